@@ -3,6 +3,7 @@ import cv2
 from PyQt5 import QtCore
 from score_behavior.score_analyzer import FrameAnalyzer
 from score_behavior.global_defs import DeviceState
+from score_behavior import video_overlay
 import logging
 
 from .dialog_controller import TrialDialogController
@@ -97,13 +98,13 @@ class ObjectSpaceFrameAnalyzer(FrameAnalyzer):
         for place, state in self.obj_state.items():
             if place in self.rect_coord and state:
                 pt1, pt2 = self.rect_coord[place](w, h)
-                cv2.rectangle(frame, pt1, pt2, (0, 0, 255), cv2.FILLED)
+                video_overlay.rectangle(frame, pt1, pt2, (0, 0, 255), cv2.FILLED)
         font = cv2.FONT_HERSHEY_DUPLEX
         tpt = 300, self.device.top_info_band_height-2
         if self.obj_state['TR']:
-            cv2.putText(frame, "Trial: on", tpt, font, 0.5, (255, 255, 255), 1)
+            video_overlay.put_text(frame, "Trial: on", tpt, font, 0.5, (255, 255, 255), 1)
         else:
-            cv2.putText(frame, "Trial: off", tpt, font, 0.5, (255, 255, 255), 1)
+            video_overlay.put_text(frame, "Trial: off", tpt, font, 0.5, (255, 255, 255), 1)
 
     def finalize_trial(self):
         scheme = self.session.get_scheme_trial_info()
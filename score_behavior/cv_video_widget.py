@@ -11,7 +11,12 @@ logger = logging.getLogger(__name__)
 
 
 class OpenCVQImage(QtGui.QImage):
-    def __init__(self, opencv_bgr_img):
+    """a QImage wrapping the pixels of an OpenCV BGR image, without copying them.
+
+    With Qt versions lacking the BGR888 format, the image is converted into rgb_buffer, if given, so that the
+    conversion does not allocate.
+    """
+    def __init__(self, opencv_bgr_img, rgb_buffer=None):
 
         h, w, n_channels = opencv_bgr_img.shape
         depth = opencv_bgr_img.dtype
@@ -19,10 +24,16 @@ class OpenCVQImage(QtGui.QImage):
             raise ValueError("the input image must be 8-bit, 3-channel")
 
         # it's assumed the image is in BGR format
-        opencv_rgb_img = cv2.cvtColor(opencv_bgr_img, cv2.COLOR_BGR2RGB)
-        self._imgData = opencv_rgb_img.tostring()
-        super(OpenCVQImage, self).__init__(self._imgData, w, h,
-                                           QtGui.QImage.Format_RGB888)
+        if hasattr(QtGui.QImage, 'Format_BGR888'):
+            img = np.ascontiguousarray(opencv_bgr_img)
+            image_format = QtGui.QImage.Format_BGR888
+        else:
+            if rgb_buffer is None or rgb_buffer.shape != opencv_bgr_img.shape:
+                rgb_buffer = np.empty_like(opencv_bgr_img)
+            img = cv2.cvtColor(opencv_bgr_img, cv2.COLOR_BGR2RGB, dst=rgb_buffer)
+            image_format = QtGui.QImage.Format_RGB888
+        self._imgData = img  # the QImage does not keep the pixels alive by itself
+        super(OpenCVQImage, self).__init__(img.data, w, h, img.strides[0], image_format)
 
 
 class CVVideoWidget(QtWidgets.QWidget):
@@ -41,6 +52,7 @@ class CVVideoWidget(QtWidgets.QWidget):
         super(CVVideoWidget, self).__init__(parent, flags=flags_)
         self._camera_device = None
         self._frame = None
+        self._rgb_buffer = None
         self.setMinimumSize(640, 480)
         self.setMaximumSize(640, 480)
 
@@ -72,13 +84,19 @@ class CVVideoWidget(QtWidgets.QWidget):
 
     @QtCore.pyqtSlot(np.ndarray)
     def _on_new_frame(self, frame):
-        self._frame = frame.copy()
+        # the frame comes from the display buffer pool of the device: it is copied, and its buffer given back, so
+        # that the device never writes over the frame being painted
+        if self._frame is None or self._frame.shape != frame.shape or self._frame.dtype != frame.dtype:
+            self._frame = np.empty_like(frame)
+        np.copyto(self._frame, frame)
+        self._camera_device.display_frame_taken()
         self.new_frame.emit(self._frame)
         self.update()
 
     def changeEvent(self, e):
         if self._camera_device is not None and e.type() == QtCore.QEvent.EnabledChange:
             if self.isEnabled():
+                self._camera_device.reset_display_frames()
                 self._camera_device.new_frame.connect(self._on_new_frame)
             else:
                 self._camera_device.new_frame.disconnect(self._on_new_frame)
@@ -89,7 +107,10 @@ class CVVideoWidget(QtWidgets.QWidget):
             painter.fillRect(self.rect(), QtCore.Qt.darkGray)
             return
         painter = QtGui.QPainter(self)
-        painter.drawImage(QtCore.QPoint(0, 0), OpenCVQImage(self._frame))
+        image = OpenCVQImage(self._frame, self._rgb_buffer)
+        if image.format() == QtGui.QImage.Format_RGB888:
+            self._rgb_buffer = image._imgData
+        painter.drawImage(QtCore.QPoint(0, 0), image)
 
     def mousePressEvent(self, a0: QtGui.QMouseEvent):
         self.mouse_press_action_signal.emit(a0.x(), a0.y())
@@ -0,0 +1,85 @@
+# benchmark of the memory allocated for each frame between the camera and the QImage drawn by the video widget
+
+import argparse
+import time
+import tracemalloc
+
+import numpy as np
+import cv2
+from PyQt5 import QtGui
+
+from score_behavior.cv_video_widget import OpenCVQImage
+from score_behavior.frame_buffers import FrameBufferPool, make_banded_frame, resize_into_pool
+
+
+def copying_frame_path(frame, band_height, scale):
+    """the reference implementation: bands by concatenation, a resized copy, a copy and an RGB string"""
+    h, w, _ = frame.shape
+    band = np.zeros((band_height, w, 3), frame.dtype)
+    frame = np.concatenate((band, frame, band), axis=0)
+    h, w, _ = frame.shape
+    frame_display = cv2.resize(frame, (int(w * scale), int(h * scale)), interpolation=cv2.INTER_AREA)
+    frame_widget = frame_display.copy()
+    h, w, _ = frame_widget.shape
+    data = cv2.cvtColor(frame_widget, cv2.COLOR_BGR2RGB).tostring()
+    return QtGui.QImage(data, w, h, QtGui.QImage.Format_RGB888), data
+
+
+class PooledFramePath:
+    def __init__(self, band_height, scale):
+        self.band_height = band_height
+        self.scale = scale
+        self.frame_pool = FrameBufferPool(4)
+        self.display_pool = FrameBufferPool(4)
+        self.rgb_buffer = None
+
+    def __call__(self, frame):
+        frame = make_banded_frame(frame, self.frame_pool, self.band_height, self.band_height)
+        frame_display = resize_into_pool(frame, self.display_pool, self.scale)
+        image = OpenCVQImage(frame_display, self.rgb_buffer)
+        if image.format() == QtGui.QImage.Format_RGB888:
+            self.rgb_buffer = image._imgData
+        return image
+
+
+def measure(path, frames):
+    """mean of the peak of memory allocated while processing each frame, and mean time per frame"""
+    path(frames[0])  # the pools allocate on the first frame
+    peaks = []
+    t0 = time.perf_counter()
+    tracemalloc.start()
+    for frame in frames:
+        current, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        result = path(frame)
+        _, peak = tracemalloc.get_traced_memory()
+        peaks.append(peak - current)
+        del result
+    tracemalloc.stop()
+    return np.mean(peaks), (time.perf_counter() - t0) / len(frames)
+
+
+def run_benchmark(n_frames=200, width=640, height=480, scale=0.8, band_height=15):
+    rng = np.random.RandomState(0)
+    frames = [rng.randint(0, 256, (height, width, 3)).astype(np.uint8) for _ in range(8)]
+    frames = [frames[i % len(frames)] for i in range(n_frames)]
+    copying_bytes, copying_time = measure(lambda f: copying_frame_path(f, band_height, scale), frames)
+    pooled_bytes, pooled_time = measure(PooledFramePath(band_height, scale), frames)
+    print("frames: {} of {}x{}, display scale {}".format(n_frames, width, height, scale))
+    print("copying frame path: {:.0f} bytes allocated per frame".format(copying_bytes))
+    print("pooled frame path:  {:.0f} bytes allocated per frame".format(pooled_bytes))
+    print("time per frame (with tracing): {:.2f} ms copying, {:.2f} ms pooled".format(1.e3 * copying_time,
+                                                                                    1.e3 * pooled_time))
+
+
+def _main():
+    parser = argparse.ArgumentParser(description='Benchmark the memory allocated per frame on the display path',
+                                     prog='frame_buffer_benchmark')
+    parser.add_argument('--frames', type=int, default=200, help="number of frames")
+    parser.add_argument('--scale', type=float, default=0.8, help="display scale")
+    args = parser.parse_args()
+    run_benchmark(args.frames, scale=args.scale)
+
+
+if __name__ == '__main__':
+    _main()
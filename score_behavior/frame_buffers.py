@@ -0,0 +1,194 @@
+import threading
+import time
+import logging
+
+import numpy as np
+import cv2
+
+from score_behavior.frame_pipeline import FramePacket
+
+logger = logging.getLogger(__name__)
+
+
+class FrameBufferPool:
+    """a fixed set of preallocated frame buffers, handed out in turn.
+
+    A buffer is handed out again n_buffers acquisitions later, so whoever holds a frame from the pool must be done
+    with it by then. The buffers are allocated again only when the frame shape changes.
+    """
+
+    def __init__(self, n_buffers=4):
+        self.n_buffers = max(int(n_buffers), 1)
+        self._buffers = []
+        self._shape = None
+        self._dtype = None
+        self._next = 0
+
+    def acquire(self, shape, dtype=np.uint8):
+        shape = tuple(shape)
+        if shape != self._shape or np.dtype(dtype) != self._dtype:
+            logger.debug("allocating {} frame buffers of shape {}".format(self.n_buffers, shape))
+            self._buffers = [np.zeros(shape, dtype) for _ in range(self.n_buffers)]
+            self._shape = shape
+            self._dtype = np.dtype(dtype)
+            self._next = 0
+        buffer = self._buffers[self._next]
+        self._next = (self._next + 1) % self.n_buffers
+        return buffer
+
+
+rotate_codes = {90: cv2.ROTATE_90_CLOCKWISE,
+                180: cv2.ROTATE_180,
+                270: cv2.ROTATE_90_COUNTERCLOCKWISE}
+
+
+def rotated_shape(shape, rotate_angle):
+    h, w = shape[:2]
+    if rotate_angle in (90, 270):
+        h, w = w, h
+    return (h, w) + tuple(shape[2:])
+
+
+def transform_into(frame, rotate_angle, mirrored, dst):
+    """rotates and mirrors the frame straight into dst, which must have the rotated shape"""
+    if rotate_angle in rotate_codes:
+        cv2.rotate(frame, rotate_codes[rotate_angle], dst=dst)
+        if mirrored:
+            cv2.flip(dst, 1, dst=dst)
+    elif mirrored:
+        cv2.flip(frame, 1, dst=dst)
+    else:
+        np.copyto(dst, frame)
+    return dst
+
+
+def make_banded_frame(frame, pool, top_band_height, bottom_band_height, rotate_angle=0, mirrored=False):
+    """the rotated and mirrored frame, between black info bands, in a buffer from the pool"""
+    h, w, n_channels = rotated_shape(frame.shape, rotate_angle)
+    banded = pool.acquire((top_band_height + h + bottom_band_height, w, n_channels), frame.dtype)
+    # the bands of a reused buffer still have the text drawn on them the previous time
+    banded[:top_band_height] = 0
+    banded[top_band_height + h:] = 0
+    transform_into(frame, rotate_angle, mirrored, banded[top_band_height:top_band_height + h])
+    return banded
+
+
+def resize_into_pool(frame, pool, scale, interpolation=cv2.INTER_AREA):
+    """the frame resized by scale, in a buffer from the pool"""
+    h, w = frame.shape[:2]
+    size = (int(w * scale), int(h * scale))
+    dst = pool.acquire((size[1], size[0]) + frame.shape[2:], frame.dtype)
+    cv2.resize(frame, size, dst=dst, interpolation=interpolation)
+    return dst
+
+
+class FrameRing:
+    """the latest frames from a capture thread, in a fixed ring of preallocated slots.
+
+    The capture writes each frame into the next slot (reserve), then publishes it with a sequence number and the
+    time of capture. Publishing takes no lock: the consumer only finds out about a frame once its sequence number
+    is set, and the lock is only taken to wake up a consumer waiting in read_next. A frame stays valid until
+    n_slots - 1 more frames have been captured.
+
+    dropped counts the frames the consumer never got, because newer ones came before it asked; duplicates counts
+    the times the consumer asked and no frame newer than the last one it got was there.
+    """
+
+    def __init__(self, n_slots=4):
+        self.n_slots = max(int(n_slots), 2)
+        self._buffers = [None] * self.n_slots
+        self._frames = [None] * self.n_slots
+        self._timestamps = [0.] * self.n_slots
+        self._seqs = [-1] * self.n_slots
+        self._next_seq = 0
+        self._latest_seq = -1
+        self._last_read = -1
+        self._waiting = 0
+        self._condition = threading.Condition()
+        self._closed = False
+        self.captured = 0
+        self.dropped = 0
+        self.duplicates = 0
+
+    def reserve(self, shape, dtype=np.uint8):
+        """the buffer for the capture to write the next frame into.
+
+        The same buffer is handed out again until a frame is published, so a failed read does not use up a slot.
+        """
+        ix = self._next_seq % self.n_slots
+        buffer = self._buffers[ix]
+        if buffer is None or buffer.shape != tuple(shape) or buffer.dtype != np.dtype(dtype):
+            buffer = np.zeros(shape, dtype)
+            self._buffers[ix] = buffer
+        return buffer
+
+    def publish(self, frame, timestamp=None):
+        """makes the frame just captured into the reserved buffer the latest one, returns its sequence number"""
+        if timestamp is None:
+            timestamp = time.time()
+        seq = self._next_seq
+        ix = seq % self.n_slots
+        self._frames[ix] = frame
+        self._timestamps[ix] = timestamp
+        self._seqs[ix] = seq
+        self._next_seq += 1
+        self.captured += 1
+        self._latest_seq = seq
+        if self._waiting:
+            with self._condition:
+                self._condition.notify_all()
+        return seq
+
+    def _packet(self, seq):
+        ix = seq % self.n_slots
+        packet = FramePacket(self._frames[ix], self._seqs[ix], self._timestamps[ix])
+        if packet.capture_no != seq:
+            return None  # overwritten since, can only happen if the consumer is n_slots frames behind
+        return packet
+
+    def latest(self):
+        """the latest frame as a FramePacket, without counting it as read by the consumer"""
+        if self._latest_seq < 0:
+            return None
+        return self._packet(self._latest_seq)
+
+    def read_next(self, timeout=None):
+        """the latest frame newer than the last one returned, as a FramePacket.
+
+        Waits up to timeout seconds (forever if None) for the capture; returns None if no new frame came by then or
+        the ring is closed.
+        """
+        seq = self._latest_seq
+        if seq <= self._last_read and timeout != 0:
+            deadline = None if timeout is None else time.time() + timeout
+            with self._condition:
+                self._waiting += 1
+                try:
+                    while self._latest_seq <= self._last_read and not self._closed:
+                        remaining = None if deadline is None else deadline - time.time()
+                        if remaining is not None and remaining <= 0:
+                            break
+                        self._condition.wait(remaining)
+                finally:
+                    self._waiting -= 1
+            seq = self._latest_seq
+        if seq <= self._last_read:
+            if not self._closed:
+                self.duplicates += 1
+            return None
+        packet = self._packet(seq)
+        if packet is None:
+            return None
+        if self._last_read >= 0:
+            self.dropped += seq - self._last_read - 1
+        self._last_read = seq
+        return packet
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+    def report(self):
+        return "{} frames captured, {} dropped, {} duplicate reads".format(self.captured, self.dropped,
+                                                                           self.duplicates)
@@ -0,0 +1,211 @@
+import collections
+import threading
+import time
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class RingBuffer:
+    """a bounded, thread safe fifo between two pipeline stages.
+
+    When full, put either waits for room (overwrite=False) or throws away the oldest item (overwrite=True), which
+    is then counted as dropped.
+    """
+
+    def __init__(self, capacity, overwrite=False):
+        self.capacity = max(int(capacity), 1)
+        self.overwrite = overwrite
+        self._items = collections.deque()
+        self._condition = threading.Condition()
+        self._closed = False
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def put(self, item):
+        with self._condition:
+            if len(self._items) >= self.capacity:
+                if self.overwrite:
+                    self._items.popleft()
+                    self.dropped += 1
+                else:
+                    while len(self._items) >= self.capacity and not self._closed:
+                        self._condition.wait()
+            if self._closed:
+                return
+            self._items.append(item)
+            self._condition.notify_all()
+
+    def get(self, timeout=None):
+        """the oldest item, or None if the buffer is closed or nothing came within timeout"""
+        with self._condition:
+            if not self._items and not self._closed:
+                self._condition.wait(timeout)
+            if not self._items:
+                return None
+            item = self._items.popleft()
+            self._condition.notify_all()
+            return item
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+
+class LatencyHistogram:
+    """counts of latencies in logarithmically spaced bins, from 0.1 ms to 10 s"""
+
+    def __init__(self, n_bins=50, min_latency=1.e-4, max_latency=10.):
+        self.edges = np.logspace(np.log10(min_latency), np.log10(max_latency), n_bins + 1)
+        self.counts = np.zeros(n_bins + 2, np.int64)  # with underflow and overflow bins
+        self.count = 0
+        self.total = 0.
+        self.max = 0.
+        self._lock = threading.Lock()
+
+    def add(self, latency):
+        with self._lock:
+            self.counts[np.searchsorted(self.edges, latency, side='right')] += 1
+            self.count += 1
+            self.total += latency
+            self.max = max(self.max, latency)
+
+    def percentile(self, q):
+        """the upper edge of the bin holding the q-th percentile"""
+        if self.count == 0:
+            return 0.
+        ix = int(np.searchsorted(np.cumsum(self.counts), q / 100. * self.count))
+        if ix == 0:
+            return self.edges[0]
+        if ix > len(self.edges) - 1:
+            return self.max
+        return self.edges[ix]
+
+    @property
+    def mean(self):
+        if self.count == 0:
+            return 0.
+        return self.total / self.count
+
+    def summary(self):
+        return "n={} mean={:.1f} ms p50<{:.1f} ms p95<{:.1f} ms p99<{:.1f} ms max={:.1f} ms".format(
+            self.count, 1.e3 * self.mean, 1.e3 * self.percentile(50), 1.e3 * self.percentile(95),
+            1.e3 * self.percentile(99), 1.e3 * self.max)
+
+
+class FramePacket:
+    """a frame on its way through the pipeline, with the time and sequence number of its capture"""
+
+    def __init__(self, frame, capture_no, timestamp=None):
+        self.frame = frame
+        self.capture_no = capture_no
+        if timestamp is None:
+            timestamp = time.time()
+        self.timestamp = timestamp
+
+
+class PipelineStage:
+    """a thread taking packets from an input buffer, processing them and passing the results to an output buffer.
+
+    func takes a packet and returns the packet to pass on, or None to stop it there. The time spent in func is
+    kept in a latency histogram.
+    """
+
+    def __init__(self, name, func, in_buffer, out_buffer=None):
+        self.name = name
+        self.func = func
+        self.in_buffer = in_buffer
+        self.out_buffer = out_buffer
+        self.latency = LatencyHistogram()
+        self.processed = 0
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self.run, name="PipelineStage-" + self.name, daemon=True)
+        self._thread.start()
+
+    def run(self):
+        while self._running:
+            packet = self.in_buffer.get(timeout=0.1)
+            if packet is None:
+                continue
+            t0 = time.perf_counter()
+            try:
+                packet = self.func(packet)
+            except Exception as e:
+                logger.exception("pipeline stage {} failed: {}".format(self.name, e))
+                packet = None
+            self.latency.add(time.perf_counter() - t0)
+            self.processed += 1
+            if packet is not None and self.out_buffer is not None:
+                self.out_buffer.put(packet)
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+class FramePipeline:
+    """a chain of stages connected by ring buffers.
+
+    The first buffer is fed by the capture, which never waits: when the next stage falls behind, the oldest frames
+    are dropped. The buffers of the stages listed in skip_stages drop frames the same way, the other ones make the
+    previous stage wait.
+    """
+
+    def __init__(self, stages, buffer_size=30, skip_stages=()):
+        self.input = RingBuffer(buffer_size, overwrite=True)
+        self.stages = []
+        self.buffers = [self.input]
+        in_buffer = self.input
+        for i, (name, func) in enumerate(stages):
+            out_buffer = None
+            if i < len(stages) - 1:
+                out_buffer = RingBuffer(buffer_size, overwrite=stages[i + 1][0] in skip_stages)
+                self.buffers.append(out_buffer)
+            self.stages.append(PipelineStage(name, func, in_buffer, out_buffer))
+            in_buffer = out_buffer
+        self.capture_latency = LatencyHistogram()
+        self.end_to_end_latency = LatencyHistogram()
+        self._capture_no = 0
+        self._last_capture = None
+
+    def start(self):
+        for stage in self.stages:
+            stage.start()
+
+    def stop(self):
+        for buffer in self.buffers:
+            buffer.close()
+        for stage in self.stages:
+            stage.stop()
+        logger.info("Frame pipeline statistics:\n" + self.report())
+
+    def push(self, frame, timestamp=None):
+        """called by the capture for each new frame"""
+        packet = FramePacket(frame, self._capture_no, timestamp)
+        self._capture_no += 1
+        if self._last_capture is not None:
+            self.capture_latency.add(packet.timestamp - self._last_capture)
+        self._last_capture = packet.timestamp
+        self.input.put(packet)
+
+    def frame_done(self, packet):
+        """called by the last stage, to keep the time from capture to the end of the pipeline"""
+        self.end_to_end_latency.add(time.time() - packet.timestamp)
+
+    def report(self):
+        lines = ["capture interval: " + self.capture_latency.summary()]
+        for stage, buffer in zip(self.stages, self.buffers):
+            lines.append("{}: {}, {} dropped before it".format(stage.name, stage.latency.summary(), buffer.dropped))
+        lines.append("capture to end: " + self.end_to_end_latency.summary())
+        return '\n'.join(lines)
@@ -7,11 +7,13 @@ import logging
 import datetime
 
 from score_behavior.tracking.tracker import Tracker
+from score_behavior.tracking.background_cache import BackgroundCache
 from score_behavior.ObjectSpace.session_manager import ObjectSpaceSessionManager
 from score_behavior.score_session_controller import SessionController
 from score_behavior.global_defs import DeviceState as State
 from score_behavior.tracking_controller.tracker_controller import TrackerController
 from score_behavior.score_config import get_config_section
+from score_behavior import video_overlay
 
 logger = logging.getLogger(__name__)
 
@@ -34,6 +36,7 @@ class FrameAnalyzer(QtCore.QObject):
         self.do_track = False
         self.default_trial_duration_seconds = 0
         self.trial_duration_seconds = 0
+        self.arena = None
         self.read_config()
         self._device = device
         self.csv_out = None
@@ -66,6 +69,8 @@ class FrameAnalyzer(QtCore.QObject):
         if "default_trial_duration_seconds" in d:
             self.default_trial_duration_seconds = datetime.timedelta(seconds=d['default_trial_duration_seconds'])
             self.trial_duration_seconds = self.default_trial_duration_seconds
+        if "arena" in d:
+            self.arena = d["arena"]
 
     @property
     def device(self):
@@ -187,6 +192,8 @@ class FrameAnalyzer(QtCore.QObject):
         else:
             self.session.set_comments('')
 
+        self.setup_background_for_trial()
+
         trial_info = self.session.get_trial_results_info()
         self.make_splash_screen(trial_info)
         self.trial_number_changed_signal.emit(str(trial_info['sequence_nr']))
@@ -236,8 +243,24 @@ class FrameAnalyzer(QtCore.QObject):
             self.session.set_trial_finished(self.video_out_filename, self.video_out_raw_filename)
         self.trial_state = self.TrialState.IDLE
         if self.tracker:
+            self.tracker.save_background()
             self.tracker.delete_all_animals()
 
+    def setup_background_for_trial(self):
+        """the background is kept in a cache for the session, for each camera, arena and camera setting.
+
+        At the start of each trial, the tracker loads it from there if needed, and checks it against the first frames.
+        """
+        if not self.tracker:
+            return
+        camera_id = getattr(self.device, 'camera_id', None)
+        source = 'video' if camera_id is None else 'camera{}'.format(camera_id)
+        if self.arena:
+            source += '_' + str(self.arena)
+        self.tracker.set_background_cache(BackgroundCache(self.session.get_background_cache_dir()), source,
+                                          self.device.rotate_angle, self.device.mirrored)
+        self.tracker.begin_trial()
+
     def make_splash_screen(self, trial_info):
         width, height = self.device.frame_size_out
         self.device.splash_screen_countdown = self.device.fps * 3  # show the splash screen for three seconds
@@ -363,10 +386,10 @@ class FrameAnalyzer(QtCore.QObject):
 
             if self.animal_start_x != -1:
                 yellow = (0, 255, 255)
-                cv2.line(frame, (int(self.animal_start_x / self.device.scale),
-                                 int(self.animal_start_y / self.device.scale)),
-                                (int(self.animal_end_x / self.device.scale),
-                                 int(self.animal_end_y / self.device.scale)), yellow, 2)
+                video_overlay.line(frame, (int(self.animal_start_x / self.device.scale),
+                                           int(self.animal_start_y / self.device.scale)),
+                                          (int(self.animal_end_x / self.device.scale),
+                                           int(self.animal_end_y / self.device.scale)), yellow, 2)
 
     @QtCore.pyqtSlot(int, int)
     def mouse_press_action(self, x, y):
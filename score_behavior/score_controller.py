@@ -3,6 +3,7 @@ import cv2
 import numpy as np
 import time
 import datetime
+import threading
 import warnings
 import logging
 
@@ -11,6 +12,14 @@ from PyQt5 import QtCore
 from .global_defs import DeviceState as State
 from score_behavior.video_control import VideoControlWidget
 from score_behavior.score_config import get_config_section
+from score_behavior.video_writer import AsyncVideoWriter
+from score_behavior.video_seek_index import VideoSeekIndex
+from score_behavior.video_reader import PrefetchingVideoReader
+from score_behavior.video_proxy import VideoProxy
+from score_behavior.video_overlay import OverlayWriter
+from score_behavior import video_overlay
+from score_behavior.frame_pipeline import FramePipeline
+from score_behavior.frame_buffers import FrameBufferPool, FrameRing, make_banded_frame, resize_into_pool
 
 logger = logging.getLogger(__name__)
 
@@ -70,6 +79,7 @@ class DeviceManager(QtCore.QObject):
         self.video_out_filename = None
         self.out = None
         self.raw_out = None
+        self.overlay_out = None  # what is drawn on the frames, when only the raw video is encoded
         self.display_time = True
         self.save_raw_video = True
         self.yes_no = False
@@ -78,6 +88,12 @@ class DeviceManager(QtCore.QObject):
         self.bottom_info_band_height = 15
         # this flag to close the manager
         self.to_release = False
+        # preallocated buffers for the frames after capture, and for the frames sent to the display
+        self.frame_pool = FrameBufferPool(4)
+        self.display_pool = None
+        self._display_slots = None
+        self.display_frames_skipped = 0
+        self.set_display_pool(4)
         self._device = None  # the underlying video source device
         self.init_device()
         # if self.analyzer.do_track:
@@ -253,23 +269,59 @@ class DeviceManager(QtCore.QObject):
         elif platform.system() == 'Windows':
             codec_string = 'MSVC'
 
+        writer_queue_size = 64
+        writer_policy = 'block'
+        recording_mode = 'annotated'
         d = get_config_section("video")
         if 'codec' in d:
             codec_string = d['codec']
+        if 'writer_queue_size' in d:
+            writer_queue_size = d['writer_queue_size']
+        if 'writer_policy' in d:
+            writer_policy = d['writer_policy']
+        if 'recording_mode' in d:
+            recording_mode = d['recording_mode']
 
         logger.info("using codec " + codec_string + " to save video")
         fourcc = cv2.VideoWriter_fourcc(*codec_string)
         if self.out:
             # self.out.release()
             self.out = None
-        self.out = cv2.VideoWriter(filename, fourcc, self.fps, self.frame_size_out)
+        self.overlay_out = None
         self.frame_no = 0
-        if self.save_raw_video:
-            if self.raw_out:
-                # self.raw_out.release()
-                self.raw_out = None
-            self.raw_out = cv2.VideoWriter(filename_raw, fourcc, self.fps, self.frame_size_out)
-        if self.out.isOpened():
+        if recording_mode == 'raw_overlay' and filename_raw:
+            # only the raw video is encoded, and what is drawn on the frames is recorded next to it, for the
+            # annotated video to be rendered later with video_overlay
+            logger.info("recording the overlay of {} in {}".format(filename_raw,
+                                                                   OverlayWriter.sidecar_file_name(filename_raw)))
+            if writer_policy == 'drop_oldest':
+                # a frame dropped from the raw video would put the overlay of the next ones on the wrong frames
+                logger.warning("the drop_oldest writer policy can't be used with the raw_overlay recording mode, "
+                               "spilling frames instead")
+                writer_policy = 'spill'
+            self.raw_out = AsyncVideoWriter(filename_raw, fourcc, self.fps, self.frame_size_out, writer_queue_size,
+                                            writer_policy)
+            self.overlay_out = OverlayWriter(OverlayWriter.sidecar_file_name(filename_raw))
+            writer = self.raw_out
+        else:
+            # the frames are encoded on a separate thread for each file, so that codec stalls do not delay
+            # acquisition
+            self.out = AsyncVideoWriter(filename, fourcc, self.fps, self.frame_size_out, writer_queue_size,
+                                        writer_policy)
+            if self.save_raw_video:
+                if self.raw_out:
+                    # self.raw_out.release()
+                    self.raw_out = None
+                self.raw_out = AsyncVideoWriter(filename_raw, fourcc, self.fps, self.frame_size_out,
+                                                writer_queue_size, writer_policy)
+                if not self.raw_out.isOpened():
+                    # the trial goes on with the annotated video alone
+                    logger.error("Can't open raw output file {}".format(filename_raw))
+                    self.error_signal.emit("Can't open raw output file {}".format(filename_raw))
+                    self.raw_out.release()
+                    self.raw_out = None
+            writer = self.out
+        if writer.isOpened():
             logger.info("successfully opened video out file {} at {} fps and {} frame size".format(filename, self.fps,
                                                                                                    self.frame_size_out))
             self.start_time = self.get_absolute_time()
@@ -283,40 +335,60 @@ class DeviceManager(QtCore.QObject):
         self.video_out_file_changed_signal.emit("Video: " + os.path.basename(filename))
 
     def close_video_out_files(self):
+        # release waits for the writer threads to encode the frames still queued
         if self.out:
             self.out.release()
             self.out = None
         if self.raw_out:
             self.raw_out.release()
             self.raw_out = None
+        if self.overlay_out:
+            self.overlay_out.close()
+            self.overlay_out = None
         logger.debug("closed video files for trial")
 
     @QtCore.pyqtSlot()
     def query_frame(self):
         pass  # pure virtual function
 
+    def write_raw_frame(self, frame):
+        """writes the frame, before anything is drawn on it, to the raw video. Returns the number of the frame in the
+        overlay sidecar, if there is one, to pass on to write_out_frame"""
+        if self.raw_out and (self.save_raw_video or self.overlay_out):
+            self.raw_out.write(frame)
+            if self.overlay_out:
+                return self.overlay_out.begin_frame(frame)
+        return None
+
+    def write_out_frame(self, frame, overlay_no=None):
+        """writes the frame, with everything drawn on it, to the annotated video, or its overlay to the sidecar"""
+        if self.overlay_out and overlay_no is not None:
+            self.overlay_out.end_frame(overlay_no)
+        if self.out:
+            self.out.write(frame)
+
     def add_timestamp_string(self, frame):
 
         w, h = self.frame_size_out
         font = cv2.FONT_HERSHEY_DUPLEX
         datestring = datetime.datetime.now().isoformat()
         tpt = 35, h - 5
-        cv2.putText(frame, datestring, tpt, font, 0.5, (255, 255, 255), 1)
+        video_overlay.put_text(frame, datestring, tpt, font, 0.5, (255, 255, 255), 1)
         if self.state == State.ACQUIRING and self.display_time:
             cur_time = str(self.get_cur_time())[:-4]
             font = cv2.FONT_HERSHEY_DUPLEX
             # noinspection PyUnusedLocal
             # t_size, baseline = cv2.getTextSize(cur_time, font, 0.5, 1)
             tpt = 330, h - 5
-            cv2.putText(frame, cur_time, tpt, font, 0.5, (255, 255, 255), 1)
+            video_overlay.put_text(frame, cur_time, tpt, font, 0.5, (255, 255, 255), 1)
             cur_frame = str(self.frame_no)
 
             # t_size, baseline = cv2.getTextSize(cur_time, font, 0.5, 1)
             tpt = 430, h - 5
-            cv2.putText(frame, cur_frame, tpt, font, 0.5, (255, 255, 255), 1)
+            video_overlay.put_text(frame, cur_frame, tpt, font, 0.5, (255, 255, 255), 1)
             tpt = 500, h - 5
             fps_string = "fps: " + "{0:5.1f}".format(self.current_fps)
-            cv2.putText(frame, fps_string, tpt, font, 0.5, (255, 255, 255), 1)
+            video_overlay.put_text(frame, fps_string, tpt, font, 0.5, (255, 255, 255), 1)
 
     def get_cur_time(self):
         """get current time, null implementation"""
@@ -367,6 +439,32 @@ class DeviceManager(QtCore.QObject):
             self.analyzer.process_frame(frame)
         self.add_timestamp_string(frame)
 
+    def set_display_pool(self, n_buffers):
+        self.display_pool = FrameBufferPool(n_buffers)
+        # a buffer is reused n_buffers frames later, so at most n_buffers - 1 frames can wait for the display
+        self._display_slots = threading.Semaphore(max(n_buffers - 1, 1))
+
+    def emit_display_frame(self, frame, scale=None):
+        """sends the frame, resized to the display scale, to the display if anything is connected to it.
+
+        The frame is left out if the display has not taken the frames sent before, as its buffer would be written
+        over while they wait.
+        """
+        if self.receivers(self.new_frame) == 0:
+            return
+        if not self._display_slots.acquire(blocking=False):
+            self.display_frames_skipped += 1
+            return
+        self.new_frame.emit(resize_into_pool(frame, self.display_pool, self.scale if scale is None else scale))
+
+    def display_frame_taken(self):
+        """called by the display once it is done with a frame sent with new_frame, so that its buffer can be reused"""
+        self._display_slots.release()
+
+    def reset_display_frames(self):
+        """forgets the frames sent to the display and not taken, e.g. when it was disconnected in the meantime"""
+        self._display_slots = threading.Semaphore(max(self.display_pool.n_buffers - 1, 1))
+
 
 # noinspection PyAttributeOutsideInit
 class VideoDeviceManager(DeviceManager):
@@ -374,11 +472,24 @@ class VideoDeviceManager(DeviceManager):
     frame_pos_signal = QtCore.pyqtSignal(int, name="CameraDevice.frame_pos_signal")
     time_pos_signal = QtCore.pyqtSignal(str, name="CameraDevice.time_pos_signal")
     video_in_changed_signal = QtCore.pyqtSignal(str, name="CameraDevice.video_in_changed_signal")
+    frame_cache_signal = QtCore.pyqtSignal(str, name="CameraDevice.frame_cache_signal")
 
-    speed_possible = ['0.5', '0.8', '1', '1.2', '1.5', '2']
+    speed_possible = ['0.5', '0.8', '1', '1.2', '1.5', '2', '4', '8', '16']
 
     def __init__(self, video_file=None, parent_window=None, analyzer=None):
         self.video_in_file_name = video_file
+        self.read_ahead_frames = 32
+        self.frame_cache_mb = 256
+        self.reader = None  # the prefetching reader, if the frames are decoded ahead
+        self._stats_frame_no = 0  # the frame the cache statistics were last shown at
+        self.max_display_fps = 60
+        self.frame_step = 1  # the frames the video moves on at each timer tick, more than one in a fast review
+        self.review_frames = None  # the frames shown in a fast review
+        self._review_position = 0.
+        self.proxy = None  # the downscaled copy of the video, if there is one, for navigation and fast review
+        self._proxy_active = False  # whether the frames shown come from the proxy
+        self._proxy_frame_no = 0  # the frame of the proxy shown next
+        self.read_config()
         super(VideoDeviceManager, self).__init__(parent_window=parent_window, analyzer=analyzer)
         self.save_raw_video = False
         self.playback_speed = 1.
@@ -386,6 +497,15 @@ class VideoDeviceManager(DeviceManager):
         self.video_control_widget = None
         self.state = State.READY
 
+    def read_config(self):
+        d = get_config_section("video")
+        if "read_ahead_frames" in d:
+            self.read_ahead_frames = d["read_ahead_frames"]
+        if "frame_cache_mb" in d:
+            self.frame_cache_mb = d["frame_cache_mb"]
+        if "max_display_fps" in d:
+            self.max_display_fps = d["max_display_fps"]
+
     # noinspection PyUnresolvedReferences
     def init_device(self):
         if self.video_in_file_name is None:
@@ -400,7 +520,19 @@ class VideoDeviceManager(DeviceManager):
             raise RuntimeError("Could not open video file {}".format(self.video_in_file_name))
         else:
             logger.debug("Successfully opened file {}".format(self.video_in_file_name))
+        if self.read_ahead_frames > 0:
+            # decoded on its own thread, so that the timer ticks only copy the frames
+            self.reader = PrefetchingVideoReader(self._device, self.read_ahead_frames,
+                                                 int(self.frame_cache_mb * 2 ** 20))
+            self._device = self.reader
         logger.debug("video has a size of {} and {} fps".format(self.frame_size_in, self.fps))
+        # seeking falls back to the decoder until the index is loaded, or built the first time the video is opened
+        self.seek_index = None
+        threading.Thread(target=self.load_seek_index, args=(self.video_in_file_name,), name="VideoSeekIndex",
+                         daemon=True).start()
+        self.proxy = VideoProxy.load(self.video_in_file_name)
+        if self.proxy is not None:
+            logger.info("using proxy {} for navigation".format(self.proxy.proxy_file))
         if self.video_control_widget is None:
             control_widget = VideoControlWidget()
             control_widget.ui.playButton.clicked.connect(self.play_action)
@@ -425,6 +557,7 @@ class VideoDeviceManager(DeviceManager):
             self.frame_pos_signal.connect(control_widget.ui.timeSlider.setValue)
             self.frame_pos_signal.connect(control_widget.set_frame)
             self.time_pos_signal.connect(control_widget.ui.timeLabel.setText)
+            self.frame_cache_signal.connect(control_widget.ui.cacheLabel.setText)
 
             self.video_control_widget = control_widget
             self.parent_window.ui.sidebarWidget.layout().addWidget(control_widget)
@@ -434,11 +567,26 @@ class VideoDeviceManager(DeviceManager):
             self.init_thread()
         return None
 
+    def load_seek_index(self, video_file):
+        index = VideoSeekIndex.load_or_build(video_file)
+        if video_file == self.video_in_file_name:
+            self.seek_index = index
+            if self.reader is not None:
+                self.reader.seek_index = index
+            if self.frame_step > 1:
+                self.set_review_frames()
+
     def setup_input_for_trial(self):
         self.is_paused = True
         new_in_file = self.analyzer.session.get_video_in_file_name_for_trial()
         if new_in_file != self.video_in_file_name:
             self.video_in_file_name = new_in_file
+            if self.reader is not None:
+                self.reader.release()
+                self.reader = None
+            if self.proxy is not None:
+                self.proxy.close()
+            self._proxy_active = False
             self._device = None
             self.init_device()
             if self.analyzer.do_track:
@@ -478,31 +626,40 @@ class VideoDeviceManager(DeviceManager):
                 self._device is None:
             return
 
-        ret, frame = self._device.read()
+        if self.frame_step > 1 and not self.move_to_review_frame():
+            return
+
+        w, h = self.frame_size_in
+        if self._proxy_active:
+            ret, frame = self.read_proxy_frame(self.frame_pool.acquire((h, w, 3)))
+        else:
+            ret, frame = self._device.read(self.frame_pool.acquire((h, w, 3)))
 
         if ret:
             # logger.debug("acquiring frame of shape {}".format(frame.shape))
-            self.frame_no = int(self._device.get(cv2.CAP_PROP_POS_FRAMES))
+            if self._proxy_active:
+                # the frame of the video after the one shown, as if it had been read from the video
+                self.frame_no = self.proxy.source_frame(self._proxy_frame_no) + 1
+            else:
+                self.frame_no = int(self._device.get(cv2.CAP_PROP_POS_FRAMES))
             self.last_frame = frame
             self.frame_pos_signal.emit(self.frame_no)
+            # about once a second of video, however many frames are stepped over in a fast review
+            if self.reader is not None and abs(self.frame_no - self._stats_frame_no) >= max(self.fps, 1):
+                self._stats_frame_no = self.frame_no
+                self.frame_cache_signal.emit("{hits} hits, {underruns} underruns, {misses} misses".format(
+                    **self.reader.statistics()))
 
             tds = self.timedelta_to_string(self.get_cur_time())
 
             self.time_pos_signal.emit(tds)
             self.set_remaining_time()
-            h, w, _ = frame.shape
 
             if self.state == State.ACQUIRING:
-                if self.save_raw_video and self.raw_out:
-                    self.raw_out.write(frame)
+                overlay_no = self.write_raw_frame(frame)
                 self.process_frame(frame)  # should it be called only when recording?
-
-                if self.out:
-                    # logger.debug("saving frame of shape {}".format(str(frame.shape)))
-                    self.out.write(frame)
-                frame_display = cv2.resize(np.copy(frame), (int(w * self.scale), int(h * self.scale)),
-                                           interpolation=cv2.INTER_AREA)
-                self.new_frame.emit(frame_display)
+                self.write_out_frame(frame, overlay_no)
+                self.emit_display_frame(frame)
         else:
             self.video_finished_signal.emit()
             self.state = State.NOT_READY
@@ -530,8 +687,38 @@ class VideoDeviceManager(DeviceManager):
 
     @QtCore.pyqtSlot(int)
     def skip_to_frame(self, val):
-        self._device.set(cv2.CAP_PROP_POS_FRAMES, float(val))
+        if self.reader is not None:
+            # the reader seeks through the index itself, and only if the frame is not cached
+            self._device.set(cv2.CAP_PROP_POS_FRAMES, float(val))
+        elif self.seek_index is not None:
+            self.seek_index.seek(self._device, val, int(self._device.get(cv2.CAP_PROP_POS_FRAMES)))
+        else:
+            self._device.set(cv2.CAP_PROP_POS_FRAMES, float(val))
         self.frame_no = val
+        self._review_position = float(val)
+        if self.is_paused and self.proxy is not None:
+            self.show_preview(val)
+
+    def read_proxy_frame(self, image):
+        """the frame of the proxy to show next, scaled up to the size of the video into image"""
+        small = self.proxy.read(self._proxy_frame_no)
+        if small is None:
+            return False, None
+        h, w = image.shape[:2]
+        return True, cv2.resize(small, (w, h), dst=image, interpolation=cv2.INTER_LINEAR)
+
+    def show_preview(self, frame_no):
+        """shows the frame from the proxy while paused, e.g. when moving the time slider"""
+        small = self.proxy.read(self.proxy.proxy_frame(frame_no))
+        if small is None:
+            return
+        self.time_pos_signal.emit(self.timedelta_to_string(self.get_cur_time()))
+        self.emit_display_frame(small, self.scale / self.proxy.scale)
+
+    def use_proxy(self):
+        """whether the frames come from the proxy: only in a fast review, and only if they are not tracked"""
+        return self.proxy is not None and self.frame_step > 1 and (self.analyzer is None or
+                                                                  self.analyzer.tracker is None)
 
     @property
     def fps(self):
@@ -543,6 +730,14 @@ class VideoDeviceManager(DeviceManager):
         return datetime.timedelta(milliseconds=1000 * self.frame_no / self.fps)
 
     def move_to_frame(self, frame_no):
+        if self.reader is not None:
+            self._device.set(cv2.CAP_PROP_POS_FRAMES, float(frame_no))
+            self.frame_no = frame_no
+            return
+        if self.seek_index is not None:
+            self.seek_index.seek(self._device, frame_no, int(self._device.get(cv2.CAP_PROP_POS_FRAMES)))
+            self.frame_no = frame_no
+            return
         if frame_no < self.frame_no:
             warnings.warn("can't skip to earlier frame")
         while self._device.get(cv2.CAP_PROP_POS_FRAMES) < frame_no:
@@ -550,9 +745,71 @@ class VideoDeviceManager(DeviceManager):
         self.frame_no = frame_no
 
     def set_speed(self, speed):
+        """plays at speed times the frame rate of the video.
+
+        Above max_display_fps frames per second the video is reviewed: the timer ticks at max_display_fps, and each
+        tick moves on by several frames, of which only one is decoded and shown.
+        """
         self.playback_speed = speed
-        self.interval = int(1.e3 / (self.fps * speed))
+        frames_per_second = max(self.fps, 1) * speed
+        self.frame_step = max(int(round(frames_per_second / self.max_display_fps)), 1)
+        self.interval = int(1.e3 * self.frame_step / frames_per_second)
         self._timer.setInterval(self.interval)
+        self._review_position = float(self.frame_no)
+        self.set_review_frames()
+        if self._proxy_active and self.frame_step == 1:
+            # back to the video, at the frame after the last one shown from the proxy
+            self._proxy_active = False
+            self.skip_to_frame(self.frame_no)
+
+    def set_review_frames(self):
+        """the frames shown in a fast review: one every frame_step frames or, if there is a keyframe in every step,
+        the keyframes, which are decoded without the frames before them"""
+        if self.frame_step <= 1:
+            self.review_frames = None
+        else:
+            frames = np.arange(0, int(self.video_last_frame()), self.frame_step)
+            if self.seek_index is not None and self.frame_step >= self.seek_index.max_keyframe_interval:
+                keyframes = self.seek_index.keyframe_numbers
+                frames = keyframes[np.searchsorted(keyframes, frames, side='right') - 1]
+            self.review_frames = np.unique(frames)
+            logger.info("reviewing at {}x, showing {} of {} frames".format(
+                self.playback_speed, len(self.review_frames), int(self.video_last_frame())))
+            if self.analyzer is not None and self.analyzer.tracker is not None:
+                logger.warning("the tracker only gets the frames shown while reviewing at {}x".format(
+                    self.playback_speed))
+        if self.reader is not None:
+            # nothing is decoded ahead from the video while the frames come from the proxy
+            self.reader.set_schedule([] if self.use_proxy() else self.review_frames)
+
+    def move_to_review_frame(self):
+        """moves on by frame_step frames, to the last review frame before that, if it was not shown yet.
+
+        The frame number stays that of the frame shown, so that the events scored on it are at the right frame.
+        The frames come from the proxy if there is one and they are not tracked.
+        """
+        self._review_position += self.frame_step
+        target = int(self._review_position)
+        if target < int(self.video_last_frame()):
+            if self.use_proxy():
+                proxy_frame_no = self.proxy.proxy_frame(target)
+                if self.proxy.source_frame(proxy_frame_no) < self.frame_no:
+                    return False
+                self._proxy_frame_no = proxy_frame_no
+                self._proxy_active = True
+                return True
+            if self.review_frames is not None:
+                i = np.searchsorted(self.review_frames, target, side='right') - 1
+                if i >= 0:
+                    target = int(self.review_frames[i])
+        self._proxy_active = False
+        if target < self.frame_no:
+            # no new frame to show on this tick
+            return False
+        position = self._review_position
+        self.skip_to_frame(target)
+        self._review_position = position
+        return True
 
     @QtCore.pyqtSlot()
     def rewind_action(self):
@@ -563,7 +820,7 @@ class VideoDeviceManager(DeviceManager):
     @QtCore.pyqtSlot()
     def fastforward_action(self):
         new_frame = self.frame_no + 60 * self.fps
-        new_frame = min(new_frame, self.last_frame)
+        new_frame = min(new_frame, int(self.video_last_frame()))
         self.skip_to_frame(new_frame)
 
     @QtCore.pyqtSlot()
@@ -586,6 +843,8 @@ class VideoDeviceManager(DeviceManager):
 
 
 class OpenCVCameraStream(QtCore.QThread):
+    """reads the camera on its own thread, into a ring of preallocated frame slots"""
+
     def __init__(self, camera_id=0, parent=None):
         QtCore.QThread.__init__(self, parent)
         self.camera_id = camera_id
@@ -595,9 +854,11 @@ class OpenCVCameraStream(QtCore.QThread):
         logger.debug("OpenCV Capture for Camera started")
         logger.debug("width is" + str(self.width) + " height is " + str(self.height))
         self.ret = True
-        self.frame = np.zeros((self.height, self.width, 3), np.uint8)
+        self.ring = FrameRing(4)
         self.running = False
+        self._stopped = False
         self.frame_no = 0
+        self.pipeline = None  # if set, every frame is pushed into it as soon as it is captured
 
     def isOpened(self):
         return self._device.isOpened()
@@ -605,24 +866,52 @@ class OpenCVCameraStream(QtCore.QThread):
     def run(self):
         self.running = True
         while self.running:
-            self.ret, self.frame = self._device.read()
-            self.frame_no += 1
-            time.sleep(0.001)
-            logger.debug("acquired frame " + str(self.frame_no) + " frame type " + str(type(self.frame)) +
-                         " ret is " + str(self.ret) + " data type " + str(self.frame.dtype))
+            ring = self.ring
+            # the read blocks until the camera delivers the next frame
+            ret, frame = self._device.read(ring.reserve((self.height, self.width, 3)))
+            timestamp = time.time()
+            self.ret = ret
+            if not ret:
+                ring.close()
+                break
+            self.frame_no = ring.publish(frame, timestamp) + 1
+            pipeline = self.pipeline
+            if pipeline is not None:
+                pipeline.push(frame, timestamp)
+        self.running = False
+
+    def read_next(self, timeout=None):
+        """the next frame captured after the last one read, as a FramePacket, see FrameRing.read_next"""
+        return self.ring.read_next(timeout)
 
     def read(self):
-        logger.debug("read frame " + str(self.frame_no))
-        return self.ret, self.frame
+        packet = self.ring.latest()
+        if packet is None:
+            return self.ret, None
+        return self.ret, packet.frame
 
     def get(self, arg):
         return self._device.get(arg)
 
+    def stop(self):
+        if self._stopped:
+            return
+        self._stopped = True
+        self.running = False
+        self.ring.close()
+        self.wait()
+        logger.info("camera stream: " + self.ring.report())
+
 class CameraDeviceManager(DeviceManager):
     _DEFAULT_FPS = 30
 
     def __init__(self, camera_id=0, parent_window=None, analyzer=None):
         self.camera_id = camera_id
+        self.use_pipeline = False
+        self.pipeline_buffer_size = 30
+        self.pipeline = None
+        self.frame_timestamp = None  # the capture time of the frame being analyzed, when using the pipeline
+        self.read_config()
         super(CameraDeviceManager, self).__init__(parent_window=parent_window, analyzer=analyzer)
         self.init_thread()
         self.state = State.READY
@@ -640,12 +929,92 @@ class CameraDeviceManager(DeviceManager):
             raise RuntimeError("Could not initialize camera id {}".format(self.camera_id))
         if self.analyzer.do_track:
             self.analyzer.init_tracker(self.frame_size_in)
+        if self.use_pipeline:
+            self.init_pipeline()
         return None
 
+    def read_config(self):
+        d = get_config_section("video")
+        if "pipeline" in d:
+            self.use_pipeline = bool(d["pipeline"])
+        if "pipeline_buffer_size" in d:
+            self.pipeline_buffer_size = d["pipeline_buffer_size"]
+
+    def init_pipeline(self):
+        """capture, preprocessing, tracking and display each on their own thread, with buffers in between.
+
+        Encoding already runs on the threads of the video writers. The display skips frames when it falls behind.
+        """
+        self.pipeline = FramePipeline([('preprocess', self.preprocess_packet),
+                                       ('analyze', self.analyze_packet),
+                                       ('display', self.display_packet)],
+                                      buffer_size=self.pipeline_buffer_size, skip_stages=('display',))
+        # enough buffers for all the frames that can be in the pipeline buffers at once
+        self._device.ring = FrameRing(self.pipeline_buffer_size + 4)
+        self.frame_pool = FrameBufferPool(2 * self.pipeline_buffer_size + 6)
+        self.set_display_pool(self.pipeline_buffer_size + 4)
+        self.pipeline.start()
+        self._device.pipeline = self.pipeline
+        logger.info("started frame pipeline")
+
+    def preprocess(self, frame):
+        """rotation, mirroring and the info bands, written straight into a buffer from the pool"""
+        return make_banded_frame(frame, self.frame_pool, self.top_info_band_height, self.bottom_info_band_height,
+                                 self.rotate_angle, self.mirrored)
+
+    def preprocess_packet(self, packet):
+        if self.state not in (State.READY, State.ACQUIRING):
+            return None
+        packet.splash = False
+        if self.splash_screen_countdown:
+            packet.frame = self.analyzer.splash_screen
+            packet.splash = True
+            if self.splash_screen_countdown == 1:
+                self.analyzer.trial_state = self.analyzer.TrialState.READY
+            self.splash_screen_countdown -= 1
+        else:
+            packet.frame = self.preprocess(packet.frame)
+        # the raw video is written before tracking, so that a slow frame there does not hold it back
+        packet.overlay_no = None
+        if self.state == State.ACQUIRING:
+            packet.overlay_no = self.write_raw_frame(packet.frame)
+        return packet
+
+    def analyze_packet(self, packet):
+        self.frame_no += 1
+        if self.state == State.ACQUIRING:
+            self.frame_timestamp = packet.timestamp
+            self.set_remaining_time()
+            if not packet.splash:
+                self.process_frame(packet.frame)
+            self.write_out_frame(packet.frame, packet.overlay_no)
+            if self.last_frame_time:
+                inst_fps = 1. / max(packet.timestamp - self.last_frame_time, 1.e-6)
+                self.current_fps = 0.95 * self.current_fps + 0.05 * inst_fps
+            self.last_frame_time = packet.timestamp
+            self.frame_timestamp = None
+        return packet
+
+    def display_packet(self, packet):
+        self.emit_display_frame(packet.frame)
+        self.pipeline.frame_done(packet)
+        return None
+
+    def release(self):
+        if self.pipeline:
+            self._device.pipeline = None
+            self.pipeline.stop()
+            self.pipeline = None
+        self._device.stop()
+        super(CameraDeviceManager, self).release()
+
     @QtCore.pyqtSlot()
     def query_frame(self):
         if self.to_release:
             self.release()
+            return
+        if self.pipeline:
+            return  # the frames go through the pipeline threads instead
         if self.state in (State.READY, State.ACQUIRING):
             if self.splash_screen_countdown:
                 frame = self.analyzer.splash_screen
@@ -655,39 +1024,35 @@ class CameraDeviceManager(DeviceManager):
                 else:
                     pass
                 self.splash_screen_countdown -= 1
+                frame_time = time.time()
             else:
-                ret, frame = self._device.read()
-                if ret:
-                    h, w, _ = frame.shape
-                    frame = self.rotate_functions[self.rotate_angle](frame)
-                    if self.mirrored:
-                        frame = cv2.flip(frame, 1)
-                    h, w, _ = frame.shape
-                    top_band = np.zeros((self.top_info_band_height, w, 3), frame.dtype)
-                    bottom_band = np.zeros((self.bottom_info_band_height, w, 3), frame.dtype)
-                    # frame_in = frame
-                    frame = np.concatenate((top_band, frame, bottom_band), axis=0)
+                # only a frame captured since the last timer tick is processed, never the same one twice. Waiting
+                # up to half a tick for it keeps the timer and the camera from drifting in and out of phase
+                packet = self._device.read_next(timeout=self.interval / 2.e3)
+                if packet is None:
+                    if self._device.ret:
+                        return
+                    ret = False
+                else:
+                    ret = True
+                    frame = self.preprocess(packet.frame)
+                    frame_time = packet.timestamp
             if ret:
                 self.frame_no += 1
                 if self.state == State.ACQUIRING:
+                    self.frame_timestamp = frame_time
                     self.set_remaining_time()
-                    if self.save_raw_video and self.raw_out:
-                        self.raw_out.write(frame)
+                    overlay_no = self.write_raw_frame(frame)
                     if self.splash_screen_countdown == 0:
                         self.process_frame(frame)
-
-                    if self.out:
-                        self.out.write(frame)
-                    frame_time = time.time()
-                    inst_fps = 1. / (frame_time - self.last_frame_time)
+                    self.write_out_frame(frame, overlay_no)
+                    if self.last_frame_time:
+                        inst_fps = 1. / max(frame_time - self.last_frame_time, 1.e-6)
+                        self.current_fps = 0.95 * self.current_fps + 0.05 * inst_fps
                     self.last_frame_time = frame_time
-                    self.current_fps = 0.95 * self.current_fps + 0.05 * inst_fps
-
-                h, w, _ = frame.shape
-                frame_display = cv2.resize(frame, (int(w * self.scale), int(h * self.scale)),
-                                           interpolation=cv2.INTER_AREA)
+                    self.frame_timestamp = None
 
-                self.new_frame.emit(frame_display)
+                self.emit_display_frame(frame)
             else:
                 logger.info("Camera lost")
                 raise RuntimeError("Camera Lost")
@@ -732,6 +1097,9 @@ class CameraDeviceManager(DeviceManager):
     def get_cur_time(self):
         if self.analyzer.trial_state != self.analyzer.TrialState.ONGOING:
             return datetime.timedelta(0)
+        elif self.frame_timestamp is not None:
+            # the time of capture, however long the frame took to get to the analysis
+            return datetime.datetime.fromtimestamp(self.frame_timestamp) - self.start_time
         else:
             return datetime.datetime.now() - self.start_time
 
@@ -0,0 +1,83 @@
+import os
+import numpy as np
+import pandas as pd
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class CSVLogWriter:
+    """an append-only csv log, with the rows collected in preallocated column buffers and written out in chunks.
+
+    The first column is the index of the log (e.g. the wall time). The file has the same layout as a data frame
+    indexed by that column and saved with to_csv, but adding a row costs the same however long the log is, and
+    only the rows added since the last flush are ever written.
+    """
+
+    def __init__(self, filename, columns, buffer_size=1024):
+        self.filename = filename
+        self.columns = list(columns)
+        self.buffer_size = buffer_size
+        self._buffers = [np.empty(buffer_size, dtype=object) for _ in self.columns]
+        self._column_index = {c: i for i, c in enumerate(self.columns)}
+        self._n_rows = 0
+        self.open()
+
+    def open(self):
+        """starts a new file, or prepares to append to an existing one with the same columns.
+
+        An existing file with different columns is rewritten once with the current columns.
+        """
+        if os.path.exists(self.filename) and os.path.getsize(self.filename) > 0:
+            existing = pd.read_csv(self.filename, nrows=0)
+            if list(existing.columns) == self.columns:
+                logger.debug("Appending to file {}".format(self.filename))
+                return
+            logger.info("File {} has different columns, rewriting it".format(self.filename))
+            existing = pd.read_csv(self.filename)
+            existing.reindex(columns=self.columns).to_csv(self.filename, index=False)
+        else:
+            pd.DataFrame(columns=self.columns).to_csv(self.filename, index=False)
+
+    def append(self, row):
+        """adds a row, given as a sequence of values in the order of the columns"""
+        n = self._n_rows
+        for buffer, value in zip(self._buffers, row):
+            buffer[n] = value
+        self._n_rows += 1
+        if self._n_rows == self.buffer_size:
+            self.flush()
+
+    def append_dict(self, row):
+        """adds a row given as a dict, the missing columns are left empty"""
+        n = self._n_rows
+        for buffer in self._buffers:
+            buffer[n] = np.NaN
+        for key, value in row.items():
+            if key in self._column_index:
+                self._buffers[self._column_index[key]][n] = value
+        self._n_rows += 1
+        if self._n_rows == self.buffer_size:
+            self.flush()
+
+    def to_data_frame(self):
+        """the rows still in the buffers, as a data frame"""
+        n = self._n_rows
+        df = pd.DataFrame({c: b[:n] for c, b in zip(self.columns, self._buffers)}, columns=self.columns)
+        return df.infer_objects()
+
+    def flush(self):
+        if self._n_rows == 0:
+            return
+        self.to_data_frame().to_csv(self.filename, mode='a', header=False, index=False)
+        for buffer in self._buffers:
+            buffer[:self._n_rows] = None
+        self._n_rows = 0
+
+    def read(self):
+        """the whole log, from the file"""
+        self.flush()
+        return pd.read_csv(self.filename, index_col=self.columns[0])
+
+    def close(self):
+        self.flush()
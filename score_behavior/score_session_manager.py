@@ -8,6 +8,8 @@ import logging
 import glob
 
 from score_behavior.score_config import get_config_section
+from score_behavior.score_log_writer import CSVLogWriter
+from score_behavior.video_proxy import ProxyBuilder
 
 logger = logging.getLogger(__name__)
 
@@ -22,6 +24,9 @@ logger = logging.getLogger(__name__)
 
 class SessionManager:
     required_columns = ('condition', 'session', 'subject', 'trial',)
+    tracker_file_columns = ('wall_time', 'sequence_nr', 'frame', 'cur_time', 'id', 'centroid_x', 'centroid_y',
+                            'head_x', 'head_y', 'front_x', 'front_y', 'back_x', 'back_y', 'orientation',
+                            'load_tier', 'interpolated')
 
     def __init__(self, filename, initial_trial=1, extra_event_columns=None, extra_trial_columns=None,
                  min_free_disk_space=0, mode='live', r_keys=None):
@@ -30,8 +35,15 @@ class SessionManager:
         self.extra_event_columns = []
         self.extra_trial_columns = []
         self.log_file_per_trial = False
+        self.log_buffer_size = 1024
+        self.make_proxy_videos = False
+        self.proxy_scale = 0.5
 
         self.read_config()
+        # the proxies of the raw videos are made in the background, after each trial
+        self.proxy_builder = None
+        if self.make_proxy_videos:
+            self.proxy_builder = ProxyBuilder(self.proxy_scale)
 
         # Determine if there is enough space to continue
         import platform
@@ -87,6 +99,8 @@ This program will cowardly refuse to continue""".format(min_free_disk_space))
         self.event_log_file = None
         self.event_log_columns = None
         self.event_log = None
+        self.trial_events = []  # the events of the current trial, but its frame events
+        self.trial_log = None  # the per trial log of the current trial, frame events included
 
         self.tracker_file = None
         self.tracker_columns = None
@@ -140,6 +154,12 @@ This program will cowardly refuse to continue""".format(min_free_disk_space))
 
         if "log_file_per_trial" in config_dict:
             self.log_file_per_trial = config_dict["log_file_per_trial"]
+        if "log_buffer_size" in config_dict:
+            self.log_buffer_size = config_dict["log_buffer_size"]
+        if "make_proxy_videos" in config_dict:
+            self.make_proxy_videos = config_dict["make_proxy_videos"]
+        if "proxy_scale" in config_dict:
+            self.proxy_scale = config_dict["proxy_scale"]
 
     def get_task_specific_result_columns(self):
         return ()
@@ -187,10 +207,9 @@ This program will cowardly refuse to continue""".format(min_free_disk_space))
         if os.path.exists(self.event_log_file):
             logger.info("File exists, backing it up")
             shutil.copyfile(self.event_log_file, self.event_log_file + '.bk')
-            self.event_log = pd.read_csv(self.event_log_file, index_col='wall_time')
-        else:
-            self.event_log = pd.DataFrame(columns=self.event_log_columns)
-            self.event_log.set_index('wall_time', inplace=True)
+        # frame events are only kept for the current trial, the log file has the others
+        self.event_log = CSVLogWriter(self.event_log_file, self.event_log_columns, self.log_buffer_size)
+        self.trial_events = []
         logger.debug("File ready for writing")
 
     def open_tracker_file(self):
@@ -198,17 +217,12 @@ This program will cowardly refuse to continue""".format(min_free_disk_space))
         import shutil
 
         self.tracker_file = self.get_tracker_file_name()
-        self.tracker_columns = ['wall_time', 'sequence_nr', 'frame', 'cur_time', 'id', 'centroid_x', 'centroid_y',
-                                'head_x', 'head_y',
-                                'front_x', 'front_y', 'back_x', 'back_y']
+        self.tracker_columns = list(self.tracker_file_columns)
         logger.info("Attempting to open tracker file {}".format(self.tracker_file))
         if os.path.exists(self.tracker_file):
             logger.info("File exists, backing it up")
             shutil.copyfile(self.tracker_file, self.tracker_file + '.bk')
-            self.tracker_log = pd.read_csv(self.tracker_file, index_col='wall_time')
-        else:
-            self.tracker_log = pd.DataFrame(columns=self.tracker_columns)
-            self.tracker_log.set_index('wall_time', inplace=True)
+        self.tracker_log = CSVLogWriter(self.tracker_file, self.tracker_columns, self.log_buffer_size)
         logger.debug("File ready for writing.")
 
     def get_log_file_name(self):
@@ -221,6 +235,9 @@ This program will cowardly refuse to continue""".format(min_free_disk_space))
         filename = os.path.join(self.dirname, self.basename + '.track.csv')
         return filename
 
+    def get_background_cache_dir(self):
+        return os.path.join(self.dirname, self.basename + '.backgrounds')
+
     def get_scheme_trial_info(self):
         try:
             s = self.scheme.ix[self.cur_scheduled_run].copy()
@@ -259,12 +276,17 @@ This program will cowardly refuse to continue""".format(min_free_disk_space))
     def write_per_trial_log_file(self):
         prefix = self.file_name_prefix_for_trial
         filename = prefix + ".logt.csv"
-        events = self.get_events_for_trial()
-        events.to_csv(filename)
+        if self.trial_log is not None:
+            # the events were written as they came
+            self.trial_log.close()
+            self.trial_log = None
+        else:
+            events = self.get_events_for_trial()
+            events.to_csv(filename)
         logger.debug("saved log for trial in file " + filename)
 
     def get_log_with_no_frames(self):
-        return self.event_log[self.event_log['type'] != 'FR']
+        return self.event_log.read()
 
     def set_trial_finished(self, video_out_filename, video_out_raw_filename):
         if self.comments:
@@ -273,12 +295,13 @@ This program will cowardly refuse to continue""".format(min_free_disk_space))
         self.trials_results.loc[(self.cur_actual_run, 'video_out_raw_filename')] = \
             os.path.basename(video_out_raw_filename)
         self.trials_results.to_csv(self.result_file)
-        log_no_frames = self.get_log_with_no_frames()
-        log_no_frames.to_csv(self.event_log_file)
-        if self.tracker_log is not None:
-            self.tracker_log.to_csv(self.tracker_file)
+        self.event_log.flush()
+        self.tracker_log.flush()
         if self.log_file_per_trial:
             self.write_per_trial_log_file()
+        self.trial_events = []
+        if self.proxy_builder and os.path.exists(video_out_raw_filename):
+            self.proxy_builder.submit(video_out_raw_filename)
 
         logger.info("finalized trial {}".format(self.cur_actual_run))
         if not self.unscheduled_trial:
@@ -355,21 +378,37 @@ This program will cowardly refuse to continue""".format(min_free_disk_space))
         import time
         start_stop = bool(int(msg[-1]))
         msg = msg[:-1]
-        row = [ts, frame_no, self.cur_actual_run, self.cur_scheduled_run, msg, start_stop]
+        row = [time.time(), ts, frame_no, self.cur_actual_run, self.cur_scheduled_run, msg, start_stop]
         row.extend(extra_data)
         logger.debug("event row is " + str(row))
-        self.event_log.loc[time.time()] = row
+        if self.log_file_per_trial:
+            if self.trial_log is None:
+                self.trial_log = CSVLogWriter(self.file_name_prefix_for_trial + ".logt.csv", self.event_log_columns,
+                                              self.log_buffer_size)
+            self.trial_log.append(row)
+        # the frame events, one per frame, are not kept in memory, but for the first event of the trial
+        if msg != 'FR' or not self.trial_events:
+            self.trial_events.append(row)
+        if msg != 'FR':
+            self.event_log.append(row)
 
     def set_position_data(self, position_data):
         import time
         for px in position_data:
             px['sequence_nr'] = self.cur_actual_run
-            self.tracker_log.loc[time.time()] = px
+            px['wall_time'] = time.time()
+            self.tracker_log.append_dict(px)
 
     def get_events_for_trial(self, i=None):
         if i is None:
             i = self.cur_actual_run
-        lt = self.event_log.loc[self.event_log['sequence_nr'] == float(i)]
+        if i == self.cur_actual_run:
+            lt = pd.DataFrame(self.trial_events, columns=self.event_log_columns)
+            lt.set_index('wall_time', inplace=True)
+            return lt
+        # earlier trials are read back from the log file, without their frame events
+        event_log = self.event_log.read()
+        lt = event_log.loc[event_log['sequence_nr'] == float(i)]
         # if not lt.empty:
         #     assert lt.iloc[0]['type'] == 'TR'
         #     assert lt.iloc[-1]['type'] == 'TR'
@@ -406,9 +445,11 @@ This program will cowardly refuse to continue""".format(min_free_disk_space))
         self.redoing_trial = True
 
     def close(self):
-        log_no_frames = self.get_log_with_no_frames()
-        log_no_frames.to_csv(self.event_log_file)
-        if self.tracker_log:
-            self.tracker_log.to_csv(self.tracker_file)
+        if self.proxy_builder:
+            self.proxy_builder.close()
+        if self.trial_log is not None:
+            self.trial_log.close()
+        self.event_log.close()
+        self.tracker_log.close()
         self.trials_results.to_csv(self.result_file)
         logger.info("Closed csv files")
@@ -0,0 +1,316 @@
+# offline tracking of recorded sessions or videos, without the GUI and as fast as the frames can be decoded
+
+import argparse
+import datetime
+import glob
+import logging
+import os
+import time
+
+import numpy as np
+import pandas as pd
+import cv2
+
+from score_behavior.score_config import config_init, get_config_section
+from score_behavior.score_session_manager import SessionManager
+from score_behavior.tracking.tracker import Tracker
+
+logger = logging.getLogger(__name__)
+
+
+class VideoTrackingJob:
+    """tracks all the frames of a single video file"""
+
+    def __init__(self, video_file, sequence_nr=1):
+        self.video_file = video_file
+        self.sequence_nr = sequence_nr
+        self.background_frames = 25
+        self.postures_two_steps = False
+        self.read_config()
+        self.n_frames = 0
+        self.elapsed = 0.
+        self.progress_interval = 100
+
+    def read_config(self):
+        d = get_config_section("offline_tracker")
+        if "background_frames" in d:
+            self.background_frames = d["background_frames"]
+        if "postures_two_steps" in d:
+            self.postures_two_steps = bool(d["postures_two_steps"])
+
+    @staticmethod
+    def open_capture(video_file):
+        capture = cv2.VideoCapture(video_file)
+        if not capture.isOpened():
+            logger.error("Could not open video file {}".format(video_file))
+            raise RuntimeError("Could not open video file {}".format(video_file))
+        return capture
+
+    def compute_background(self, capture):
+        """the median of frames sampled evenly across the video, so that a moving animal is left out"""
+        n_total = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+        n_samples = max(min(self.background_frames, n_total), 1)
+        frames = []
+        for frame_no in np.linspace(0, max(n_total - 1, 0), n_samples).astype(int):
+            capture.set(cv2.CAP_PROP_POS_FRAMES, float(frame_no))
+            ret, frame = capture.read()
+            if ret:
+                frames.append(frame)
+        capture.set(cv2.CAP_PROP_POS_FRAMES, 0.)
+        if not frames:
+            raise RuntimeError("Could not read frames from video file {}".format(self.video_file))
+        return np.median(np.stack(frames, axis=3), axis=3).astype(np.uint8)
+
+    def run(self, progress_queue=None):
+        """tracks the whole video, returns the rows of the track file.
+
+        If a progress queue is given, (pid, video file, frame, number of frames) tuples are put in it as the
+        tracking goes on.
+        """
+        capture = self.open_capture(self.video_file)
+        fps = capture.get(cv2.CAP_PROP_FPS)
+        if not fps > 0:
+            fps = 30.
+        frame_size = (int(capture.get(cv2.CAP_PROP_FRAME_WIDTH)), int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+        logger.info("Tracking video {} of size {} at {} fps".format(self.video_file, frame_size, fps))
+
+        tracker = Tracker(frame_size)
+        tracker.postures_two_steps = self.postures_two_steps
+        tracker.show_model = False
+        tracker.show_posture = False
+        tracker.set_background(self.compute_background(capture))
+
+        n_total = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+        pid = os.getpid()
+        rows = []
+        frame_no = 0
+        t_start = time.perf_counter()
+        while True:
+            ret, frame = capture.read()
+            if not ret:
+                break
+            frame_no += 1
+            position_data = tracker.track(frame, frame_no)
+            if len(tracker.animals) < tracker.max_num_animals:
+                tracker.add_animal_auto()
+            if position_data:
+                cur_time = datetime.timedelta(milliseconds=1000 * frame_no / fps)
+                wall_time = time.time()
+                for px in position_data:
+                    px['wall_time'] = wall_time
+                    px['sequence_nr'] = self.sequence_nr
+                    px['frame'] = frame_no
+                    px['cur_time'] = cur_time
+                    rows.append(px)
+            if progress_queue is not None and frame_no % self.progress_interval == 0:
+                progress_queue.put((pid, self.video_file, frame_no, n_total))
+        if progress_queue is not None:
+            progress_queue.put((pid, self.video_file, frame_no, frame_no))
+        self.elapsed = time.perf_counter() - t_start
+        self.n_frames = frame_no
+        capture.release()
+        logger.info("Tracked {} frames of {} in {:.1f} s".format(self.n_frames, self.video_file, self.elapsed))
+        return rows
+
+
+def make_track_log(rows):
+    """a data frame with the layout of the track files written by the session manager"""
+    track_log = pd.DataFrame(rows, columns=SessionManager.tracker_file_columns)
+    track_log.set_index('wall_time', inplace=True)
+    return track_log
+
+
+class SessionVideos:
+    """the input videos of the trials of a session, found as in the video mode of the session manager.
+
+    The session manager itself is not used, as it opens (and backs up) the result and log files of the session.
+    """
+
+    def __init__(self, sheet_file):
+        if not sheet_file.endswith('.sheet.csv'):
+            raise ValueError("scheme filename should have the end in '.sheet.csv'. ")
+        self.sheet_file = sheet_file
+        self.dirname = os.path.dirname(sheet_file)
+        self.basename = os.path.basename(sheet_file)[:-len('.sheet.csv')]
+        self.video_in_source = None
+        self.video_in_glob = None
+        self.read_config()
+        self.scheme = pd.read_csv(sheet_file, index_col='run_nr')
+
+    def read_config(self):
+        d = get_config_section("data_manager")
+        if "video_in_source" in d:
+            self.video_in_source = d["video_in_source"]
+        if "video_in_glob" in d:
+            self.video_in_glob = d["video_in_glob"]
+
+    def get_runs(self):
+        """(sequence_nr, run_nr) of the trials as they have been run if there are results, else as scheduled"""
+        result_file = os.path.join(self.dirname, self.basename + '.results.csv')
+        if os.path.exists(result_file):
+            results = pd.read_csv(result_file, index_col='sequence_nr')
+            if 'run_nr' in results.columns and len(results) > 0:
+                return [(int(seq), int(r)) for seq, r in results['run_nr'].dropna().items()]
+        return [(i + 1, int(r)) for i, r in enumerate(pd.unique(self.scheme.index))]
+
+    def get_video_in_file_name_for_trial(self, trial_no):
+        if self.video_in_source != "glob":
+            raise ValueError("Unknown video in mode {}".format(self.video_in_source))
+        file_glob = os.path.join(self.dirname, self.video_in_glob.format(prefix=self.basename, trial=trial_no))
+        file_list = sorted(glob.glob(file_glob))
+        if len(file_list) > 0:
+            return file_list[-1]  # the most recent file for that trial, as in the session manager
+        return None
+
+    def get_tracker_file_name(self):
+        return os.path.join(self.dirname, self.basename + '.track.csv')
+
+
+def get_session_jobs(sheet_file):
+    """one tracking job per trial of a session, and the name of the track file of the session"""
+    session = SessionVideos(sheet_file)
+    jobs = []
+    for sequence_nr, run_nr in session.get_runs():
+        video_file = session.get_video_in_file_name_for_trial(run_nr)
+        if video_file is None:
+            logger.warning("Video for trial {} does not exist".format(run_nr))
+            continue
+        jobs.append(VideoTrackingJob(video_file, sequence_nr))
+    return jobs, session.get_tracker_file_name()
+
+
+def get_video_track_file_name(video_file):
+    basename, _ = os.path.splitext(video_file)
+    return basename + '.track.csv'
+
+
+def _init_worker(config_file):
+    # the configuration is a module global, which is not inherited by spawned processes
+    config_init(config_file)
+    # one process per trial already uses all the cores
+    cv2.setNumThreads(1)
+
+
+def _run_job(job, progress_queue=None):
+    rows = job.run(progress_queue)
+    return rows, job.n_frames, job.elapsed
+
+
+def print_job_report(video_file, n_frames, elapsed):
+    print("{}: {} frames, {:.1f} frames/s".format(video_file, n_frames, n_frames / max(elapsed, 1.e-9)))
+
+
+class ProgressDisplay:
+    """a single status line with the progress of each worker process"""
+
+    def __init__(self):
+        self.workers = {}
+
+    def update(self, pid, video_file, frame_no, n_total):
+        self.workers[pid] = (os.path.basename(video_file), frame_no, n_total)
+
+    def drain(self, queue):
+        updated = False
+        while not queue.empty():
+            self.update(*queue.get())
+            updated = True
+        if updated:
+            self.show()
+
+    def show(self):
+        status = []
+        for i, pid in enumerate(sorted(self.workers)):
+            name, frame_no, n_total = self.workers[pid]
+            if n_total > 0:
+                status.append("[{}] {} {:.0f}%".format(i + 1, name, 100. * frame_no / n_total))
+            else:
+                status.append("[{}] {} {}".format(i + 1, name, frame_no))
+        print('\r' + ' | '.join(status), end='', flush=True)
+
+
+def run_jobs(jobs, n_workers=1, config_file=None):
+    """tracks all the jobs, in a pool of n_workers processes if more than one.
+
+    Returns the rows, the number of frames and the tracking time of each job, in the order of the jobs, whatever
+    the order in which they were completed.
+    """
+    results = []
+    if n_workers <= 1:
+        for job in jobs:
+            rows, n_frames, elapsed = _run_job(job)
+            results.append((rows, n_frames, elapsed))
+            print_job_report(job.video_file, n_frames, elapsed)
+        return results
+
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor, wait
+
+    manager = multiprocessing.Manager()
+    progress_queue = manager.Queue()
+    display = ProgressDisplay()
+    with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker, initargs=(config_file,)) as executor:
+        futures = [executor.submit(_run_job, job, progress_queue) for job in jobs]
+        pending = set(futures)
+        while pending:
+            _, pending = wait(pending, timeout=0.5)
+            display.drain(progress_queue)
+        print()
+        for job, future in zip(jobs, futures):
+            rows, n_frames, elapsed = future.result()
+            results.append((rows, n_frames, elapsed))
+            print_job_report(job.video_file, n_frames, elapsed)
+    manager.shutdown()
+    return results
+
+
+def save_track_file(track_file, jobs, results):
+    """merges the rows of the jobs of one track file in sequence_nr order"""
+    order = sorted(range(len(jobs)), key=lambda i: jobs[i].sequence_nr)
+    rows = []
+    for i in order:
+        rows.extend(results[i][0])
+    make_track_log(rows).to_csv(track_file)
+    logger.info("Saved tracking data to {}".format(track_file))
+    print("Saved tracking data to {}".format(track_file))
+
+
+def _main():
+    logging.basicConfig(filename='score_track_log.log', level=logging.INFO, filemode='w',
+                        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description='Track recorded sessions or videos without the GUI.',
+                                     prog='score-track')
+    parser.add_argument('inputs', nargs='+', help="session .sheet.csv files, or video files")
+    parser.add_argument('--config', nargs=1, help="Read a default config file")
+    parser.add_argument('--jobs', type=int, default=1, help="number of videos to track in parallel processes")
+    args = parser.parse_args()
+    fname = None
+    if args.config:
+        fname = args.config[0]
+    config_init(fname)
+
+    track_files = []
+    jobs = []
+    for fn in args.inputs:
+        if fn.endswith('.sheet.csv'):
+            file_jobs, track_file = get_session_jobs(fn)
+        else:
+            file_jobs, track_file = [VideoTrackingJob(fn)], get_video_track_file_name(fn)
+        track_files.append((track_file, len(file_jobs)))
+        jobs.extend(file_jobs)
+
+    t_start = time.perf_counter()
+    results = run_jobs(jobs, args.jobs, fname)
+    elapsed = time.perf_counter() - t_start
+
+    first = 0
+    for track_file, n_jobs in track_files:
+        save_track_file(track_file, jobs[first:first + n_jobs], results[first:first + n_jobs])
+        first += n_jobs
+
+    n_frames = sum(r[1] for r in results)
+    if elapsed > 0:
+        print("Tracked {} frames in {:.1f} s, {:.1f} frames/s".format(n_frames, elapsed, n_frames / elapsed))
+
+
+if __name__ == '__main__':
+    _main()
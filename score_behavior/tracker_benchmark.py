@@ -0,0 +1,462 @@
+# benchmark of the posture search of the tracker on a synthetic video of a moving animal
+
+import argparse
+import math
+import time
+import logging
+
+import numpy as np
+import cv2
+
+import score_behavior.tracking.geometry as geometry
+from score_behavior.tracking.tracker import Animal, Tracker
+from score_behavior.tracking.time_budget import TimeBudget
+
+logger = logging.getLogger(__name__)
+
+
+def make_synthetic_frames(n_frames=300, width=320, height=240, seed=0, n_animals=1, return_positions=False,
+                          speed=2., return_heads=False):
+    """a noisy static background, with dark elongated blobs with a head wandering around, at speed pixels per frame.
+
+    With return_positions, the (n_frames, n_animals, 2) true positions of the animals are returned as well, and with
+    return_heads the true positions of their heads.
+    """
+    rng = np.random.RandomState(seed)
+    background = (rng.rand(height, width, 3) * 40 + 100).astype(np.uint8)
+    state = [[width * (k + 1) / (n_animals + 2.), height / 2. + 30 * (k % 2), k * 2.] for k in range(n_animals)]
+    frames = []
+    positions = np.zeros((n_frames, n_animals, 2))
+    heads = np.zeros((n_frames, n_animals, 2))
+    for i in range(n_frames):
+        frame = background.copy()
+        for k, (x, y, a) in enumerate(state):
+            a += 0.08 * math.sin(i / 15. + k)
+            x = min(max(x + speed * math.cos(a), 30), width - 30)
+            y = min(max(y + speed * math.sin(a), 30), height - 30)
+            state[k] = [x, y, a]
+            positions[i, k] = x, y
+            heads[i, k] = int(x + 18 * math.cos(a)), int(y + 18 * math.sin(a))
+            cv2.ellipse(frame, (int(x), int(y)), (16, 7), a * 180 / math.pi, 0, 360, (20, 20, 20), -1)
+            cv2.circle(frame, tuple(int(c) for c in heads[i, k]), 5, (30, 30, 30), -1)
+        frame = cv2.add(frame, (rng.rand(height, width, 3) * 6).astype(np.uint8))
+        frames.append(frame)
+    if return_positions and return_heads:
+        return background, frames, positions, heads
+    if return_positions:
+        return background, frames, positions
+    return background, frames
+
+
+def score_postures_loop(animal, matrix, postures):
+    """the reference implementation: draw and score one posture at a time"""
+    mask_size = 50
+    mask_half = mask_size / 2
+    mask = np.zeros((mask_size, mask_size), float)
+    hr = animal.scaled_head_radius
+    fr = animal.scaled_front_radius
+    br = animal.scaled_back_radius
+    vals = []
+    for p in postures:
+        mask.fill(-1)
+        mask_center = geometry.Point(mask_half, mask_half)
+        animal_center = animal.back
+        h = p.head - animal_center + mask_center
+        f = p.front - animal_center + mask_center
+        b = p.back - animal_center + mask_center
+        if not p.contracted:
+            quad = [geometry.point_along_a_perpendicular(f.x, f.y, h.x, h.y, h.x, h.y, hr),
+                    geometry.point_along_a_perpendicular(f.x, f.y, h.x, h.y, f.x, f.y, fr),
+                    geometry.point_along_a_perpendicular(f.x, f.y, h.x, h.y, f.x, f.y, -fr),
+                    geometry.point_along_a_perpendicular(f.x, f.y, h.x, h.y, h.x, h.y, -hr)]
+            cv2.fillConvexPoly(mask, np.array([list(q) for q in quad], 'int32'), 1)
+            quad = [geometry.point_along_a_perpendicular(f.x, f.y, b.x, b.y, b.x, b.y, br),
+                    geometry.point_along_a_perpendicular(f.x, f.y, b.x, b.y, f.x, f.y, fr),
+                    geometry.point_along_a_perpendicular(f.x, f.y, b.x, b.y, f.x, f.y, -fr),
+                    geometry.point_along_a_perpendicular(f.x, f.y, b.x, b.y, b.x, b.y, -br)]
+            cv2.fillConvexPoly(mask, np.array([list(q) for q in quad], 'int32'), 1)
+        else:
+            quad = [geometry.point_along_a_perpendicular(b.x, b.y, h.x, h.y, h.x, h.y, hr),
+                    geometry.point_along_a_perpendicular(b.x, b.y, h.x, h.y, b.x, b.y, br),
+                    geometry.point_along_a_perpendicular(b.x, b.y, h.x, h.y, b.x, b.y, -br),
+                    geometry.point_along_a_perpendicular(b.x, b.y, h.x, h.y, h.x, h.y, -hr)]
+            cv2.fillConvexPoly(mask, np.array([list(q) for q in quad], 'int32'), 1)
+        cv2.circle(mask, h.as_int_tuple(), hr, 1, -1)
+        cv2.circle(mask, f.as_int_tuple(), fr, 1, -1)
+        cv2.circle(mask, b.as_int_tuple(), br, 1, -1)
+
+        ac = animal_center
+        mh = int(mask_half)
+        matrix_slice = matrix[max((int(ac.y) - mh), 0): int(ac.y) + mh, max(int(ac.x) - mh, 0):int(ac.x) + mh]
+        mask_start_r = -(int(ac.y) - mh) if int(ac.y) - mh < 0 else 0
+        mask_start_c = -(int(ac.x) - mh) if int(ac.x) - mh < 0 else 0
+        mask_end_r = mask.shape[0] - max(int(ac.y) + mh - matrix.shape[0], 0)
+        mask_end_c = mask.shape[1] - max(int(ac.x) + mh - matrix.shape[1], 0)
+        mask_slice = mask[mask_start_r:mask_end_r, mask_start_c:mask_end_c]
+        vals.append(np.multiply(mask_slice, matrix_slice).sum())
+    return np.array(vals)
+
+
+class ScoringBenchmark:
+    """times the reference and the batched posture scoring on the same candidates, before each tracked frame"""
+
+    def __init__(self, tracker):
+        self.tracker = tracker
+        self.loop_times = []
+        self.batch_times = []
+        self.n_candidates = []
+        self.mismatches = 0
+
+    def measure(self, matrix):
+        for a in self.tracker.animals:
+            candidates, contracted = a.generate_posture_array()
+            postures = a.generate_postures()
+            m = matrix.astype(float) - 100.
+            t0 = time.perf_counter()
+            ref = score_postures_loop(a, m, postures)
+            t1 = time.perf_counter()
+            vals = self.tracker.posture_scorer.score(m, a.back, candidates, contracted)
+            t2 = time.perf_counter()
+            if not np.array_equal(ref, vals):
+                self.mismatches += 1
+            self.loop_times.append(t1 - t0)
+            self.batch_times.append(t2 - t1)
+            self.n_candidates.append(len(postures))
+
+    def report(self):
+        loop_ms = 1.e3 * np.mean(self.loop_times)
+        batch_ms = 1.e3 * np.mean(self.batch_times)
+        print("frames: {}, candidates per frame: {:.0f}".format(len(self.loop_times), np.mean(self.n_candidates)))
+        print("per-posture loop: {:.2f} ms/frame".format(loop_ms))
+        print("batched scoring:  {:.2f} ms/frame".format(batch_ms))
+        print("speedup: {:.1f}x, frames with differing scores: {}".format(loop_ms / batch_ms, self.mismatches))
+
+
+def run_benchmark(n_frames=300, two_steps=False):
+    background, frames = make_synthetic_frames(n_frames)
+    height, width = background.shape[:2]
+    tracker = Tracker((width, height))
+    tracker.postures_two_steps = two_steps
+    tracker.set_background(background)
+    benchmark = ScoringBenchmark(tracker)
+
+    original_track_animals = tracker.track_animals
+
+    def track_animals(matrix, frame_time):
+        benchmark.measure(matrix)
+        return original_track_animals(matrix, frame_time)
+
+    tracker.track_animals = track_animals
+    for i, frame in enumerate(frames):
+        tracker.track(frame, i)
+        if not tracker.animals:
+            tracker.add_animal_auto()
+    benchmark.report()
+
+
+class SearchBenchmark:
+    """runs the exhaustive and the coarse to fine posture searches from the same animal state, before each frame"""
+
+    def __init__(self, tracker):
+        self.tracker = tracker
+        self.times = {'exhaustive': [], 'coarse_to_fine': []}
+        self.evaluations = {'exhaustive': [], 'coarse_to_fine': []}
+        self.best = {'exhaustive': [], 'coarse_to_fine': []}
+        self.head_distances = []
+
+    def measure(self, matrix):
+        heads = {}
+        for mode in ('exhaustive', 'coarse_to_fine'):
+            t0 = time.perf_counter()
+            postures, _, vals = self.tracker.search_postures(matrix, mode)
+            self.times[mode].append(time.perf_counter() - t0)
+            self.evaluations[mode].append(sum(len(p) for p in postures))
+            best = [int(np.argmax(v)) for v in vals]
+            self.best[mode].extend(v[b] for v, b in zip(vals, best))
+            heads[mode] = np.array([p[b, Animal.HEAD] for p, b in zip(postures, best)])
+        self.head_distances.extend(np.sqrt(np.sum((heads['exhaustive'] - heads['coarse_to_fine']) ** 2, axis=1)))
+
+    def report(self):
+        exhaustive = np.array(self.best['exhaustive'])
+        coarse = np.array(self.best['coarse_to_fine'])
+        print("frames: {}".format(len(self.times['exhaustive'])))
+        for mode in ('exhaustive', 'coarse_to_fine'):
+            print("{:15s} {:6.0f} evaluations/frame, {:.2f} ms/frame".format(
+                mode + ':', np.mean(self.evaluations[mode]), 1.e3 * np.mean(self.times[mode])))
+        print("coarse to fine best score: same or better on {:.1f}% of the frames, mean ratio to exhaustive "
+              "{:.3f}".format(100. * np.mean(coarse >= exhaustive), np.mean(coarse / np.maximum(exhaustive, 1.))))
+        print("distance between the best heads: mean {:.2f} px, max {:.2f} px".format(
+            np.mean(self.head_distances), np.max(self.head_distances)))
+
+
+def run_search_benchmark(n_frames=300, two_steps=False):
+    """evaluations per frame and best scores of the coarse to fine posture search, against the exhaustive one"""
+    background, frames = make_synthetic_frames(n_frames)
+    height, width = background.shape[:2]
+    tracker = Tracker((width, height))
+    tracker.postures_two_steps = two_steps
+    tracker.set_background(background)
+    benchmark = SearchBenchmark(tracker)
+
+    original_track_animals = tracker.track_animals
+
+    def track_animals(matrix, frame_time):
+        if tracker.animals:
+            benchmark.measure(matrix)
+        return original_track_animals(matrix, frame_time)
+
+    tracker.track_animals = track_animals
+    for i, frame in enumerate(frames):
+        tracker.track(frame, i)
+        if not tracker.animals:
+            tracker.add_animal_auto()
+    benchmark.report()
+
+
+def run_motion_benchmark(n_frames=300, speeds=(2., 4., 6.)):
+    """evaluations per frame and head error of the tracking with and without the motion model, at several speeds"""
+    for speed in speeds:
+        background, frames, _, heads = make_synthetic_frames(n_frames, speed=speed, return_positions=True,
+                                                             return_heads=True)
+        height, width = background.shape[:2]
+        for motion_model in ('none', 'kalman'):
+            tracker = Tracker((width, height))
+            tracker.motion_model = motion_model
+            tracker.show_model = False
+            tracker.show_posture = False
+            tracker.set_background(background)
+            errors = []
+            confidences = []
+            elapsed = 0.
+            n_timed = 0
+            evaluations = 0
+            for i, frame in enumerate(frames):
+                frame = frame.copy()  # the tracker draws on the frames, which are tracked again by the other runs
+                evaluations_before = tracker.posture_evaluations
+                t0 = time.perf_counter()
+                position_data = tracker.track(frame, i)
+                t1 = time.perf_counter()
+                if not tracker.animals:
+                    tracker.add_animal_auto()
+                elif position_data:
+                    elapsed += t1 - t0
+                    n_timed += 1
+                    evaluations += tracker.posture_evaluations - evaluations_before
+                    position = tracker.animals[0].get_position()
+                    errors.append(math.hypot(position.head[0] - heads[i, 0, 0], position.head[1] - heads[i, 0, 1]))
+                    confidences.append(position.confidence)
+            print("speed {:.0f} px/frame, motion model {:6s}: {:5.1f} evaluations/frame, {:.2f} ms/frame, head error "
+                  "mean {:.2f} px, max {:.2f} px, min confidence {:.2f}".format(
+                    speed, motion_model, evaluations / max(n_timed, 1), 1.e3 * elapsed / max(n_timed, 1),
+                    np.mean(errors), np.max(errors), np.min(confidences)))
+
+
+def run_multi_animal_benchmark(n_frames=300, max_animals=4):
+    """time per frame and identity swaps, tracking from 1 to max_animals animals.
+
+    An identity swap is counted when the true animal closest to a tracked one changes.
+    """
+    times = {}
+    for n_animals in range(1, max_animals + 1):
+        background, frames, positions = make_synthetic_frames(n_frames, n_animals=n_animals, return_positions=True)
+        height, width = background.shape[:2]
+        tracker = Tracker((width, height))
+        tracker.max_num_animals = n_animals
+        tracker.show_model = False
+        tracker.show_posture = False
+        tracker.set_background(background)
+        identities = None
+        swaps = 0
+        elapsed = 0.
+        n_timed = 0
+        for i, frame in enumerate(frames):
+            t0 = time.perf_counter()
+            position_data = tracker.track(frame, i)
+            t1 = time.perf_counter()
+            if len(tracker.animals) < n_animals:
+                tracker.add_animal_auto()
+            if not position_data or len(position_data) < n_animals:
+                continue
+            elapsed += t1 - t0
+            n_timed += 1
+            if len(tracker.centroids) < n_animals:
+                continue  # animals touching each other, the identities are checked again once they separate
+            centroids = np.array([(p['centroid_x'], p['centroid_y']) for p in position_data])
+            # the true animal closest to each tracked one
+            closest = np.argmin(np.sum((centroids[:, np.newaxis] - positions[i][np.newaxis]) ** 2, axis=2), axis=1)
+            if identities is not None:
+                swaps += int(np.sum(closest != identities))
+            identities = closest
+        times[n_animals] = 1.e3 * elapsed / max(n_timed, 1)
+        print("{} animals: {:.2f} ms/frame ({:.2f} ms/frame per animal), {} identity changes".format(
+            n_animals, times[n_animals], times[n_animals] / n_animals, swaps))
+    return times
+
+
+def track_video(frames, background, n_animals=1, roi_mode=False):
+    """tracks the frames, returns the time per frame and the (n_frames, n_animals, 2) tracked back positions"""
+    height, width = background.shape[:2]
+    tracker = Tracker((width, height))
+    tracker.max_num_animals = n_animals
+    tracker.roi_mode = roi_mode
+    tracker.show_model = False
+    tracker.show_posture = False
+    tracker.set_background(background)
+    backs = np.full((len(frames), n_animals, 2), np.nan)
+    elapsed = 0.
+    n_timed = 0
+    for i, frame in enumerate(frames):
+        frame = frame.copy()  # the tracker draws on the frames, which are tracked again by the other runs
+        t0 = time.perf_counter()
+        position_data = tracker.track(frame, i)
+        t1 = time.perf_counter()
+        if len(tracker.animals) < n_animals:
+            tracker.add_animal_auto()
+        elif position_data:
+            elapsed += t1 - t0
+            n_timed += 1
+            for p in position_data:
+                backs[i, p['id']] = p['back_x'], p['back_y']
+    return 1.e3 * elapsed / max(n_timed, 1), backs, tracker
+
+
+def run_roi_benchmark(n_frames=300, width=1280, height=960, n_animals=1):
+    """time per frame of the full frame and of the ROI foreground extraction, and how far apart their tracks are"""
+    background, frames = make_synthetic_frames(n_frames, width, height, n_animals=n_animals)
+    full_ms, full_backs, _ = track_video(frames, background, n_animals)
+    roi_ms, roi_backs, tracker = track_video(frames, background, n_animals, roi_mode=True)
+    distance = np.sqrt(np.sum((full_backs - roi_backs) ** 2, axis=2))
+    print("frames: {} of {}x{}, {} animals".format(n_frames, width, height, n_animals))
+    print("full frame search: {:.2f} ms/frame".format(full_ms))
+    print("ROI search:        {:.2f} ms/frame ({} ROI, {} full frame searches)".format(
+        roi_ms, tracker.roi_searches, tracker.full_frame_searches))
+    print("speedup: {:.1f}x, distance between the tracks: mean {:.2f} px, max {:.2f} px".format(
+        full_ms / roi_ms, np.nanmean(distance), np.nanmax(distance)))
+
+
+def run_tier_benchmark(n_frames=300, width=640, height=480):
+    """time per frame of the posture and the centroid tracking tiers, the latter with and without a posture zone,
+    and how close the centroids and orientations are to the true positions and headings"""
+    background, frames, positions, heads = make_synthetic_frames(n_frames, width, height, return_positions=True,
+                                                                 return_heads=True)
+    # the heading of the animals, as an axis (modulo 180 degrees)
+    headings = np.degrees(np.arctan2(heads[:, 0, 1] - positions[:, 0, 1], heads[:, 0, 0] - positions[:, 0, 0]))
+    zone = (width / 2., height / 2., min(width, height) / 4.)
+    for name, tier, zones in (('posture', 'posture', []), ('centroid', 'centroid', []),
+                              ('centroid with a zone', 'centroid', [zone])):
+        tracker = Tracker((width, height))
+        tracker.tracking_tier = tier
+        tracker.set_posture_zones(zones)
+        tracker.set_background(background)
+        elapsed = 0.
+        n_timed = 0
+        n_postures = 0
+        distances = []
+        angle_errors = []
+        for i, frame in enumerate(frames):
+            frame = frame.copy()
+            t0 = time.perf_counter()
+            position_data = tracker.track(frame, i)
+            t1 = time.perf_counter()
+            if not tracker.animals:
+                tracker.add_animal_auto()
+                continue
+            elapsed += t1 - t0
+            n_timed += 1
+            p = position_data[0]
+            n_postures += int(tracker.animals[0].has_posture)
+            distances.append(math.hypot(p['centroid_x'] - positions[i, 0, 0], p['centroid_y'] - positions[i, 0, 1]))
+            if 'orientation' in p:
+                d = (p['orientation'] - headings[i]) % 180.
+                angle_errors.append(min(d, 180. - d))
+        line = "{:<21} {:.2f} ms/frame, posture in {:.0%} of the frames, centroid error {:.2f} px".format(
+            name + ':', 1.e3 * elapsed / max(n_timed, 1), n_postures / max(n_timed, 1), np.mean(distances))
+        if angle_errors:
+            line += ", orientation error mean {:.1f} max {:.1f} deg".format(np.mean(angle_errors), np.max(angle_errors))
+        print(line)
+
+
+def run_time_budget_benchmark(n_frames=600, width=1280, height=960, budget_ms=10., extra_ms=15.):
+    """the load tiers the tracker goes through with a time budget, when the machine is busy for the middle third of
+    the frames (extra_ms of work added to each tracked frame), and how far the tracked centroids are from the truth"""
+    background, frames, positions = make_synthetic_frames(n_frames, width, height, return_positions=True)
+    tracker = Tracker((width, height))
+    tracker.time_budget = TimeBudget(budget_ms * 1.e-3)
+    tracker.set_background(background)
+    original_track_frame = tracker.track_frame
+    busy = range(n_frames // 3, 2 * n_frames // 3)
+
+    def track_frame(frame, frame_time=0):
+        if frame_time in busy:
+            time.sleep(extra_ms * 1.e-3)
+        return original_track_frame(frame, frame_time)
+
+    tracker.track_frame = track_frame
+    tiers = np.zeros(n_frames, int)
+    errors = np.full(n_frames, np.nan)
+    interpolated = np.zeros(n_frames, bool)
+    elapsed = np.zeros(n_frames)
+    for i, frame in enumerate(frames):
+        frame = frame.copy()
+        t0 = time.perf_counter()
+        position_data = tracker.track(frame, i)
+        elapsed[i] = time.perf_counter() - t0
+        if not tracker.animals:
+            tracker.add_animal_auto()
+        if not position_data:
+            continue
+        p = position_data[0]
+        tiers[i] = p['load_tier']
+        interpolated[i] = p['interpolated']
+        errors[i] = math.hypot(p['centroid_x'] - positions[i, 0, 0], p['centroid_y'] - positions[i, 0, 1])
+    print("frames: {} of {}x{}, budget {:.1f} ms/frame, {:.1f} ms/frame more in frames {} to {}".format(
+        n_frames, width, height, budget_ms, extra_ms, busy.start, busy.stop))
+    for name, part in (('before', slice(0, busy.start)), ('busy', slice(busy.start, busy.stop)),
+                       ('after', slice(busy.stop, n_frames))):
+        counts = np.bincount(tiers[part], minlength=TimeBudget.SKIP_FRAMES + 1)
+        print("{:<6} {:.2f} ms/frame, frames per tier {}, {} predicted, centroid error {:.2f} px".format(
+            name + ':', 1.e3 * np.mean(elapsed[part]), ' '.join(str(c) for c in counts),
+            int(np.sum(interpolated[part])), np.nanmean(errors[part])))
+    if np.any(interpolated):
+        print("centroid error on the predicted frames: mean {:.2f} px, max {:.2f} px".format(
+            np.nanmean(errors[interpolated]), np.nanmax(errors[interpolated])))
+
+
+def _main():
+    parser = argparse.ArgumentParser(description='Benchmark the posture scoring of the tracker',
+                                     prog='tracker_benchmark')
+    parser.add_argument('--frames', type=int, default=300, help="number of synthetic frames to track")
+    parser.add_argument('--two-steps', action='store_true', help="expand rotations on all the moved postures")
+    parser.add_argument('--animals', type=int, default=0,
+                        help="time the tracking of 1 up to this number of animals, instead of the scoring")
+    parser.add_argument('--search', action='store_true',
+                        help="compare the coarse to fine and the exhaustive posture searches")
+    parser.add_argument('--motion', action='store_true',
+                        help="compare the tracking with and without the motion model, at several speeds")
+    parser.add_argument('--budget', type=float, default=0., metavar='MS',
+                        help="track large frames with this time budget per frame, and a busy period in the middle")
+    parser.add_argument('--tiers', action='store_true',
+                        help="compare the posture and the centroid tracking tiers")
+    parser.add_argument('--roi', action='store_true',
+                        help="compare the full frame and the ROI foreground extraction on large frames")
+    parser.add_argument('--size', type=int, nargs=2, default=(1280, 960), metavar=('WIDTH', 'HEIGHT'),
+                        help="frame size for the ROI and time budget comparisons")
+    args = parser.parse_args()
+    if args.budget:
+        run_time_budget_benchmark(args.frames, args.size[0], args.size[1], args.budget)
+    elif args.tiers:
+        run_tier_benchmark(args.frames)
+    elif args.roi:
+        run_roi_benchmark(args.frames, args.size[0], args.size[1], max(args.animals, 1))
+    elif args.motion:
+        run_motion_benchmark(args.frames)
+    elif args.search:
+        run_search_benchmark(args.frames, args.two_steps)
+    elif args.animals:
+        run_multi_animal_benchmark(args.frames, args.animals)
+    else:
+        run_benchmark(args.frames, args.two_steps)
+
+
+if __name__ == '__main__':
+    _main()
@@ -0,0 +1,85 @@
+import numpy as np
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def centroid_cost(predicted, centroids):
+    """the (K, M) matrix of the squared distances between K predicted animal positions and M component centroids"""
+    predicted = np.asarray(predicted, dtype=float).reshape((-1, 2))
+    centroids = np.asarray(centroids, dtype=float).reshape((-1, 2))
+    diff = predicted[:, np.newaxis, :] - centroids[np.newaxis, :, :]
+    return np.sum(diff * diff, axis=2)
+
+
+def linear_assignment(cost):
+    """the optimal assignment of the rows of a cost matrix to its columns, with the Hungarian algorithm.
+
+    Each row is assigned to at most one column and vice versa, so that min(rows, columns) pairs are made with the
+    minimum total cost. Returns the indices of the assigned rows, in increasing order, and of their columns.
+    The inner loops run over whole rows, so the cost is O(n^2 m) numpy operations on vectors of length m.
+    """
+    cost = np.asarray(cost, dtype=float)
+    if cost.ndim != 2:
+        raise ValueError("the cost matrix must be 2-dimensional")
+    transposed = cost.shape[0] > cost.shape[1]
+    if transposed:
+        cost = cost.T
+    n, m = cost.shape
+    if n == 0:
+        return np.zeros(0, np.int64), np.zeros(0, np.int64)
+
+    # potentials of the rows and the columns, the row assigned to each column and the augmenting paths, all 1-based
+    # with the column 0 standing for the row being added
+    u = np.zeros(n + 1)
+    v = np.zeros(m + 1)
+    p = np.zeros(m + 1, np.int64)
+    way = np.zeros(m + 1, np.int64)
+    for i in range(1, n + 1):
+        p[0] = i
+        j0 = 0
+        min_v = np.full(m + 1, np.inf)
+        used = np.zeros(m + 1, bool)
+        while True:
+            used[j0] = True
+            i0 = p[j0]
+            free = ~used[1:]
+            reduced = cost[i0 - 1] - u[i0] - v[1:]
+            better = free & (reduced < min_v[1:])
+            min_v[1:][better] = reduced[better]
+            way[1:][better] = j0
+            candidates = np.where(free, min_v[1:], np.inf)
+            j1 = int(np.argmin(candidates)) + 1
+            delta = candidates[j1 - 1]
+            used_columns = np.nonzero(used)[0]
+            u[p[used_columns]] += delta
+            v[used_columns] -= delta
+            min_v[1:][free] -= delta
+            j0 = j1
+            if p[j0] == 0:
+                break
+        while j0:
+            j1 = way[j0]
+            p[j0] = p[j1]
+            j0 = j1
+
+    cols = np.nonzero(p[1:])[0]
+    rows = p[1:][cols] - 1
+    if transposed:
+        rows, cols = cols, rows
+    order = np.argsort(rows)
+    return rows[order], cols[order]
+
+
+def assign_identities(predicted, centroids):
+    """the index of the component centroid for each animal.
+
+    Animals and components are matched one to one, minimizing the total squared distance between the predicted
+    animal positions and the centroids. When there are fewer components than animals (e.g. two animals touching and
+    merging into one component) the animals left over take their closest component.
+    """
+    cost = centroid_cost(predicted, centroids)
+    assigned = np.argmin(cost, axis=1)
+    rows, cols = linear_assignment(cost)
+    assigned[rows] = cols
+    return assigned
@@ -0,0 +1,114 @@
+import numpy as np
+import cv2
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def median_frame(frames):
+    """the per-pixel median of a (H, W, 3, N) uint8 stack of frames, without going through float64.
+
+    For an even number of frames, the upper of the two middle values is taken.
+    """
+    k = frames.shape[-1] // 2
+    return np.partition(frames, k, axis=-1)[..., k]
+
+
+class BackgroundModel:
+    """a static background, set once.
+
+    The background frame is updated in place by the adaptive models, so that references to it stay valid. due is
+    called on every frame, and tells when an update is due, once every update_interval frames. update takes the
+    current frame and a mask which is non-zero on the animals, to be left out of the update.
+    """
+
+    adaptive = False
+
+    def __init__(self, update_interval=10):
+        self.background = None
+        self.update_interval = max(int(update_interval), 1)
+        self._countdown = self.update_interval
+        self.updates = 0
+
+    def reset(self, frame):
+        self.background = np.array(frame, dtype=np.uint8)
+        self._countdown = self.update_interval
+
+    def due(self):
+        if not self.adaptive or self.background is None:
+            return False
+        self._countdown -= 1
+        if self._countdown > 0:
+            return False
+        self._countdown = self.update_interval
+        return True
+
+    def update(self, frame, animal_mask=None):
+        if animal_mask is None:
+            outside = None
+        else:
+            outside = cv2.compare(animal_mask, 0, cv2.CMP_EQ)
+        self.update_outside(frame, outside)
+        self.updates += 1
+
+    def update_outside(self, frame, outside):
+        """updates the background where outside is non-zero (everywhere if it's None)"""
+        pass
+
+
+class RunningAverageBackground(BackgroundModel):
+    """an exponential running average of the frames, with weight alpha for each update.
+
+    The average is kept in a float32 frame, the background is the average rounded to uint8.
+    """
+
+    adaptive = True
+
+    def __init__(self, update_interval=10, alpha=0.02):
+        super(RunningAverageBackground, self).__init__(update_interval)
+        self.alpha = alpha
+        self._average = None
+
+    def reset(self, frame):
+        super(RunningAverageBackground, self).reset(frame)
+        self._average = self.background.astype(np.float32)
+
+    def update_outside(self, frame, outside):
+        cv2.accumulateWeighted(frame, self._average, self.alpha, mask=outside)
+        cv2.convertScaleAbs(self._average, dst=self.background)
+
+
+class StreamingMedianBackground(BackgroundModel):
+    """an approximate running median, kept in the uint8 background frame itself.
+
+    At each update, every background pixel moves by step towards the value in the frame, so that it settles where
+    as many frames are above it as below it.
+    """
+
+    adaptive = True
+
+    def __init__(self, update_interval=10, step=1):
+        super(StreamingMedianBackground, self).__init__(update_interval)
+        self.step = step
+
+    def update_outside(self, frame, outside):
+        step = (self.step, self.step, self.step, 0)
+        higher = cv2.min(cv2.compare(frame, self.background, cv2.CMP_GT), step)
+        lower = cv2.min(cv2.compare(frame, self.background, cv2.CMP_LT), step)
+        cv2.add(self.background, higher, dst=self.background, mask=outside)
+        cv2.subtract(self.background, lower, dst=self.background, mask=outside)
+
+
+background_models = {'static': BackgroundModel,
+                     'running_average': RunningAverageBackground,
+                     'streaming_median': StreamingMedianBackground}
+
+
+def make_background_model(name, update_interval=10, alpha=0.02, step=1):
+    if name not in background_models:
+        raise ValueError("Unknown background model {}".format(name))
+    if name == 'running_average':
+        return RunningAverageBackground(update_interval, alpha)
+    if name == 'streaming_median':
+        return StreamingMedianBackground(update_interval, step)
+    return BackgroundModel(update_interval)
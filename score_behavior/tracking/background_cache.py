@@ -0,0 +1,76 @@
+import os
+import re
+import logging
+
+import numpy as np
+import cv2
+
+logger = logging.getLogger(__name__)
+
+
+def background_change(background, frame, threshold=25, scale=0.25):
+    """the fraction of the frame that differs from the background by more than threshold in some channel.
+
+    Both are compared at a reduced scale, which is enough to tell a moved camera or changed lighting from an animal
+    in the arena, which only covers a small fraction of the frame.
+    """
+    if background.ndim == 2 and frame.ndim == 3:
+        frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    h, w = background.shape[:2]
+    size = (max(int(w * scale), 1), max(int(h * scale), 1))
+    small_background = cv2.resize(background, size, interpolation=cv2.INTER_AREA)
+    small_frame = cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+    diff = cv2.absdiff(small_background, small_frame)
+    if diff.ndim == 3:
+        diff = diff.max(axis=2)
+    return np.count_nonzero(diff > threshold) / float(diff.size)
+
+
+class BackgroundCache:
+    """backgrounds saved as lossless png images in a directory, one per camera setting and resolution.
+
+    The key is made of a source, which stands for the camera and the arena, the rotation and mirror settings and
+    the frame size. Grayscale backgrounds have their own keys.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    @staticmethod
+    def make_key(source, rotate_angle, mirrored, frame_shape):
+        h, w = frame_shape[:2]
+        source = re.sub(r'[^A-Za-z0-9_.-]+', '_', str(source))
+        key = "{}_rot{}_mirror{}_{}x{}".format(source, int(rotate_angle), int(bool(mirrored)), w, h)
+        if len(frame_shape) == 2:
+            key += '_gray'
+        return key
+
+    def file_name(self, key):
+        return os.path.join(self.directory, 'background_' + key + '.png')
+
+    def load(self, key, frame_shape=None):
+        """the background saved under key, or None if there is none or it does not have the frame shape"""
+        filename = self.file_name(key)
+        if not os.path.exists(filename):
+            return None
+        background = cv2.imread(filename, cv2.IMREAD_UNCHANGED)
+        if background is None:
+            logger.warning("could not read cached background {}".format(filename))
+            return None
+        if frame_shape is not None and background.shape != tuple(frame_shape):
+            logger.warning("cached background {} has shape {} instead of {}".format(filename, background.shape,
+                                                                                      tuple(frame_shape)))
+            return None
+        logger.info("loaded cached background {}".format(filename))
+        return background
+
+    def save(self, key, background):
+        os.makedirs(self.directory, exist_ok=True)
+        filename = self.file_name(key)
+        # written to a temporary file first, so that a crash never leaves a truncated background behind
+        tmp_filename = filename + '.tmp.png'
+        if not cv2.imwrite(tmp_filename, np.asarray(background, dtype=np.uint8)):
+            logger.error("could not write background to {}".format(filename))
+            return
+        os.replace(tmp_filename, filename)
+        logger.debug("saved background {}".format(filename))
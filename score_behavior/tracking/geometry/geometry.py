@@ -86,6 +86,35 @@ def point_along_a_line_p(p1, p2, distance):
     return Point(x, y)
 
 
+def _square_v(x):
+    """squares as computed by x**2 on floats in the scalar functions, that is through pow rather than x * x, so
+    that the vectorized functions return the very same values"""
+    return np.power(x, 2.)
+
+
+# noinspection PyShadowingNames
+def point_along_a_line_v(start, end, distance):
+    """vectorized point_along_a_line, on (N, 2) arrays of points, with the same edge cases"""
+    start = np.asarray(start, dtype=float)
+    end = np.asarray(end, dtype=float)
+    distance = np.asarray(distance, dtype=float)
+    dx = end[:, 0] - start[:, 0]
+    dy = end[:, 1] - start[:, 1]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        k = dy / dx
+        point_dx = np.sqrt(_square_v(distance) / (1 + _square_v(k)))
+        point_dx = np.where(dx < 0, -point_dx, point_dx)
+        point_dy = point_dx * k
+    point_dx = np.where(distance < 0, -point_dx, point_dx)
+    point_dy = np.where(distance < 0, -point_dy, point_dy)
+
+    vertical = dx == 0
+    x = np.where(vertical, start[:, 0], start[:, 0] + point_dx)
+    y = np.where(vertical, np.where(dy < 0, start[:, 1] - distance, start[:, 1] + distance), start[:, 1] + point_dy)
+    return np.stack((x, y), axis=-1)
+
+
 # noinspection PyShadowingNames
 def point_along_a_perpendicular(start_x, start_y, end_x, end_y, p_start_x, p_start_y, distance):
     dx = end_x - start_x
@@ -116,6 +145,31 @@ def point_along_a_perpendicular_p(s, e, p, distance):
     return point_along_a_perpendicular(s.x, s.y, e.x, e.y, p.x, p.y, distance)
 
 
+# noinspection PyShadowingNames
+def point_along_a_perpendicular_v(start, end, p_start, distance):
+    """vectorized point_along_a_perpendicular, on (N, 2) arrays of points, with the same edge cases"""
+    start = np.asarray(start, dtype=float)
+    end = np.asarray(end, dtype=float)
+    p_start = np.asarray(p_start, dtype=float)
+    distance = np.asarray(distance, dtype=float)
+    dx = end[:, 0] - start[:, 0]
+    dy = end[:, 1] - start[:, 1]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        k = dy / dx
+        point_dx = np.sqrt(_square_v(distance) / (1 + _square_v(k)))
+        point_dx = np.where(dx < 0, -point_dx, point_dx)
+        point_dy = point_dx * k
+    point_dx = np.where(distance < 0, -point_dx, point_dx)
+    point_dy = np.where(distance < 0, -point_dy, point_dy)
+
+    vertical = dx == 0
+    x = np.where(vertical, np.where(dy < 0, p_start[:, 0] - distance, p_start[:, 0] + distance),
+                 p_start[:, 0] - point_dy)
+    y = np.where(vertical, p_start[:, 1], p_start[:, 1] + point_dx)
+    return np.stack((x, y), axis=-1)
+
+
 # noinspection PyShadowingNames
 def point_along_a_line_eq(k, start_x, start_y, distance):
     if k != 0:
@@ -131,6 +185,22 @@ def point_along_a_line_eq(k, start_x, start_y, distance):
     return x, y
 
 
+# noinspection PyShadowingNames
+def point_along_a_line_eq_v(k, start, distance):
+    """vectorized point_along_a_line_eq, for (N,) slopes and (N, 2) start points"""
+    k = np.asarray(k, dtype=float)
+    start = np.asarray(start, dtype=float)
+    distance = np.asarray(distance, dtype=float)
+    point_dx = np.sqrt(_square_v(distance) / (1 + _square_v(k)))
+    point_dx = np.where(distance < 0, -point_dx, point_dx)
+    point_dy = point_dx * k
+
+    flat = k == 0
+    x = np.where(flat, start[:, 0], start[:, 0] + point_dx)
+    y = np.where(flat, start[:, 1] + distance, start[:, 1] + point_dy)
+    return np.stack((x, y), axis=-1)
+
+
 def distance(start_x, start_y, end_x, end_y):
     return math.sqrt((start_x - end_x)**2 + (start_y - end_y)**2)
 
@@ -139,6 +209,13 @@ def distance_p(p1, p2):
     return distance(p1.x, p1.y, p2.x, p2.y)
 
 
+def distance_v(start, end):
+    """vectorized distance between the rows of two (N, 2) arrays of points"""
+    start = np.asarray(start, dtype=float)
+    end = np.asarray(end, dtype=float)
+    return np.sqrt(_square_v(start[:, 0] - end[:, 0]) + _square_v(start[:, 1] - end[:, 1]))
+
+
 def line_equation(start_x, start_y, end_x, end_y):
     dx = end_x - start_x
     k = 0
@@ -147,6 +224,16 @@ def line_equation(start_x, start_y, end_x, end_y):
     return k, start_y
 
 
+def line_equation_v(start, end):
+    """vectorized line_equation, on (N, 2) arrays of points. Returns the (N,) slopes and intercepts"""
+    start = np.asarray(start, dtype=float)
+    end = np.asarray(end, dtype=float)
+    dx = end[:, 0] - start[:, 0]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        k = (end[:, 1] - start[:, 1]) / dx
+    return np.where(dx != 0, k, 0.), start[:, 1].copy()
+
+
 def cosine(x1, y1, x2, y2, x3, y3):
     sx1 = x1 - x2
     sy1 = y1 - y2
@@ -171,6 +258,20 @@ def cosine_p(p1, p2, p3):
     return cosine(p1.x, p1.y, p2.x, p2.y, p3.x, p3.y)
     
 
+def cosine_v(p1, p2, p3):
+    """vectorized cosine of the angle in p2 of the triangles p1, p2, p3, given as (N, 2) arrays of points"""
+    p1 = np.asarray(p1, dtype=float)
+    p2 = np.asarray(p2, dtype=float)
+    p3 = np.asarray(p3, dtype=float)
+    s1 = p1 - p2
+    s2 = p3 - p2
+    dot = s1[:, 0] * s2[:, 0] + s1[:, 1] * s2[:, 1]
+    prod = np.sqrt(_square_v(s1[:, 0]) + _square_v(s1[:, 1])) * np.sqrt(_square_v(s2[:, 0]) + _square_v(s2[:, 1]))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cos = np.clip(dot / prod, -1.0, 1.0)
+    return np.where(prod != 0, cos, 0.)
+
+
 def sgn(x):
     if x < 0:
         return -1
@@ -179,8 +280,8 @@ def sgn(x):
 
 
 def intersection_with_circle(p1, p2, center, radius):    
-    p1s = p1.difference(center)
-    p2s = p2.difference(center)
+    p1s = p1 - center
+    p2s = p2 - center
     # http://mathworld.wolfram.com/Circle-LineIntersection.html
     dx = p2s.x - p1s.x
     dy = p2s.y - p1s.y
@@ -197,7 +298,38 @@ def intersection_with_circle(p1, p2, center, radius):
         p2.x = (D * dy - sgn(dy) * dx * math.sqrt(det)) / (dr ** 2)
         p1.y = (- D * dx + abs(dy) * math.sqrt(det)) / (dr ** 2)
         p2.y = (- D * dx - abs(dy) * math.sqrt(det)) / (dr ** 2)
-        return p1.add(center), p2.add(center)
+        return p1 + center, p2 + center
+
+
+def intersection_with_circle_v(p1, p2, center, radius):
+    """vectorized intersection_with_circle, for the lines through the rows of the (N, 2) arrays p1 and p2.
+
+    Returns two (N, 2) arrays of intersection points, with rows of nan where a line misses its circle.
+    """
+    center = np.asarray(center, dtype=float)
+    p1s = np.asarray(p1, dtype=float) - center
+    p2s = np.asarray(p2, dtype=float) - center
+    radius = np.asarray(radius, dtype=float)
+    dx = p2s[:, 0] - p1s[:, 0]
+    dy = p2s[:, 1] - p1s[:, 1]
+    dr = np.sqrt(_square_v(dx) + _square_v(dy))
+    D = p1s[:, 0] * p2s[:, 1] - p2s[:, 0] * p1s[:, 1]
+    det = _square_v(radius) * _square_v(dr) - _square_v(D)
+    miss = det <= 0
+
+    sgn_dy = np.where(dy < 0, -1., 1.)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sqrt_det = np.sqrt(np.where(miss, 0., det))
+        dr2 = _square_v(dr)
+        x1 = (D * dy + sgn_dy * dx * sqrt_det) / dr2
+        x2 = (D * dy - sgn_dy * dx * sqrt_det) / dr2
+        y1 = (- D * dx + np.abs(dy) * sqrt_det) / dr2
+        y2 = (- D * dx - np.abs(dy) * sqrt_det) / dr2
+    i1 = np.stack((x1, y1), axis=-1) + center
+    i2 = np.stack((x2, y2), axis=-1) + center
+    i1[miss] = np.nan
+    i2[miss] = np.nan
+    return i1, i2
 
 
 def angle(x1, y1, pivot_x, pivot_y, x2, y2):
@@ -212,6 +344,15 @@ def angle(x1, y1, pivot_x, pivot_y, x2, y2):
     return math.atan2(det, dot)
 
 
+def angle_v(p1, pivot, p2):
+    """vectorized angle, between the rows of the (N, 2) arrays p1 and p2 around the pivots"""
+    pivot = np.asarray(pivot, dtype=float)
+    s1 = np.asarray(p1, dtype=float) - pivot
+    s2 = np.asarray(p2, dtype=float) - pivot
+    dot = s1[:, 0] * s2[:, 0] + s1[:, 1] * s2[:, 1]
+    det = s1[:, 0] * s2[:, 1] - s1[:, 1] * s2[:, 0]
+    return np.where((det == 0) & (dot == 0), 0., np.arctan2(det, dot))
+
 
 # noinspection PyShadowingNames
 def rotate_p(point, pivot, angle):
@@ -221,3 +362,17 @@ def rotate_p(point, pivot, angle):
     x = p.x * c - p.y * s + pivot.x
     y = p.x * s + p.y * c + pivot.y
     return Point(x, y)
+
+
+# noinspection PyShadowingNames
+def rotate_v(point, pivot, angle):
+    """vectorized rotate_p, for (N, 2) arrays of points and pivots, and a single angle or an (N,) array of angles"""
+    # sines and cosines come from math, as in rotate_p, computed once for each distinct angle
+    angles, inverse = np.unique(np.asarray(angle, dtype=float), return_inverse=True)
+    s = np.array([math.sin(a) for a in angles])[inverse]
+    c = np.array([math.cos(a) for a in angles])[inverse]
+    pivot = np.asarray(pivot, dtype=float)
+    p = np.asarray(point, dtype=float) - pivot
+    x = p[:, 0] * c - p[:, 1] * s + pivot[:, 0]
+    y = p[:, 0] * s + p[:, 1] * c + pivot[:, 1]
+    return np.stack((x, y), axis=-1)
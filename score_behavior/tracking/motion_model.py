@@ -0,0 +1,126 @@
+import math
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class ConstantVelocityFilter:
+    """a Kalman filter with a constant velocity model, on n coordinates.
+
+    The coordinates are filtered independently, with the same dynamics and the same noise, so that they share a
+    single 2x2 covariance of position and velocity, and a single gain. The time unit is the frame. process_noise is
+    the variance of the acceleration, measurement_noise the variance of the measured positions.
+    """
+
+    def __init__(self, position, process_noise=1., measurement_noise=1., initial_speed_variance=25.):
+        self.measurement_noise = measurement_noise
+        self.initial_speed_variance = initial_speed_variance
+        self.transition = np.array([[1., 1.], [0., 1.]])
+        self.process_covariance = process_noise * np.array([[0.25, 0.5], [0.5, 1.]])
+        self.state = None  # (n, 2) positions and velocities
+        self.covariance = None
+        self.innovation = 0.  # the mean normalized squared innovation of the last update
+        self.reset(position)
+
+    def reset(self, position):
+        """starts again from position, at rest, with the velocity unknown"""
+        position = np.asarray(position, dtype=float).reshape(-1)
+        self.state = np.zeros((len(position), 2))
+        self.state[:, 0] = position
+        self.covariance = np.diag([self.measurement_noise, self.initial_speed_variance])
+
+    def predict(self):
+        self.state = self.state.dot(self.transition.T)
+        self.covariance = self.transition.dot(self.covariance).dot(self.transition.T) + self.process_covariance
+
+    def update(self, residual):
+        """corrects the prediction with the residual of the measurement, which is left to the caller so that angles
+        can be wrapped"""
+        residual = np.asarray(residual, dtype=float).reshape(-1)
+        s = self.covariance[0, 0] + self.measurement_noise
+        gain = self.covariance[:, 0] / s
+        self.state += residual[:, np.newaxis] * gain[np.newaxis, :]
+        self.covariance = self.covariance - np.outer(gain, self.covariance[0, :])
+        self.innovation = float(np.mean(residual * residual)) / s
+
+    def position(self):
+        return self.state[:, 0].copy()
+
+    def prediction_std(self):
+        """the standard deviation of the next measurement around the predicted position"""
+        return float(np.sqrt(self.covariance[0, 0] + self.measurement_noise))
+
+
+class PostureMotionModel:
+    """the motion of an animal moving as a rigid body, at constant velocity and turning rate.
+
+    The back point and the heading, from the back to the head, are each followed by a constant velocity Kalman
+    filter. The position noises are in pixels, the angle noises in radians.
+
+    The confidence is a running average of the fraction of the measured postures that fall within gate standard
+    deviations of the prediction. It drops when the measured postures stop following the motion, e.g. when the
+    tracker loses the animal.
+    """
+
+    def __init__(self, posture, process_noise=1., measurement_noise=1., angle_process_noise=0.01,
+                 angle_measurement_noise=0.01, gate=3., confidence_alpha=0.9):
+        posture = np.asarray(posture, dtype=float).reshape((3, 2))
+        self.back_filter = ConstantVelocityFilter(posture[2], process_noise, measurement_noise)
+        self.heading_filter = ConstantVelocityFilter(self.heading(posture), angle_process_noise,
+                                                     angle_measurement_noise, initial_speed_variance=0.25)
+        self.posture = posture  # the last measured posture
+        self.gate = gate
+        self.confidence_alpha = confidence_alpha
+        self.confidence = 1.
+
+    @staticmethod
+    def wrap(angle):
+        return math.atan2(math.sin(angle), math.cos(angle))
+
+    @staticmethod
+    def heading(posture):
+        d = posture[0] - posture[2]
+        return math.atan2(d[1], d[0])
+
+    def reset(self, posture):
+        """starts again from posture, at rest"""
+        self.posture = np.asarray(posture, dtype=float).reshape((3, 2))
+        self.back_filter.reset(self.posture[2])
+        self.heading_filter.reset(self.heading(self.posture))
+
+    def predict(self):
+        self.back_filter.predict()
+        self.heading_filter.predict()
+
+    def update(self, posture):
+        posture = np.asarray(posture, dtype=float).reshape((3, 2))
+        self.back_filter.update(posture[2] - self.back_filter.position())
+        self.heading_filter.update(self.wrap(self.heading(posture) - self.heading_filter.position()[0]))
+        self.heading_filter.state[0, 0] = self.wrap(self.heading_filter.state[0, 0])
+        self.posture = posture
+        innovation = max(self.back_filter.innovation, self.heading_filter.innovation)
+        within_gate = innovation <= self.gate * self.gate
+        self.confidence = self.confidence_alpha * self.confidence + (1. - self.confidence_alpha) * within_gate
+
+    def predicted_posture(self, posture):
+        """posture, given as a (3, 2) head, front and back, turned around its back as much as predicted.
+
+        The translation is left to the caller: the centroid of the animal is measured in every frame, and tells how
+        far it moved better than the prediction of the back.
+        """
+        posture = np.asarray(posture, dtype=float).reshape((3, 2))
+        turn = self.heading_filter.position()[0] - self.heading(self.posture)
+        c = math.cos(turn)
+        s = math.sin(turn)
+        rotation = np.array([[c, -s], [s, c]])
+        return (posture - posture[2]).dot(rotation.T) + posture[2]
+
+    def position_std(self):
+        """the standard deviation of the next back position around the prediction, in pixels"""
+        return self.back_filter.prediction_std()
+
+    def angle_std(self):
+        """the standard deviation of the next heading around the prediction, in degrees"""
+        return math.degrees(self.heading_filter.prediction_std())
@@ -0,0 +1,182 @@
+import numpy as np
+import cv2
+import logging
+
+import score_behavior.tracking.geometry as geometry
+
+logger = logging.getLogger(__name__)
+
+
+class PostureScorer:
+    """scores a whole batch of candidate postures against the foreground matrix in one pass.
+
+    Every candidate body model is rasterized into one slice of a stacked (N, mask_size, mask_size) mask tensor, and
+    all the candidates are then scored against the same window of the matrix with a single matrix product. The masks
+    are the same as the ones drawn by cv2 one posture at a time, so the scores are bit-identical.
+    """
+
+    def __init__(self, head_radius, front_radius, back_radius, mask_size=50):
+        self.head_radius = head_radius
+        self.front_radius = front_radius
+        self.back_radius = back_radius
+        self.mask_size = mask_size
+        self.mask_half = mask_size / 2
+        self._masks = np.zeros((0, mask_size, mask_size), np.uint8)
+        self._stamps = {}
+        for r in (head_radius, front_radius, back_radius):
+            self._stamps[r] = self.make_circle_stamp(r)
+
+    @staticmethod
+    def make_circle_stamp(radius):
+        """the half width of each row of a filled circle as drawn by cv2, -1 for the rows outside of it.
+
+        The filled circles of cv2 are made of horizontal spans symmetric around the center, so the half widths are
+        enough to redraw one at any integer center. An extra row of -1 is used for out of range lookups.
+        """
+        r = int(radius)
+        size = 2 * r + 3
+        stamp = np.zeros((size, size), np.uint8)
+        cv2.circle(stamp, (r + 1, r + 1), radius, 1, -1)
+        half_widths = np.full(size + 1, -1, np.int64)
+        rows, cols = np.nonzero(stamp)
+        np.maximum.at(half_widths, rows, np.abs(cols - (r + 1)))
+        return half_widths
+
+    def stamp_circles(self, masks, centers, radius):
+        """or the circles centered at the (N, 2) integer centers into the masks, one circle per mask"""
+        half_widths = self._stamps[radius]
+        size = half_widths.shape[0] - 1
+        offset = int(radius) + 1
+        idx = np.arange(self.mask_size)
+        rows = idx[np.newaxis, :] - centers[:, 1, np.newaxis] + offset
+        rows[(rows < 0) | (rows >= size)] = size
+        row_half_widths = half_widths[rows].astype(np.int16)
+        dist_x = np.abs(idx[np.newaxis, :] - centers[:, 0, np.newaxis]).clip(0, self.mask_size).astype(np.int16)
+        inside = np.less_equal(dist_x[:, np.newaxis, :], row_half_widths[:, :, np.newaxis])
+        np.bitwise_or(masks, inside.view(np.uint8), out=masks)
+
+    def rasterize(self, postures, contracted, animal_center):
+        """draws the body models of the (N, 3, 2) head, front, back postures, centered on animal_center.
+
+        animal_center is either one point for all the postures, or an (N, 2) array with one point per posture.
+        Returns a (N, mask_size, mask_size) uint8 tensor which is 1 on the body and 0 elsewhere.
+        """
+        n = postures.shape[0]
+        if self._masks.shape[0] < n:
+            self._masks = np.zeros((n, self.mask_size, self.mask_size), np.uint8)
+        masks = self._masks[:n]
+        masks.fill(0)
+
+        mask_center = np.array([self.mask_half, self.mask_half])
+        animal_center = np.asarray(animal_center, dtype=float)
+        if animal_center.ndim == 2:
+            animal_center = animal_center[:, np.newaxis, :]
+        pts = postures - animal_center + mask_center
+        h = pts[:, 0, :]
+        f = pts[:, 1, :]
+        b = pts[:, 2, :]
+        hr = self.head_radius
+        fr = self.front_radius
+        br = self.back_radius
+
+        # the segment from head to front, or from head to back for contracted postures
+        seg_start = np.where(contracted[:, np.newaxis], b, f)
+        seg_radius = np.where(contracted, br, fr)
+        # the 8 corners of the two quadrilaterals of all the postures are computed in a single call, corner by corner
+        full = np.ones(n)
+        corners = geometry.point_along_a_perpendicular_v(
+            np.concatenate((seg_start,) * 4 + (f,) * 4),
+            np.concatenate((h,) * 4 + (b,) * 4),
+            np.concatenate((h, seg_start, seg_start, h, b, f, f, b)),
+            np.concatenate((hr * full, seg_radius, -seg_radius, -hr * full, br * full, fr * full, -fr * full,
+                            -br * full)))
+        corners = corners.reshape((2, 4, n, 2)).transpose((0, 2, 1, 3)).astype(np.int32, order='C')
+        quad1 = corners[0]
+        quad2 = corners[1]
+
+        for i in range(n):
+            cv2.fillConvexPoly(masks[i], quad1[i], 1)
+            if not contracted[i]:
+                cv2.fillConvexPoly(masks[i], quad2[i], 1)
+
+        centers = pts.astype(np.int64)
+        self.stamp_circles(masks, centers[:, 0, :], hr)
+        self.stamp_circles(masks, centers[:, 1, :], fr)
+        self.stamp_circles(masks, centers[:, 2, :], br)
+        return masks
+
+    def window(self, matrix, animal_center):
+        """the slices of the matrix and of the masks that overlap when the masks are centered at animal_center"""
+        mh = int(self.mask_half)
+        acx = int(animal_center[0])
+        acy = int(animal_center[1])
+        matrix_slice = (slice(max(acy - mh, 0), acy + mh), slice(max(acx - mh, 0), acx + mh))
+        mask_start_r = 0
+        mask_start_c = 0
+        mask_end_r = self.mask_size
+        mask_end_c = self.mask_size
+        if acy - mh < 0:
+            mask_start_r = -(acy - mh)
+        if acx - mh < 0:
+            mask_start_c = -(acx - mh)
+        if acy + mh > matrix.shape[0]:
+            mask_end_r -= acy + mh - matrix.shape[0]
+        if acx + mh > matrix.shape[1]:
+            mask_end_c -= acx + mh - matrix.shape[1]
+        mask_slice = (slice(None), slice(mask_start_r, mask_end_r), slice(mask_start_c, mask_end_c))
+        return matrix_slice, mask_slice
+
+    def score(self, matrix, animal_center, postures, contracted, offset=0.):
+        """the score of each posture: the sum of the matrix minus offset weighted +1 on the body and -1 outside of it"""
+        postures = np.asarray(postures, dtype=float)
+        contracted = np.asarray(contracted, dtype=bool)
+        masks = self.rasterize(postures, contracted, animal_center)
+        return self.score_masks(matrix, animal_center, masks, offset)
+
+    def score_many(self, matrix, animal_centers, postures, contracted, offset=0.):
+        """scores the candidate postures of several animals, rasterizing all of them in one pass.
+
+        postures and contracted are lists with the candidates of each animal, animal_centers the center of each
+        animal. The scores are those of the matrix minus offset, which is only computed within the windows scored.
+        Returns the list of the scores of the candidates of each animal.
+        """
+        counts = [len(p) for p in postures]
+        if not counts:
+            return []
+        all_postures = np.concatenate([np.asarray(p, dtype=float) for p in postures])
+        all_contracted = np.concatenate([np.asarray(c, dtype=bool) for c in contracted])
+        centers = np.array([np.asarray(c, dtype=float) for c in animal_centers])
+        masks = self.rasterize(all_postures, all_contracted, np.repeat(centers, counts, axis=0))
+        scores = []
+        start = 0
+        for center, n in zip(animal_centers, counts):
+            scores.append(self.score_masks(matrix, center, masks[start:start + n], offset))
+            start += n
+        return scores
+
+    def score_masks(self, matrix, animal_center, masks, offset=0.):
+        """the scores of the rasterized body models, centered on animal_center, against the matrix minus offset"""
+        if not len(masks):
+            return np.zeros(0)
+        matrix_slice, mask_slice = self.window(matrix, animal_center)
+        m = matrix[matrix_slice]
+        body = masks[mask_slice]
+        if body.shape[1:] != m.shape:
+            logger.error('tracker fault: mask of shape {} does not match matrix window of shape {}'.format(
+                body.shape[1:], m.shape))
+            logger.info("ac = ({}, {}), mh = {}".format(animal_center[0], animal_center[1], int(self.mask_half)))
+            logger.info(("matrix size = {}, {}".format(matrix.shape[0], matrix.shape[1])))
+            return np.zeros(masks.shape[0])
+        # mask * m summed, with the mask being +1 on the body and -1 elsewhere. The matrix holds integer values, and
+        # the sums over a window stay well below 2**24, so that they are exact in single precision
+        if m.dtype == np.uint8:
+            # the offset is only applied to the window, and the sum over it is computed in integers
+            m_total = int(m.sum(dtype=np.int64)) - offset * m.size
+            m = m.astype(np.float32)
+            if offset:
+                m -= np.float32(offset)
+        else:
+            m = m.astype(np.float32) - np.float32(offset) if offset else m
+            m_total = m.sum(dtype=float)
+        on_body = body.reshape((body.shape[0], -1)).astype(np.float32).dot(m.reshape(-1).astype(np.float32))
+        return 2 * on_body.astype(float) - m_total
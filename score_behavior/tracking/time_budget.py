@@ -0,0 +1,79 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class TimeBudget:
+    """keeps the time the tracker takes per frame within a budget, by shedding work in steps.
+
+    The load is a running average of the tracking time per frame, in seconds, skipped frames counting for the
+    little they take. When it goes over the budget the tier goes up by one, and when it stays under
+    recover_fraction of the budget for hold_frames frames it goes down by one. After each change the tier is held
+    for hold_frames frames, so that the load can settle.
+
+    The tiers are:
+        0: full tracking
+        1: fewer candidate postures
+        2: only the windows around the animals are searched, with no periodic full frame search
+        3: no overlay drawn on the frames
+        4: one frame every skip_interval is tracked, the positions in the others are predicted from the motion
+    """
+    FULL = 0
+    FEWER_CANDIDATES = 1
+    ROI_ONLY = 2
+    NO_OVERLAY = 3
+    SKIP_FRAMES = 4
+
+    tier_labels = {FULL: 'full', FEWER_CANDIDATES: 'fewer candidates', ROI_ONLY: 'ROI only',
+                   NO_OVERLAY: 'no overlay', SKIP_FRAMES: 'skipping frames'}
+
+    def __init__(self, budget, alpha=0.1, recover_fraction=0.5, hold_frames=30, max_tier=SKIP_FRAMES,
+                 skip_interval=2):
+        self.budget = budget
+        self.alpha = alpha
+        self.recover_fraction = recover_fraction
+        self.hold_frames = hold_frames
+        self.max_tier = max_tier
+        self.skip_interval = skip_interval
+        self.tier = self.FULL
+        self.load = 0.
+        self.tier_frames = {}  # the number of frames spent in each tier
+        self._held = 0
+        self._below = 0
+        self._frame_no = 0
+
+    def reset(self):
+        self.tier = self.FULL
+        self.load = 0.
+        self._held = 0
+        self._below = 0
+        self._frame_no = 0
+
+    def skip_frame(self):
+        """whether the next frame is to be skipped"""
+        return self.tier >= self.SKIP_FRAMES and self._frame_no % self.skip_interval != 0
+
+    def add(self, elapsed):
+        """takes the time spent on a frame, tracked or skipped, and moves to another tier if needed"""
+        self._frame_no += 1
+        self.tier_frames[self.tier] = self.tier_frames.get(self.tier, 0) + 1
+        self.load += self.alpha * (elapsed - self.load)
+        self._held += 1
+        if self.load < self.recover_fraction * self.budget:
+            self._below += 1
+        else:
+            self._below = 0
+        if self._held < self.hold_frames:
+            return
+        if self.load > self.budget and self.tier < self.max_tier:
+            self.set_tier(self.tier + 1)
+        elif self._below >= self.hold_frames and self.tier > self.FULL:
+            self.set_tier(self.tier - 1)
+
+    def set_tier(self, tier):
+        logger.info("tracking {:.1f} ms/frame for a budget of {:.1f} ms/frame, going from {} to {}".format(
+            1.e3 * self.load, 1.e3 * self.budget, self.tier_labels[self.tier], self.tier_labels[tier]))
+        self.tier = tier
+        self._held = 0
+        self._below = 0
+        self._frame_no = 0
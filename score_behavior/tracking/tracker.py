@@ -1,10 +1,18 @@
 import numpy as np
 import cv2
 import math
+import time
 from enum import Enum
 
 import score_behavior.tracking.geometry as geometry
+from score_behavior.tracking.posture_scoring import PostureScorer
+from score_behavior.tracking.assignment import assign_identities
+from score_behavior.tracking.background import make_background_model, median_frame
+from score_behavior.tracking.background_cache import BackgroundCache, background_change
+from score_behavior.tracking.motion_model import PostureMotionModel
+from score_behavior.tracking.time_budget import TimeBudget
 from score_behavior.score_config import get_config_section
+from score_behavior import video_overlay
 import logging
 
 logger = logging.getLogger(__name__)
@@ -17,6 +25,7 @@ class AnimalPosition:
         self.front = 0
         self.back = 0
         self.contracted = 0
+        self.confidence = 1.
 
 
 class Animal:
@@ -45,153 +54,146 @@ class Animal:
             self.back = back
             self.contracted = contracted
 
+    # postures are handled in batches, as (N, 3, 2) arrays holding the head, front and back point of each posture
+    HEAD = 0
+    FRONT = 1
+    BACK = 2
+
+    @staticmethod
+    def make_postures(head, front, back):
+        return np.stack((head, front, back), axis=1)
+
     # the primitives for animal motion, essentially the dynamics model of the animal
-    def move_back(self, postures):
+    def move_back(self, postures, distances=None):
         """move the entire animal of the same amount """
-        result = []
         # distances = [2, 4, 6, 8, 10, 14, 18, 22]
-        distances = np.arange(-10, 11, 1)
-        for p in postures:
-            for d in distances:
-                moved = geometry.point_along_a_line_p(p.back, p.front, d)
-                delta = moved - p.back
-                result.append(self.Posture(p.head + delta, p.front + delta, moved))
-        return result
-
-    def move_front(self, postures):
+        if distances is None:
+            distances = np.arange(-10, 11, 1)
+        p = np.repeat(postures, len(distances), axis=0)
+        d = np.tile(distances, len(postures))
+        moved = geometry.point_along_a_line_v(p[:, self.BACK], p[:, self.FRONT], d)
+        delta = moved - p[:, self.BACK]
+        return self.make_postures(p[:, self.HEAD] + delta, p[:, self.FRONT] + delta, moved)
+
+    def move_front(self, postures, distances=None):
         """move only the head and the front?"""
-        result = []
         # distances = [-4, -2, 2, 4, 6, 8, 10]
-        distances = np.arange(-5, 6, 1)
+        if distances is None:
+            distances = np.arange(-5, 6, 1)
         min_dist = self.scaled_back_radius - self.scaled_front_radius
         max_dist = self.scaled_back_radius + self.scaled_front_radius
-        for p in postures:
-            cd = geometry.distance_p(p.back, p.front)
-            for d in distances:
-                if cd + d < min_dist:
-                    continue
-                if cd + d > max_dist:
-                    continue
-                moved = geometry.point_along_a_line_p(p.back, p.front, cd + d)
-                delta = moved - p.front
-                result.append(self.Posture(p.head + delta, moved, p.back))
-        return result
-
-    def move_head(self, postures):
+        p = np.repeat(postures, len(distances), axis=0)
+        d = geometry.distance_v(p[:, self.BACK], p[:, self.FRONT]) + np.tile(distances, len(postures))
+        keep = ~((d < min_dist) | (d > max_dist))
+        p = p[keep]
+        moved = geometry.point_along_a_line_v(p[:, self.BACK], p[:, self.FRONT], d[keep])
+        delta = moved - p[:, self.FRONT]
+        return self.make_postures(p[:, self.HEAD] + delta, moved, p[:, self.BACK])
+
+    def move_head(self, postures, distances=None):
         """move only the head"""
-        result = []
-        distances = np.arange(-5, 6, 1)
+        if distances is None:
+            distances = np.arange(-5, 6, 1)
         min_dist = self.scaled_front_radius - self.scaled_head_radius
         max_dist = self.scaled_front_radius + self.scaled_head_radius
-        for p in postures:
-            cd = geometry.distance_p(p.front, p.head)
-            for d in distances:
-                if cd + d < min_dist:
-                    continue
-                if cd + d > max_dist:
-                    continue
-                moved = geometry.point_along_a_line_p(p.front, p.head, cd + d)
-                result.append(self.Posture(moved, p.front, p.back))
-        return result
-
-    def rotate_front(self, postures):
+        p = np.repeat(postures, len(distances), axis=0)
+        d = geometry.distance_v(p[:, self.FRONT], p[:, self.HEAD]) + np.tile(distances, len(postures))
+        keep = ~((d < min_dist) | (d > max_dist))
+        p = p[keep]
+        moved = geometry.point_along_a_line_v(p[:, self.FRONT], p[:, self.HEAD], d[keep])
+        return self.make_postures(moved, p[:, self.FRONT], p[:, self.BACK])
+
+    def rotate_front(self, postures, angles=None):
         """rotate the front and the head"""
-        result = []
-        angles = np.arange(-20, 21, 4)
-        for p in postures:
-            for a in angles:
-                ar = a * (math.pi / 180)
-                rotated_front = geometry.rotate_p(p.front, p.back, ar)
-                rotated_head = geometry.rotate_p(p.head, p.back, ar)
-                result.append(self.Posture(rotated_head, rotated_front, p.back))
-        return result
-
-    def rotate_head(self, postures):
-        """rotate only the head"""
-        result = []
+        if angles is None:
+            angles = np.arange(-20, 21, 4)
+        p = np.repeat(postures, len(angles), axis=0)
+        ar = np.tile(angles, len(postures)) * (math.pi / 180)
+        rotated_front = geometry.rotate_v(p[:, self.FRONT], p[:, self.BACK], ar)
+        rotated_head = geometry.rotate_v(p[:, self.HEAD], p[:, self.BACK], ar)
+        return self.make_postures(rotated_head, rotated_front, p[:, self.BACK])
+
+    def rotate_head(self, postures, angles=None, return_kept=False):
+        """rotate only the head, and with return_kept, which of the rotations of each posture were kept"""
         # angles = [-20, -10, 10, 20]
-        angles = np.arange(-20, 21, 4)
-        for p in postures:
-            for a in angles:
-                ar = a * (math.pi / 180)
+        if angles is None:
+            angles = np.arange(-20, 21, 4)
+        p = np.repeat(postures, len(angles), axis=0)
+        ar = np.tile(angles, len(postures)) * (math.pi / 180)
 
-                rotated_head = geometry.rotate_p(p.head, p.front, ar)
+        rotated_head = geometry.rotate_v(p[:, self.HEAD], p[:, self.FRONT], ar)
 
-                cos = geometry.cosine_p(p.back, p.front, rotated_head)
-                if cos > 0.1:
-                    continue
+        cos = geometry.cosine_v(p[:, self.BACK], p[:, self.FRONT], rotated_head)
+        keep = ~(cos > 0.1)
 
-                result.append(self.Posture(rotated_head, p.front, p.back))
-        return result
+        rotated = self.make_postures(rotated_head, p[:, self.FRONT], p[:, self.BACK])[keep]
+        if return_kept:
+            return rotated, keep
+        return rotated
 
-    def move_back_contracted(self, postures):
-        result = []
+    def move_back_contracted(self, postures, distances=None):
         # distances = [-1, 2, 4, 6, 8, 10, 20, 30]
-        distances = np.arange(-10, 11, 1)
-        for p in postures:
-            for d in distances:
-                moved = geometry.point_along_a_line_p(p.back, p.head, d)
-                delta = moved - p.back
-                result.append(self.Posture(p.head + delta, moved, moved, True))
-        return result
-
-    def move_head_contracted(self, postures):
-        result = []
+        if distances is None:
+            distances = np.arange(-10, 11, 1)
+        p = np.repeat(postures, len(distances), axis=0)
+        d = np.tile(distances, len(postures))
+        moved = geometry.point_along_a_line_v(p[:, self.BACK], p[:, self.HEAD], d)
+        delta = moved - p[:, self.BACK]
+        return self.make_postures(p[:, self.HEAD] + delta, moved, moved)
+
+    def move_head_contracted(self, postures, distances=None):
         # distances = [-2, 2]
-        distances = np.arange(-5, 6, 1)
+        if distances is None:
+            distances = np.arange(-5, 6, 1)
         min_dist = self.scaled_back_radius - self.scaled_head_radius
         max_dist = self.scaled_back_radius + self.scaled_head_radius
-        for p in postures:
-            cd = geometry.distance_p(p.back, p.head)
-            for d in distances:
-                if cd + d < min_dist:
-                    continue
-                if cd + d > max_dist:
-                    continue
-                moved = geometry.point_along_a_line_p(p.back, p.head, cd + d)
-                result.append(self.Posture(moved, p.back, p.back, True))
-        return result
-
-    def rotate_head_contracted(self, postures):
-        result = []
-
-        for p in postures:
-
-            d = geometry.distance_p(p.back, p.head) + self.scaled_head_radius - self.scaled_back_radius
-            if d <= self.scaled_head_radius / 4:
-                angles = [20, 40, 60, 80, 100, 120, 140, 160, 180, 200, 220, 240, 260, 280, 300, 320, 340]
-            else:
-                angles = [-20, -10, 10, 20]
-
-            for a in angles:
-                ar = a * (math.pi / 180)
-                rotated_head = geometry.rotate_p(p.head, p.back, ar)
-                result.append(self.Posture(rotated_head, p.back, p.back, True))
-
-        return result
-
-    def move_front_contracted(self, postures):
+        p = np.repeat(postures, len(distances), axis=0)
+        d = geometry.distance_v(p[:, self.BACK], p[:, self.HEAD]) + np.tile(distances, len(postures))
+        keep = ~((d < min_dist) | (d > max_dist))
+        p = p[keep]
+        moved = geometry.point_along_a_line_v(p[:, self.BACK], p[:, self.HEAD], d[keep])
+        return self.make_postures(moved, p[:, self.BACK], p[:, self.BACK])
+
+    def rotate_head_contracted(self, postures, wide_angles=None, narrow_angles=None):
+        if wide_angles is None:
+            wide_angles = [20, 40, 60, 80, 100, 120, 140, 160, 180, 200, 220, 240, 260, 280, 300, 320, 340]
+        if narrow_angles is None:
+            narrow_angles = [-20, -10, 10, 20]
+
+        d = geometry.distance_v(postures[:, self.BACK], postures[:, self.HEAD]) + self.scaled_head_radius - \
+            self.scaled_back_radius
+        wide = d <= self.scaled_head_radius / 4
+
+        # each posture is rotated by either the wide or the narrow set of angles
+        n_angles = np.where(wide, len(wide_angles), len(narrow_angles))
+        p = np.repeat(postures, n_angles, axis=0)
+        angles = np.array([a for w in wide for a in (wide_angles if w else narrow_angles)])
+        ar = angles * (math.pi / 180)
+        rotated_head = geometry.rotate_v(p[:, self.HEAD], p[:, self.BACK], ar)
+        return self.make_postures(rotated_head, p[:, self.BACK], p[:, self.BACK])
+
+    def move_front_contracted(self, postures, distances=None):
         """moving the front gets the mouse out of the contracted state"""
-        result = []
-        distances = [2, 4, 6]
+        if distances is None:
+            distances = np.array([2, 4, 6])
         base_distance = self.scaled_back_radius - self.scaled_front_radius
-        for p in postures:
-            hd = geometry.distance_p(p.back, p.head)
-            for d in distances:
-                moved_front = geometry.point_along_a_line_p(p.back, p.head, base_distance + d)
-                moved_head = geometry.point_along_a_line_p(p.back, p.head, hd + d)
-                result.append(self.Posture(moved_head, moved_front, p.back))
-        return result
-
-    def generate_postures(self):
-        """enumerates the possible postures"""
-
+        p = np.repeat(postures, len(distances), axis=0)
+        d = np.tile(distances, len(postures))
+        hd = geometry.distance_v(p[:, self.BACK], p[:, self.HEAD])
+        moved_front = geometry.point_along_a_line_v(p[:, self.BACK], p[:, self.HEAD], base_distance + d)
+        moved_head = geometry.point_along_a_line_v(p[:, self.BACK], p[:, self.HEAD], hd + d)
+        return self.make_postures(moved_head, moved_front, p[:, self.BACK])
+
+    def initial_posture(self):
+        """the current posture moved with the centroid, as a (1, 3, 2) array, where the search for the new one starts"""
         centroid_scaled = self.centroid.scaled(self.host.scale_factor, self.host.config.skeletonization_border)
         # "tether" the front to the centroid if it runs away too far
         if np.linalg.norm(self.back-centroid_scaled, ord=2) > 50:
             self.head = (self.head - self.front) + centroid_scaled
             self.front = (self.front - self.front) + centroid_scaled
             self.back = centroid_scaled
+            if self.motion_model is not None:
+                self.motion_model.reset((self.head, self.front, self.back))
 
         disp = self.centroid - self.prev_centroid
         animal_vec = self.head - self.back
@@ -199,45 +201,189 @@ class Animal:
         # if it appears that the animal is running backwards, flip the Posture
         if np.dot(animal_vec, self.speed) < 0 and np.linalg.norm(self.speed) > self.host.speed_threshold \
                 and not self.contracted:
-            postures = [self.Posture(self.back + disp, self.front + disp,
-                                     self.head + disp, self.contracted)]
+            postures0 = np.array([(self.back + disp, self.front + disp, self.head + disp)], dtype=float)
+            if self.motion_model is not None:
+                # the motion so far was that of the flipped posture
+                self.motion_model.reset(postures0[0])
+        else:
+            postures0 = np.array([(self.head + disp, self.front + disp, self.back + disp)], dtype=float)
+        return postures0
+
+    def search_center(self, postures0):
+        """the posture around which the candidates are generated: the initial posture, turned as predicted by the
+        motion model if there is one"""
+        if self.motion_model is None:
+            return postures0
+        return self.motion_model.predicted_posture(postures0[0])[np.newaxis]
+
+    def search_grids(self, narrow=False):
+        """the distances and angles of the moves of generate_posture_array, narrowed around the prediction of the
+        motion model, if any.
+
+        The half width of the grids follows the standard deviation of the prediction, so that fewer candidates are
+        scored while the motion is well predicted, and the full grids when it is not. Without a motion model, the
+        full grids are used. With narrow, the half widths are halved, keeping the steps of the grids.
+        """
+        if self.motion_model is None and not narrow:
+            return None, None, None
+        if self.motion_model is None:
+            n_distance, n_short, n_angle = 10, 5, 20
         else:
-            postures = [self.Posture(self.head + disp, self.front + disp,
-                                     self.back + disp, self.contracted)]
-        postures0 = postures[:]
+            sigmas = self.host.motion_grid_sigmas
+            n_distance = int(np.clip(np.ceil(sigmas * self.motion_model.position_std()), 2, 10))
+            n_short = int(np.clip(np.ceil(n_distance / 2.), 1, 5))
+            n_angle = 4 * int(np.clip(np.ceil(sigmas * self.motion_model.angle_std() / 4.), 1, 5))
+        if narrow:
+            n_distance = int(np.ceil(n_distance / 2.))
+            n_short = int(np.ceil(n_short / 2.))
+            n_angle = 4 * int(np.ceil(n_angle / 8.))
+        return np.arange(-n_distance, n_distance + 1), np.arange(-n_short, n_short + 1), \
+            np.arange(-n_angle, n_angle + 1, 4)
+
+    def generate_posture_array(self, return_steps=False, narrow=False):
+        """enumerates the possible postures, on the grids of search_grids.
+
+        Returns an (N, 3, 2) array with the head, front and back of each candidate posture and an (N,) vector of
+        contracted flags. The first candidate is the current posture, moved with the centroid.
+
+        With return_steps, also returns the steps that make each candidate: the index of the candidate that is
+        rotated, the rotation, 0 for rotate_front, 1 for rotate_head and -1 for none, and its angle.
+        """
+        postures0 = self.initial_posture()
+        distances, short_distances, angles = self.search_grids(narrow)
+        blocks = [(postures0, self.contracted)]
+        # with a motion model, the candidates are generated around the predicted posture, which has to score better
+        # than the initial one to be taken
+        if self.motion_model is not None:
+            postures0 = self.search_center(postures0)
+            blocks.append((postures0, self.contracted))
 
         if not self.contracted:
-            p = self.move_back(postures0)
-            postures = postures + p
-
-            p = self.move_front(postures0)
-            postures = postures + p
-
-            p = self.move_head(postures0)
-            postures = postures + p
+            blocks.append((self.move_back(postures0, distances), False))
+            blocks.append((self.move_front(postures0, short_distances), False))
+            blocks.append((self.move_head(postures0, short_distances), False))
 
             if self.host.postures_two_steps:
-                postures0 = postures[:]
-
-            p = self.rotate_front(postures0)
-            postures = postures + p
+                postures0 = np.concatenate([b for b, _ in blocks])
 
-            p = self.rotate_head(postures0)
-            postures = postures + p
+            n_moved = sum(len(b) for b, _ in blocks)
+            rotated_front = self.rotate_front(postures0, angles)
+            rotated_head, kept = self.rotate_head(postures0, angles, return_kept=True)
+            blocks.append((rotated_front, False))
+            blocks.append((rotated_head, False))
+        else:
+            blocks.append((self.move_back_contracted(postures0, distances), True))
+            blocks.append((self.move_head_contracted(postures0, short_distances), True))
+            blocks.append((self.rotate_head_contracted(postures0), True))
+            blocks.append((self.move_front_contracted(postures0), False))
+
+        postures = np.concatenate([b for b, _ in blocks])
+        contracted = np.concatenate([np.full(len(b), c, dtype=bool) for b, c in blocks])
+        if not return_steps:
+            return postures, contracted
+        moves = np.arange(len(postures))
+        rotations = np.full(len(postures), -1)
+        rotation_angles = np.zeros(len(postures))
+        if not self.contracted:
+            # postures0 are the last candidates moved
+            if angles is None:
+                angles = np.arange(-20, 21, 4)
+            rotated_moves = np.repeat(np.arange(n_moved - len(postures0), n_moved), len(angles))
+            all_angles = np.tile(angles, len(postures0))
+            moves[n_moved:] = np.concatenate([rotated_moves, rotated_moves[kept]])
+            rotations[n_moved:] = np.repeat([0, 1], [len(rotated_front), len(rotated_head)])
+            rotation_angles[n_moved:] = np.concatenate([all_angles, all_angles[kept]])
+        return postures, contracted, (moves, rotations, rotation_angles)
+
+    def posture_grid_neighbours(self, postures, steps, t):
+        """which of the candidates of generate_posture_array with return_steps are next to the candidate t on the grid
+        of the moves times the rotations: all the rotations of its move, its rotation of all the moves, and the next
+        rotations of the next moves"""
+        moves, rotations, angles = steps
+        neighbours = moves == moves[t]
+        if rotations[t] >= 0:
+            neighbours |= (rotations == rotations[t]) & (angles == angles[t])
+        moved = rotations < 0
+        step = np.abs(postures[moved] - postures[moves[t]]).max(axis=(1, 2)) <= self.neighbour_distances.max() + 1.e-6
+        next_rotations = (rotations >= 0) & (np.abs(angles - angles[t]) <= self.neighbour_angles.max()) & \
+            ((rotations == rotations[t]) | (rotations[t] < 0))
+        return neighbours | (np.isin(moves, moves[moved][step]) & next_rotations)
+
+    # the sparse grids of the coarse to fine search, and the small steps taken around the best candidates
+    coarse_distances = np.array([-8, -4, 4, 8])
+    coarse_short_distances = np.array([-4, -2, 2, 4])
+    coarse_angles = np.array([-16, -8, 8, 16])
+    coarse_wide_angles = np.arange(40, 321, 40)
+    # the steps of the dense grid, also taken from the current posture in the coarse round, so that the search
+    # never ends up below the best of the dense grid next to it
+    neighbour_distances = np.array([-1, 1])
+    neighbour_angles = np.array([-4, 4])
+    fine_distances = np.array([-2, 2])
+    fine_short_distances = np.array([-1, 1])
+    fine_angles = np.array([-4, 4])
+    # the refinement level from which the steps are those of the dense grid, or smaller
+    dense_level = 1
+
+    def generate_coarse_posture_array(self):
+        """the first step of the coarse to fine search: the current posture, and the same moves as
+        generate_posture_array on a sparse grid and to its neighbours on the dense grid"""
+        postures0 = self.initial_posture()
+        blocks = [(postures0, self.contracted)]
+        if self.motion_model is not None:
+            postures0 = self.search_center(postures0)
+            blocks.append((postures0, self.contracted))
+
+        distances = np.concatenate([self.coarse_distances, self.neighbour_distances])
+        short_distances = np.concatenate([self.coarse_short_distances, self.neighbour_distances])
+        if not self.contracted:
+            angles = np.concatenate([self.coarse_angles, self.neighbour_angles])
+            blocks.append((self.move_back(postures0, distances), False))
+            blocks.append((self.move_front(postures0, short_distances), False))
+            blocks.append((self.move_head(postures0, short_distances), False))
+            blocks.append((self.rotate_front(postures0, angles), False))
+            blocks.append((self.rotate_head(postures0, angles), False))
         else:
-            p = self.move_back_contracted(postures0)
-            postures = postures + p
+            # the narrow rotations and the moves of the front are as few as on the dense grid
+            blocks.append((self.move_back_contracted(postures0, distances), True))
+            blocks.append((self.move_head_contracted(postures0, short_distances), True))
+            blocks.append((self.rotate_head_contracted(postures0, self.coarse_wide_angles), True))
+            blocks.append((self.move_front_contracted(postures0), False))
 
-            p = self.move_head_contracted(postures0)
-            postures = postures + p
+        postures = np.concatenate([b for b, _ in blocks])
+        contracted = np.concatenate([np.full(len(b), c, dtype=bool) for b, c in blocks])
+        return postures, contracted
 
-            p = self.rotate_head_contracted(postures0)
-            postures = postures + p
+    def generate_refined_posture_array(self, postures, contracted, level=0):
+        """the postures one small step away from each of the given ones, with their contracted flags.
 
-            p = self.move_front_contracted(postures0)
-            postures = postures + p
+        The steps are halved at each level of refinement.
+        """
+        scale = 0.5 ** level
+        distances = self.fine_distances * scale
+        short_distances = self.fine_short_distances * scale
+        angles = self.fine_angles * scale
+        blocks = []
+        extended = postures[~contracted]
+        if len(extended):
+            blocks.append((self.move_back(extended, distances), False))
+            blocks.append((self.move_front(extended, short_distances), False))
+            blocks.append((self.move_head(extended, short_distances), False))
+            blocks.append((self.rotate_front(extended, angles), False))
+            blocks.append((self.rotate_head(extended, angles), False))
+        folded = postures[contracted]
+        if len(folded):
+            blocks.append((self.move_back_contracted(folded, distances), True))
+            blocks.append((self.move_head_contracted(folded, short_distances), True))
+            blocks.append((self.rotate_head_contracted(folded, [], angles), True))
+        postures = np.concatenate([b for b, _ in blocks])
+        contracted = np.concatenate([np.full(len(b), c, dtype=bool) for b, c in blocks])
+        return postures, contracted
 
-        return postures
+    def generate_postures(self):
+        """enumerates the possible postures, as a list of Posture objects"""
+        postures, contracted = self.generate_posture_array()
+        return [self.Posture(geometry.Point(p[self.HEAD]), geometry.Point(p[self.FRONT]), geometry.Point(p[self.BACK]),
+                             bool(c)) for p, c in zip(postures, contracted)]
 
     def find_closest_centroid(self, c):
         if c.ndim == 1:
@@ -301,6 +447,10 @@ class Animal:
         self.back_radius = back_radius
 
         self.contracted = False
+        self.motion_model = host.make_motion_model((self.head, self.front, self.back))
+        self.lost = False
+        self.has_posture = True  # whether the posture was searched in the last frame
+        self.orientation = None  # the orientation of the component of the animal, in the centroid tracking tier
 
     def get_position(self):
         border = self.host.config.skeletonization_border
@@ -311,129 +461,38 @@ class Animal:
         r.back = self.back.affine_r(self.host.scale_factor, border)
         r.contracted = self.contracted
         r.speed = self.speed
+        if self.motion_model is not None:
+            r.confidence = self.motion_model.confidence
         return r
 
-    # noinspection PyUnusedLocal
-    # @profile
-    def track(self, raw_matrix, animals, centroids, frame_time):
-        """tracking a single animal"""
-        # source is the original frame, raw_matrix the subtracted one
-
+    def move_to_centroid(self, centroid):
+        """follows the component assigned to the animal in this frame"""
         self.prev_centroid = self.centroid
-        logger.log(5, "centroids are " + str(centroids))
-        self.centroid = self.find_closest_centroid(centroids)
+        self.centroid = geometry.Point(np.asarray(centroid, dtype=float))
         self.speed = self.speed_alpha * self.speed + \
         (1. - self.speed_alpha) * (self.centroid - self.prev_centroid)
         logger.log(5, "speed is {}".format(np.linalg.norm(self.speed)))
-        matrix = raw_matrix.astype(np.float)
-        matrix = matrix - 100.
-        # matrix = matrix - thr
-        # matrix[matrix < 0] = -50
-
-        # setting up the alternative pos    tures
-        postures = self.generate_postures()
-        logger.log(5, "generated {} postures".format(len(postures)))
-        mask_size = 50
-        mask_half = mask_size / 2
-
-        mask = np.zeros((mask_size, mask_size), np.float)
-
-        best_posture = None
-        best_val = - 255 * mask_size * mask_size
-
-        hr = self.scaled_head_radius
-        fr = self.scaled_front_radius
-        br = self.scaled_back_radius
-
-        first = True
-        current_val = None
-
-        # find the optimal posture
-        for p in postures:
-
-            mask.fill(-1)
-            mask_center = geometry.Point(mask_half, mask_half)
-            animal_center = self.back
-
-            h = p.head - animal_center + mask_center
-            f = p.front - animal_center + mask_center
-            b = p.back - animal_center + mask_center
-
-            if not p.contracted:
-                head_p1 = geometry.point_along_a_perpendicular(f.x, f.y, h.x, h.y, h.x, h.y, hr)
-                head_p2 = geometry.point_along_a_perpendicular(f.x, f.y, h.x, h.y, h.x, h.y, -hr)
-
-                front_p1 = geometry.point_along_a_perpendicular(f.x, f.y, h.x, h.y, f.x, f.y, fr)
-                front_p2 = geometry.point_along_a_perpendicular(f.x, f.y, h.x, h.y, f.x, f.y, -fr)
+        if self.motion_model is not None:
+            self.motion_model.predict()
 
-                cv2.fillConvexPoly(mask,
-                                   np.array([list(head_p1), list(front_p1), list(front_p2), list(head_p2)], 'int32'), 1)
+    def predicted_centroid(self):
+        """where the centroid is expected in the next frame, for the identity assignment"""
+        return np.asarray(self.centroid, dtype=float) + np.asarray(self.speed, dtype=float)
 
-                front_p1 = geometry.point_along_a_perpendicular(f.x, f.y, b.x, b.y, f.x, f.y, fr)
-                front_p2 = geometry.point_along_a_perpendicular(f.x, f.y, b.x, b.y, f.x, f.y, -fr)
-                back_p1 = geometry.point_along_a_perpendicular(f.x, f.y, b.x, b.y, b.x, b.y, br)
-                back_p2 = geometry.point_along_a_perpendicular(f.x, f.y, b.x, b.y, b.x, b.y, -br)
-
-                cv2.fillConvexPoly(mask,
-                                   np.array([list(back_p1), list(front_p1), list(front_p2), list(back_p2)], 'int32'), 1)
-            else:
-                head_p1 = geometry.point_along_a_perpendicular(b.x, b.y, h.x, h.y, h.x, h.y, hr)
-                head_p2 = geometry.point_along_a_perpendicular(b.x, b.y, h.x, h.y, h.x, h.y, -hr)
-
-                front_p1 = geometry.point_along_a_perpendicular(b.x, b.y, h.x, h.y, b.x, b.y, br)
-                front_p2 = geometry.point_along_a_perpendicular(b.x, b.y, h.x, h.y, b.x, b.y, -br)
-
-                cv2.fillConvexPoly(mask,
-                                   np.array([list(head_p1), list(front_p1), list(front_p2), list(head_p2)], 'int32'), 1)
-
-            cv2.circle(mask, h.as_int_tuple(), hr, 1, -1)
-            cv2.circle(mask, f.as_int_tuple(), fr, 1, -1)
-            cv2.circle(mask, b.as_int_tuple(), br, 1, -1)
-
-            ac = animal_center
-            mh = int(mask_half)
-
-            try:
-                matrix_slice = matrix[max((int(ac.y) - mh), 0): int(ac.y) + mh, max(int(ac.x) - mh, 0):int(ac.x) + mh]
-                mask_start_r = 0
-                mask_start_c = 0
-                mask_end_r = mask.shape[0]
-                mask_end_c = mask.shape[1]
-                if int(ac.y) - mh < 0:
-                    mask_start_r = -(int(ac.y) - mh)
-                if int(ac.x) - mh < 0:
-                    mask_start_c = -(int(ac.x) - mh)
-                if int(ac.y) + mh > matrix.shape[0]:
-                    mask_end_r -= int(ac.y) + mh - matrix.shape[0]
-                if int(ac.x) + mh > matrix.shape[1]:
-                    mask_end_c -= int(ac.x) + mh - matrix.shape[1]
-                mask_slice = mask[mask_start_r:mask_end_r, mask_start_c:mask_end_c]
-
-                product = np.multiply(mask_slice, matrix_slice)
-                # product = np.multiply(mask, matrix[(int(ac.y) - mh): int(ac.y) + mh, int(ac.x) - mh:int(ac.x) + mh])
-
-                val = product.sum()
-            except ValueError:
-                logger.exception('tracker fault')
-                logger.info("ac = ({}, {}), mh = {}".format(ac.x, ac.y, mh))
-                logger.info(("matrix size = {}, {}".format(matrix.shape[0], matrix.shape[1])))
-                val = 0
-            if first:
-                current_val = val
-                first = False
-
-            if val > best_val:
-                best_posture = p
-                best_val = val
+    def update_posture(self, postures, contracted, vals):
+        """takes the best scoring of the candidate postures, returns the position data of the animal"""
+        best_ix = int(np.argmax(vals))
+        best_val = vals[best_ix]
+        current_val = vals[0]
 
         if best_val > current_val * 1.:
 
-            self.head = best_posture.head
-            self.front = best_posture.front
-            self.back = best_posture.back
+            self.head = geometry.Point(postures[best_ix, self.HEAD])
+            self.front = geometry.Point(postures[best_ix, self.FRONT])
+            self.back = geometry.Point(postures[best_ix, self.BACK])
 
             if self.contracted:
-                self.contracted = best_posture.contracted
+                self.contracted = bool(contracted[best_ix])
 
             # condition to transition to contracted
             if not self.contracted:
@@ -445,7 +504,14 @@ class Animal:
                     hd = geometry.distance_p(self.back, self.head)
                     self.head = geometry.point_along_a_line_p(self.back, self.head, hd - d)
 
-        rows, cols = raw_matrix.shape[:2]
+        if self.motion_model is not None:
+            self.motion_model.update((self.head, self.front, self.back))
+            lost = self.motion_model.confidence < self.host.motion_lost_confidence
+            if lost and not self.lost:
+                logger.warning("animal {} may be lost, the tracked postures do not follow the predicted motion "
+                               "(confidence {:.2f})".format(self.id, self.motion_model.confidence))
+            self.lost = lost
+        self.has_posture = True
 
         position_data = {'id': self.id, 'centroid_x': self.centroid[0], 'centroid_y':self.centroid[1],
                          'head_x': self.head[0], 'head_y': self.head[1],
@@ -454,6 +520,39 @@ class Animal:
 
         return position_data
 
+    def follow_centroid(self):
+        """moves the posture along with the centroid without searching it, returns the position data of the animal.
+
+        The posture only serves as the starting point of the search when it is needed again, and is left out of the
+        position data.
+        """
+        shift = (np.asarray(self.centroid, dtype=float) - np.asarray(self.prev_centroid, dtype=float)) * \
+            self.host.scale_factor
+        self.head = geometry.Point(np.asarray(self.head, dtype=float) + shift)
+        self.front = geometry.Point(np.asarray(self.front, dtype=float) + shift)
+        self.back = geometry.Point(np.asarray(self.back, dtype=float) + shift)
+        if self.motion_model is not None:
+            self.motion_model.reset((self.head, self.front, self.back))
+        self.has_posture = False
+        return {'id': self.id, 'centroid_x': self.centroid[0], 'centroid_y': self.centroid[1]}
+
+    # noinspection PyUnusedLocal
+    # @profile
+    def track(self, raw_matrix, animals, centroids, frame_time):
+        """tracking a single animal, on its closest centroid"""
+        # source is the original frame, raw_matrix the subtracted one
+        logger.log(5, "centroids are " + str(centroids))
+        self.move_to_centroid(self.find_closest_centroid(centroids))
+
+        # setting up the alternative postures
+        postures, contracted = self.generate_posture_array()
+        logger.log(5, "generated {} postures".format(len(postures)))
+
+        # find the optimal posture, scoring all the candidates at once against the matrix offset by -100, which is
+        # only computed within the scored window
+        vals = self.host.posture_scorer.score(raw_matrix, self.back, postures, contracted, offset=100.)
+        return self.update_posture(postures, contracted, vals)
+
 
 class TrackingFlowElement:
     """container for the results of the tracking operation."""
@@ -492,8 +591,6 @@ class Tracker:
 
     finished = False
 
-    animals = []  # the list of tracked animals
-
     # noinspection PyArgumentList
     def __init__(self, frame_size, config=Configuration()):
         self.scaled_head_radius = 5
@@ -502,7 +599,46 @@ class Tracker:
         self.component_threshold = 40
         self.speed_threshold = 1.2
         self.max_num_animals = 1
+        self.min_component_area = 20
+        self.roi_mode = False
+        self.roi_padding = 60
+        self.roi_full_frame_interval = 100
+        self.background_model_name = 'static'
+        self.background_update_interval = 10
+        self.background_alpha = 0.02
+        self.background_median_step = 1
+        self.background_mask_dilation = 10
+        self.background_check_frames = 5
+        self.background_check_threshold = 25
+        self.background_check_max_change = 0.05
+        self.gray_background = False
+        self.posture_search = 'exhaustive'
+        self.posture_search_keep = 2
+        self.posture_search_refinements = 3
+        self.motion_model = 'none'
+        self.motion_process_noise = 1.
+        self.motion_measurement_noise = 1.
+        self.motion_angle_process_noise = 0.01
+        self.motion_angle_measurement_noise = 0.01
+        self.motion_grid_sigmas = 2.
+        self.motion_lost_confidence = 0.5
+        self.tracking_tier = 'posture'
+        self.posture_zones = []
+        self.time_budget_ms = 0
+        self.time_budget_alpha = 0.1
+        self.time_budget_recover_fraction = 0.5
+        self.time_budget_hold_frames = 30
+        self.time_budget_max_tier = TimeBudget.SKIP_FRAMES
+        self.time_budget_skip_interval = 2
+        self.animals = []  # the list of tracked animals
         self.read_config()
+        self.time_budget = None
+        if self.time_budget_ms > 0:
+            self.time_budget = TimeBudget(self.time_budget_ms * 1.e-3, self.time_budget_alpha,
+                                          self.time_budget_recover_fraction, self.time_budget_hold_frames,
+                                          self.time_budget_max_tier, self.time_budget_skip_interval)
+        self.posture_scorer = PostureScorer(self.scaled_head_radius, self.scaled_front_radius,
+                                            self.scaled_back_radius)
 
         frame_width, frame_height = frame_size
         config.skeletonization_res_height = frame_height
@@ -515,7 +651,9 @@ class Tracker:
         config.vertebra_length = config.vertebra_length * self.scale_factor
         self.show_thresholded = False
 
-        self.background = None
+        self.background = None  # the current frame of the background model
+        self.background_model = make_background_model(self.background_model_name, self.background_update_interval,
+                                                      self.background_alpha, self.background_median_step)
         self.show_model = True
         self.show_posture = True
         self.image_scale_factor = 1
@@ -525,11 +663,86 @@ class Tracker:
         self.background_frames = 5
         self.background_countdown = 0
         self.background_buffer = None
+        self.windows = None  # the windows of the frame searched for the animals last
+        self.roi_searches = 0
+        self.full_frame_searches = 0
+        self._frames_since_full_search = 0
+        self._matrix = None
+        self._matrix_dirty = []
+        self.posture_evaluations = 0  # the number of candidate postures scored so far
+        self.posture_requested = False
+        self.orientations = None  # the orientations of the components, in the centroid tracking tier
+        self.background_cache = None
+        self._background_key_parts = None
+        self._background_checks_left = 0
+        self._background_changes = []
 
     def read_config(self):
         d = get_config_section("tracker")
         if "max_num_animals" in d:
             self.max_num_animals = d['max_num_animals']
+        if "min_component_area" in d:
+            self.min_component_area = d['min_component_area']
+        if "roi_mode" in d:
+            self.roi_mode = bool(d['roi_mode'])
+        if "roi_padding" in d:
+            self.roi_padding = d['roi_padding']
+        if "roi_full_frame_interval" in d:
+            self.roi_full_frame_interval = d['roi_full_frame_interval']
+        if "background_model" in d:
+            self.background_model_name = d['background_model']
+        if "background_update_interval" in d:
+            self.background_update_interval = d['background_update_interval']
+        if "background_alpha" in d:
+            self.background_alpha = d['background_alpha']
+        if "background_median_step" in d:
+            self.background_median_step = d['background_median_step']
+        if "background_mask_dilation" in d:
+            self.background_mask_dilation = d['background_mask_dilation']
+        if "gray_background" in d:
+            self.gray_background = bool(d['gray_background'])
+        if "posture_search" in d:
+            self.posture_search = d['posture_search']
+        if "posture_search_keep" in d:
+            self.posture_search_keep = d['posture_search_keep']
+        if "posture_search_refinements" in d:
+            self.posture_search_refinements = d['posture_search_refinements']
+        if "motion_model" in d:
+            self.motion_model = d['motion_model']
+        if "motion_process_noise" in d:
+            self.motion_process_noise = d['motion_process_noise']
+        if "motion_measurement_noise" in d:
+            self.motion_measurement_noise = d['motion_measurement_noise']
+        if "motion_angle_process_noise" in d:
+            self.motion_angle_process_noise = d['motion_angle_process_noise']
+        if "motion_angle_measurement_noise" in d:
+            self.motion_angle_measurement_noise = d['motion_angle_measurement_noise']
+        if "motion_grid_sigmas" in d:
+            self.motion_grid_sigmas = d['motion_grid_sigmas']
+        if "motion_lost_confidence" in d:
+            self.motion_lost_confidence = d['motion_lost_confidence']
+        if "tracking_tier" in d:
+            self.tracking_tier = d['tracking_tier']
+        if "posture_zones" in d:
+            self.set_posture_zones(d['posture_zones'])
+        if "time_budget_ms" in d:
+            self.time_budget_ms = d['time_budget_ms']
+        if "time_budget_alpha" in d:
+            self.time_budget_alpha = d['time_budget_alpha']
+        if "time_budget_recover_fraction" in d:
+            self.time_budget_recover_fraction = d['time_budget_recover_fraction']
+        if "time_budget_hold_frames" in d:
+            self.time_budget_hold_frames = d['time_budget_hold_frames']
+        if "time_budget_max_tier" in d:
+            self.time_budget_max_tier = d['time_budget_max_tier']
+        if "time_budget_skip_interval" in d:
+            self.time_budget_skip_interval = d['time_budget_skip_interval']
+        if "background_check_frames" in d:
+            self.background_check_frames = d['background_check_frames']
+        if "background_check_threshold" in d:
+            self.background_check_threshold = d['background_check_threshold']
+        if "background_check_max_change" in d:
+            self.background_check_max_change = d['background_check_max_change']
         if "component_threshold" in d:
             self.component_threshold = d['component_threshold']
         if "speed_threshold" in d:
@@ -545,6 +758,13 @@ class Tracker:
     def state(self):
         return self._state
 
+    @property
+    def load_tier(self):
+        """how much work is shed to keep within the time budget, see TimeBudget"""
+        if self.time_budget is None:
+            return TimeBudget.FULL
+        return self.time_budget.tier
+
     @state.setter
     def state(self, s):
         self._state = s
@@ -580,18 +800,83 @@ class Tracker:
 
     # noinspection PyAttributeOutsideInit
     def set_background(self, frame):
-        """calculate background from the frames before the video stream ends, by averaging """
-        bg = frame.astype(np.uint8)
-        self.background = bg
+        """starts the background model from the frame"""
+        if self.gray_background and frame.ndim == 3:
+            frame = cv2.cvtColor(np.asarray(frame, dtype=np.uint8), cv2.COLOR_BGR2GRAY)
+        self.background_model.reset(frame)
+        self.background = self.background_model.background
         self.state = self.State.READY
 
+    def set_background_cache(self, cache, source, rotate_angle=0, mirrored=False):
+        """backgrounds are loaded from and saved to the cache, under a key with these settings and the frame size"""
+        self.background_cache = cache
+        self._background_key_parts = (source, rotate_angle, mirrored)
+
+    def background_key(self, frame_shape):
+        return BackgroundCache.make_key(*(self._background_key_parts + (frame_shape,)))
+
+    def save_background(self):
+        if self.background_cache is None or self.background is None:
+            return
+        self.background_cache.save(self.background_key(self.background.shape), self.background)
+
+    def begin_trial(self):
+        """the background is checked against the first frames of the trial, loading it from the cache if needed"""
+        self._background_checks_left = self.background_check_frames
+        self._background_changes = []
+        if self.time_budget is not None and self.time_budget.tier_frames:
+            tiers = sorted(self.time_budget.tier_frames.items())
+            logger.info("frames tracked in each load tier: {}".format(
+                ", ".join("{}: {}".format(TimeBudget.tier_labels[t], n) for t, n in tiers)))
+            self.time_budget.tier_frames = {}
+
+    def check_background(self, frame):
+        """grabs a new background if the current one does not match the first frames of the trial any more"""
+        if self.background is None and self.background_cache is not None:
+            shape = frame.shape[:2] if self.gray_background else frame.shape
+            background = self.background_cache.load(self.background_key(shape), shape)
+            if background is not None:
+                self.set_background(background)
+        if self.background is None:
+            self._background_checks_left = 0
+            return
+        self._background_changes.append(background_change(self.background, frame, self.background_check_threshold))
+        self._background_checks_left -= 1
+        if self._background_checks_left == 0:
+            change = float(np.median(self._background_changes))
+            if change > self.background_check_max_change:
+                logger.info("background differs from the frames on {:.1%} of the frame, grabbing a new one".format(
+                    change))
+                # whatever was found against the old background can't be trusted
+                self.delete_all_animals()
+                self.grab_background()
+            else:
+                logger.debug("background differs from the frames on {:.1%} of the frame".format(change))
+
+    def update_background(self, frame):
+        """lets the background model follow slow changes in the scene, away from the tracked animals"""
+        if self.state != self.State.TRACKING or not self.background_model.due():
+            return
+        border = self.config.skeletonization_border
+        animal_mask = self._matrix[border:-border, border:-border]
+        d = int(self.background_mask_dilation)
+        if d > 0:
+            animal_mask = cv2.dilate(animal_mask, cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (2 * d + 1, 2 * d + 1)))
+        if self.background.ndim == 2:
+            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        self.background_model.update(frame, animal_mask)
+
     def add_animal_auto(self):
-        if self.state == self.State.INACTIVE:
+        """adds an animal on each of the components no animal is tracking yet, largest first"""
+        if self.state == self.State.INACTIVE or self.centroids is None:
             return
-        # TODO now only for one animal
-        x = self.centroids[0, 0]
-        y = self.centroids[0, 1]
-        self.add_animal(x-10, y, x+10, y)
+        free = np.ones(len(self.centroids), bool)
+        if self.animals:
+            free[assign_identities([a.predicted_centroid() for a in self.animals], self.centroids)] = False
+        for x, y in self.centroids[free]:
+            if len(self.animals) >= self.max_num_animals:
+                break
+            self.add_animal(x-10, y, x+10, y)
 
     def add_animal(self, start_x, start_y, end_x, end_y, config=Animal.Configuration()):
         """add an animal to the list of animals"""
@@ -611,25 +896,228 @@ class Tracker:
         """delete all tracked animals from the list"""
         self.animals = []
         self.state = self.State.READY
-        self.tracker_controller.set_tracked_animals_number(len(self.animals))
+        if self.tracker_controller:
+            self.tracker_controller.set_tracked_animals_number(len(self.animals))
 
     # noinspection PyUnusedLocal
     def track_animals(self, matrix, frame_time):
-        """loop over animals and call the tracker in the animal class"""
-        position_data = []
+        """assigns the components to the animals, and finds the posture of all the animals in one scoring pass.
 
-        for a in self.animals:
-            position_data.append(a.track(matrix, self.animals, self.centroids, frame_time))
-
-        return position_data
+        The components are matched one to one to the animals, by their distance to where each animal was expected
+        to be, so that the identities are kept when the animals cross paths.
+        """
+        if not self.animals:
+            return []
+        assigned = assign_identities([a.predicted_centroid() for a in self.animals], self.centroids)
+        for a, ix in zip(self.animals, assigned):
+            a.move_to_centroid(self.centroids[ix])
+
+        if self.tracking_tier == 'posture':
+            postures, contracted, vals = self.search_postures(matrix)
+            position_data = []
+            for a, p, c, v in zip(self.animals, postures, contracted, vals):
+                position_data.append(a.update_posture(p, c, v))
+            return position_data
+        if self.tracking_tier != 'centroid':
+            raise ValueError("Unknown tracking tier {}".format(self.tracking_tier))
+
+        posed = [a for a in self.animals if self.needs_posture(a)]
+        position_data = {}
+        if posed:
+            postures, contracted, vals = self.search_postures(matrix, animals=posed)
+            for a, p, c, v in zip(posed, postures, contracted, vals):
+                position_data[a.id] = a.update_posture(p, c, v)
+        for a, ix in zip(self.animals, assigned):
+            if a.id not in position_data:
+                position_data[a.id] = a.follow_centroid()
+            a.orientation = self.orientations[ix]
+            position_data[a.id]['orientation'] = a.orientation
+        return [position_data[a.id] for a in self.animals]
+
+    def set_posture_zones(self, zones):
+        """the zones where the posture of the animals is searched in the centroid tracking tier.
+
+        Each zone is a circle given as (x, y, radius), in frame pixels, e.g. around an object.
+        """
+        self.posture_zones = [tuple(float(v) for v in z) for z in zones]
+
+    def request_posture(self, requested=True):
+        """searches the posture of all the animals in the centroid tracking tier, until requested again with False"""
+        self.posture_requested = bool(requested)
+
+    def needs_posture(self, animal):
+        if self.tracking_tier == 'posture' or self.posture_requested:
+            return True
+        x, y = animal.centroid[0], animal.centroid[1]
+        return any((x - zx) ** 2 + (y - zy) ** 2 <= r ** 2 for zx, zy, r in self.posture_zones)
+
+    def make_motion_model(self, posture):
+        """the motion model of a new animal, starting from posture, or None if the postures are not predicted"""
+        if self.motion_model == 'kalman':
+            return PostureMotionModel(posture, self.motion_process_noise, self.motion_measurement_noise,
+                                      self.motion_angle_process_noise, self.motion_angle_measurement_noise)
+        if self.motion_model != 'none':
+            raise ValueError("Unknown motion model {}".format(self.motion_model))
+        return None
+
+    def search_posture_grids(self, matrix, centers, animals):
+        """the first step of the coarse to fine search with postures_two_steps, on the dense grid of the moves times
+        the rotations of generate_posture_array.
+
+        The moves alone are scored first. Then, around the current posture and the posture_search_keep best
+        candidates so far, all the rotations of their move, their rotation of all the moves, and the next rotations of
+        the next moves on the grid, until no other candidate would be scored. The best candidate is then at least as
+        good as all its neighbours on the grid.
+        Returns the candidate postures, contracted flags and scores of each animal, as lists of the rounds.
+        """
+        grids = [a.generate_posture_array(return_steps=True) for a in animals]
+        postures = [[] for _ in animals]
+        contracted = [[] for _ in animals]
+        vals = [[] for _ in animals]
+        scores = [np.full(len(p), -np.inf) for p, _, _ in grids]
+        # the current posture is expanded along with the moves alone
+        expanded = [np.zeros(1, dtype=int) for _ in animals]
+        new = [(steps[1] < 0) | a.posture_grid_neighbours(p, steps, 0) for a, (p, _, steps) in zip(animals, grids)]
+        done = [n.copy() for n in new]
+        while any(n.any() for n in new):
+            batch = [(p[n], c[n]) for (p, c, _), n in zip(grids, new)]
+            batch_vals = self.posture_scorer.score_many(matrix, centers, [p for p, _ in batch], [c for _, c in batch],
+                                                        offset=100.)
+            for i, (p, c), v in zip(range(len(animals)), batch, batch_vals):
+                postures[i].append(p)
+                contracted[i].append(c)
+                vals[i].append(v)
+                scores[i][new[i]] = v
+            for i, (a, (p, _, steps)) in enumerate(zip(animals, grids)):
+                top = np.setdiff1d(np.argsort(scores[i])[::-1][:self.posture_search_keep], expanded[i])
+                expanded[i] = np.union1d(expanded[i], top)
+                n = np.zeros(len(p), dtype=bool)
+                for t in top:
+                    n |= a.posture_grid_neighbours(p, steps, t)
+                new[i] = n & ~done[i]
+                done[i] |= new[i]
+        return postures, contracted, vals
+
+    def search_postures(self, matrix, mode=None, animals=None):
+        """the candidate postures of each animal (of all of them by default), their contracted flags and their scores.
+
+        The exhaustive search scores the dense grid of moves from the current posture of each animal. The coarse to
+        fine search scores a sparse grid and the nearest moves on the dense grid first, or with postures_two_steps
+        searches the dense grid as in search_posture_grids. Then come small steps around the posture_search_keep best
+        candidates found so far, for up to posture_search_refinements rounds, halving the steps at each round and
+        stopping early for the animals whose best score did not improve once the steps are those of the dense grid.
+        The candidates of all the animals are scored in one pass at each round.
+
+        In the fewer candidates tier of the time budget, the dense grid is searched as in search_posture_grids with
+        postures_two_steps, which scores far fewer candidates than all of it, without refinement. Otherwise the
+        exhaustive search is cheaper than the coarse to fine one, and scores narrower grids.
+        """
+        refinements = self.posture_search_refinements
+        narrow = False
+        if mode is None:
+            mode = self.posture_search
+            if self.load_tier >= TimeBudget.FEWER_CANDIDATES:
+                if self.postures_two_steps:
+                    mode = 'coarse_to_fine'
+                    refinements = 0
+                else:
+                    mode = 'exhaustive'
+                    narrow = True
+        if animals is None:
+            animals = self.animals
+        # the matrix is only converted and offset by -100 within the scoring windows
+        centers = [a.back for a in animals]
+        first_level = 0
+        if mode == 'coarse_to_fine' and self.postures_two_steps:
+            postures, contracted, vals = self.search_posture_grids(matrix, centers, animals)
+            # the grid has been searched already, the refinement only takes smaller steps
+            first_level = Animal.dense_level
+        else:
+            candidates = [a.generate_posture_array(narrow=narrow) if mode == 'exhaustive'
+                          else a.generate_coarse_posture_array() for a in animals]
+            postures = [[p] for p, _ in candidates]
+            contracted = [[c] for _, c in candidates]
+            vals = [[v] for v in self.posture_scorer.score_many(matrix, centers, [p for p, _ in candidates],
+                                                                 [c for _, c in candidates], offset=100.)]
+        if mode == 'coarse_to_fine':
+            best = [max(v.max() for v in vi if len(v)) for vi in vals]
+            active = list(range(len(animals)))
+            for level in range(first_level, refinements):
+                if not active:
+                    break
+                refined = []
+                for i in active:
+                    # the best candidates found so far, in any round
+                    all_vals = np.concatenate(vals[i])
+                    top = np.argsort(all_vals)[::-1][:self.posture_search_keep]
+                    refined.append(animals[i].generate_refined_posture_array(np.concatenate(postures[i])[top],
+                                                                             np.concatenate(contracted[i])[top],
+                                                                             level))
+                refined_vals = self.posture_scorer.score_many(matrix, [centers[i] for i in active],
+                                                              [p for p, _ in refined], [c for _, c in refined],
+                                                              offset=100.)
+                still_active = []
+                for i, (p, c), v in zip(active, refined, refined_vals):
+                    postures[i].append(p)
+                    contracted[i].append(c)
+                    vals[i].append(v)
+                    if len(v) and v.max() > best[i]:
+                        best[i] = v.max()
+                        still_active.append(i)
+                    elif level < animals[i].dense_level:
+                        # the steps are still larger than those of the dense grid, whose optimum may be in between
+                        still_active.append(i)
+                active = still_active
+        elif mode != 'exhaustive':
+            raise ValueError("Unknown posture search {}".format(mode))
+
+        postures = [np.concatenate(p) for p in postures]
+        contracted = [np.concatenate(c) for c in contracted]
+        vals = [np.concatenate(v) for v in vals]
+        n_evaluations = sum(len(p) for p in postures)
+        self.posture_evaluations += n_evaluations
+        logger.log(5, "scored {} postures".format(n_evaluations))
+        return postures, contracted, vals
 
     def grab_background(self):
         self.background_countdown = self.background_frames
         self.state = self.State.ACQUIRING_BG
 
     def track(self, frame, frame_time=0):
+        """track one frame, shedding work if it takes longer than the time budget.
+
+        With a time budget, the position data also have the load tier the frame was tracked in, and whether the
+        positions were only predicted, the frame being skipped.
+        """
+        if self.time_budget is None:
+            return self.track_frame(frame, frame_time)
+        tier = self.time_budget.tier
+        t0 = time.perf_counter()
+        if self.time_budget.skip_frame() and self.state == self.State.TRACKING and self.background_countdown == 0:
+            position_data = self.skip_frame()
+            interpolated = True
+        else:
+            position_data = self.track_frame(frame, frame_time)
+            interpolated = False
+        self.time_budget.add(time.perf_counter() - t0)
+        for p in position_data or []:
+            p['load_tier'] = tier
+            p['interpolated'] = interpolated
+        return position_data
+
+    def skip_frame(self):
+        """moves the animals as predicted from their motion, without looking at the frame"""
+        position_data = []
+        for a in self.animals:
+            a.move_to_centroid(a.predicted_centroid())
+            position_data.append(a.follow_centroid())
+        return position_data
+
+    def track_frame(self, frame, frame_time=0):
         """track one frame"""
         logger.log(5, "start tracking {} animals".format(len(self.animals)))
+        if self._background_checks_left > 0 and self.background_countdown == 0:
+            self.check_background(frame)
         if self.background_countdown > 0:
             if self.background_buffer is None:
                 self.background_buffer = np.zeros((self.config.skeletonization_res_height,
@@ -639,59 +1127,173 @@ class Tracker:
             self.background_countdown -= 1
             self.background_buffer[:, :, :, self.background_countdown] = frame
             if self.background_countdown == 0:
-                bg = np.median(self.background_buffer, axis=3)
+                bg = median_frame(self.background_buffer)
                 self.set_background(bg)
                 self.background_buffer = None
+                self.save_background()
 
         if self.background is None:
             return
 
-        frame_gr = cv2.absdiff(frame, self.background)  # take the absolute difference
-        frame_gr = cv2.cvtColor(frame_gr, cv2.COLOR_BGR2GRAY)  # convert to grayscale
-        cv2.normalize(frame_gr, frame_gr, 0, 255, cv2.NORM_MINMAX)  # normalize so that the minimum is zero
-
-        frame_gr1 = frame_gr.copy()
-
-        thr, _ = cv2.threshold(frame_gr, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
-        ret, frame_gr = cv2.threshold(frame_gr, thr + self.component_threshold, 254, cv2.THRESH_BINARY)
-
-        nb_components, output, stats, centroids = cv2.connectedComponentsWithStats(frame_gr, connectivity=8)
-        sizes = stats[1:, -1]
-        max_comp = np.argmax(sizes)
-        frame_gr_resized = np.zeros(frame_gr.shape, np.uint8)
-        frame_gr_resized[output == max_comp + 1] = 255
-        self.centroids = centroids[max_comp + 1, :]
-        if self.centroids.ndim == 1:
-            self.centroids = self.centroids[np.newaxis, :]
-        frame_mask = frame_gr_resized.copy()
-        frame_mask = cv2.normalize(frame_gr_resized, frame_mask, 0, 1, cv2.NORM_MINMAX)
-        frame_gr_resized = cv2.multiply(frame_mask, frame_gr1)
-        # except ValueError:
-        #     print(np.min(frame_gr.astype(np.int8)), np.max(frame_gr.astype(np.int8)))
-        # frame_gr_resized = frame_gr_resized.astype(np.uint8)
-        cv2.normalize(frame_gr_resized, frame_gr_resized, 0, 255, cv2.NORM_MINMAX)
-
-        # add borders to the frame, fill with zeros
         border = self.config.skeletonization_border
-        frame_gr_resized = cv2.copyMakeBorder(frame_gr_resized, border, border, border, border, cv2.BORDER_CONSTANT, 0)
-
-        position_data = self.track_animals(frame_gr_resized, frame_time)
-
-        frame_display = frame_gr_resized[border:-border, border:-border]
-
-        frame_display = cv2.cvtColor(frame_display, cv2.COLOR_GRAY2BGR)
-        # frame_alpha = frame_display
-        # foreground = cv2.multiply(frame_alpha, frame_display)
-        # background = cv2.multiply((1 - frame_alpha), frame)
-        #
-        # frame_display = cv2.add(foreground, background)
+        windows = self.roi_windows(frame.shape)
+        found = None
+        if windows:
+            found = self.find_components(frame, windows)
+            if found is None:
+                logger.log(5, "animals lost in the ROI windows, searching the full frame")
+            else:
+                self.roi_searches += 1
+        if found is None:
+            windows = [(0, 0, frame.shape[1], frame.shape[0])]
+            found = self.find_components(frame, windows, check_edges=False)
+            self.full_frame_searches += 1
+            self._frames_since_full_search = 0
+        else:
+            self._frames_since_full_search += 1
+        if found is None:
+            return  # nothing in the foreground
+        self.centroids, foregrounds = found
+        self.windows = windows
+
+        # the foreground, with borders filled with zeros, in a buffer of which only the parts written last time
+        # need clearing
+        matrix_shape = (frame.shape[0] + 2 * border, frame.shape[1] + 2 * border)
+        if self._matrix is None or self._matrix.shape != matrix_shape:
+            self._matrix = np.zeros(matrix_shape, np.uint8)
+            self._matrix_dirty = []
+        for rows, cols in self._matrix_dirty:
+            self._matrix[rows, cols] = 0
+        self._matrix_dirty = []
+        for (x0, y0, x1, y1), foreground in zip(windows, foregrounds):
+            rows = slice(y0 + border, y1 + border)
+            cols = slice(x0 + border, x1 + border)
+            self._matrix[rows, cols] = foreground
+            self._matrix_dirty.append((rows, cols))
+
+        position_data = self.track_animals(self._matrix, frame_time)
+        self.update_background(frame)
+
+        if self.load_tier >= TimeBudget.NO_OVERLAY:
+            return position_data
         if self.show_thresholded:
-            frame[:] = frame_display
+            frame_display = self._matrix[border:-border, border:-border]
+            video_overlay.replace(frame, cv2.cvtColor(frame_display, cv2.COLOR_GRAY2BGR))
         for ix in range(self.centroids.shape[0]):
-            cv2.circle(frame, tuple(self.centroids[ix, :].astype(np.uint16)), 2, (0, 0, 255))
+            video_overlay.circle(frame, tuple(self.centroids[ix, :].astype(np.uint16)), 2, (0, 0, 255))
         self.draw_animals(frame)
         return position_data
 
+    def roi_windows(self, frame_shape):
+        """the (x0, y0, x1, y1) windows to search for the animals in this frame, or None for the full frame.
+
+        In ROI mode, once all the animals are tracked, the windows are boxes around the predicted positions of the
+        animals, padded by roi_padding and merged where they overlap. The full frame is searched again every
+        roi_full_frame_interval frames.
+        """
+        roi_only = self.load_tier >= TimeBudget.ROI_ONLY
+        if not (self.roi_mode or roi_only) or not self.animals or len(self.animals) < self.max_num_animals:
+            return None
+        if self._frames_since_full_search >= self.roi_full_frame_interval and not roi_only:
+            return None
+        height, width = frame_shape[:2]
+        pad = self.roi_padding
+        windows = []
+        for a in self.animals:
+            x, y = a.predicted_centroid()
+            windows.append([max(int(x) - pad, 0), max(int(y) - pad, 0),
+                            min(int(x) + pad + 1, width), min(int(y) + pad + 1, height)])
+        merged = True
+        while merged:
+            merged = False
+            for i in range(len(windows)):
+                for j in range(i + 1, len(windows)):
+                    wi, wj = windows[i], windows[j]
+                    if wi[0] < wj[2] and wj[0] < wi[2] and wi[1] < wj[3] and wj[1] < wi[3]:
+                        windows[i] = [min(wi[0], wj[0]), min(wi[1], wj[1]), max(wi[2], wj[2]), max(wi[3], wj[3])]
+                        del windows[j]
+                        merged = True
+                        break
+                if merged:
+                    break
+        windows = [tuple(w) for w in windows if w[2] > w[0] and w[3] > w[1]]
+        if not windows:
+            return None
+        return windows
+
+    def find_components(self, frame, windows, check_edges=True):
+        """the centroids of the animal components in the windows of the frame, and the foreground of each window.
+
+        The foreground is the difference from the background, normalized, within the largest components only, one
+        per animal. Apart from the largest, they must not be too small to be animals. Returns None if no component
+        is found, or if check_edges and a component touches the edge of a window inside the frame, so that it may
+        not be seen whole.
+
+        In the centroid tracking tier, the orientations of the components kept are left in self.orientations, in
+        degrees: the angle of their major axis from the x axis of the frame, between -90 and 90, going clockwise as the
+        y axis points down.
+        """
+        height, width = frame.shape[:2]
+        found = []
+        for wi, (x0, y0, x1, y1) in enumerate(windows):
+            if self.background.ndim == 2:
+                # grayscale background: the frame is converted first, and the difference taken on one channel
+                frame_gr = cv2.cvtColor(frame[y0:y1, x0:x1], cv2.COLOR_BGR2GRAY)
+                cv2.absdiff(frame_gr, self.background[y0:y1, x0:x1], dst=frame_gr)
+            else:
+                frame_gr = cv2.absdiff(frame[y0:y1, x0:x1], self.background[y0:y1, x0:x1])  # absolute difference
+                frame_gr = cv2.cvtColor(frame_gr, cv2.COLOR_BGR2GRAY)  # convert to grayscale
+            cv2.normalize(frame_gr, frame_gr, 0, 255, cv2.NORM_MINMAX)  # normalize so that the minimum is zero
+
+            thr, _ = cv2.threshold(frame_gr, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+            ret, frame_th = cv2.threshold(frame_gr, thr + self.component_threshold, 254, cv2.THRESH_BINARY)
+
+            nb_components, output, stats, centroids = cv2.connectedComponentsWithStats(frame_th, connectivity=8)
+            found.append((frame_gr, output, stats[1:], centroids[1:] + (x0, y0)))
+        sizes = np.concatenate([f[2][:, cv2.CC_STAT_AREA] for f in found])
+        if len(sizes) == 0:
+            return None
+        window_ix = np.concatenate([np.full(len(f[2]), wi) for wi, f in enumerate(found)])
+        label = np.concatenate([np.arange(1, len(f[2]) + 1) for f in found])
+        largest = np.argsort(-sizes, kind='stable')[:self.max_num_animals]
+        largest = largest[(sizes[largest] >= self.min_component_area) | (np.arange(len(largest)) == 0)]
+
+        with_orientations = self.tracking_tier == 'centroid'
+        orientations = np.zeros(len(largest))
+        foregrounds = []
+        for wi, (frame_gr, output, stats, centroids) in enumerate(found):
+            kept = np.flatnonzero(window_ix[largest] == wi)
+            labels = label[largest[kept]]
+            if check_edges and len(labels):
+                x0, y0, x1, y1 = windows[wi]
+                left = stats[labels - 1, cv2.CC_STAT_LEFT]
+                top = stats[labels - 1, cv2.CC_STAT_TOP]
+                right = left + stats[labels - 1, cv2.CC_STAT_WIDTH]
+                bottom = top + stats[labels - 1, cv2.CC_STAT_HEIGHT]
+                if np.any(((left == 0) & (x0 > 0)) | ((top == 0) & (y0 > 0)) |
+                          ((right == x1 - x0) & (x1 < width)) | ((bottom == y1 - y0) & (y1 < height))):
+                    return None
+            # the difference on the components kept, and 0 elsewhere. Only the bounding boxes of the components are
+            # looked at, rather than the whole (int32) label image
+            frame_gr_resized = np.zeros_like(frame_gr)
+            for k, lb in zip(kept, labels):
+                x, y, w, h = stats[lb - 1, :4]
+                box = (slice(y, y + h), slice(x, x + w))
+                mask = output[box] == lb
+                np.copyto(frame_gr_resized[box], frame_gr[box], where=mask)
+                if with_orientations:
+                    m = cv2.moments(mask.view(np.uint8), binaryImage=True)
+                    orientations[k] = math.degrees(0.5 * math.atan2(2. * m['mu11'], m['mu20'] - m['mu02']))
+            cv2.normalize(frame_gr_resized, frame_gr_resized, 0, 255, cv2.NORM_MINMAX)
+            foregrounds.append(frame_gr_resized)
+        if check_edges and len(largest) < len(self.animals) and len(windows) > 1:
+            # a window has lost its animal: merged animals would have shared a window
+            return None
+        centroids = np.concatenate([f[3] for f in found])[largest]
+        if with_orientations:
+            self.orientations = orientations
+        return centroids, foregrounds
+
     def project(self, pos):
         r = geometry.Point(pos.x * self.image_scale_factor, pos.y * self.image_scale_factor)
         return r
@@ -718,6 +1320,17 @@ class Tracker:
             a = ap[0]
             p = ap[1]
 
+            if not a.has_posture:
+                # centroid tier: the axis of the component, through its centroid
+                if a.orientation is not None and (self.show_model or self.show_posture):
+                    c = self.project(a.centroid)
+                    r = self.scaled_radius(a.scaled_max_body_length / 2 / self.scale_factor)
+                    t = math.radians(a.orientation)
+                    d = np.array([math.cos(t), math.sin(t)]) * r
+                    video_overlay.line(frame, (int(c.x - d[0]), int(c.y - d[1])), (int(c.x + d[0]), int(c.y + d[1])),
+                                       white)
+                continue
+
             if self.show_model:
 
                 ph = self.project(p.head)
@@ -728,10 +1341,10 @@ class Tracker:
                 fr = self.scaled_radius(a.front_radius)
                 br = self.scaled_radius(a.back_radius)
 
-                cv2.circle(frame, pb.as_int_tuple(), int(br), white)
+                video_overlay.circle(frame, pb.as_int_tuple(), int(br), white)
                 if not p.contracted:
-                    cv2.circle(frame, pf.as_int_tuple(), int(fr), white)
-                cv2.circle(frame, ph.as_int_tuple(), int(hr), white)
+                    video_overlay.circle(frame, pf.as_int_tuple(), int(fr), white)
+                video_overlay.circle(frame, ph.as_int_tuple(), int(hr), white)
 
             if self.show_posture:
 
@@ -751,12 +1364,12 @@ class Tracker:
                     h = geometry.point_along_a_line(fc.x, fc.y, hc.x, hc.y, fhd + hr)
                     b = geometry.point_along_a_line(fc.x, fc.y, bc.x, bc.y, fbd + br)
 
-                    cv2.line(frame, (int(b[0]), int(b[1])),
-                             (int(fc.x), int(fc.y)), white)
-                    cv2.line(frame, (int(fc.x), int(fc.y)),
-                             (int(h[0]), int(h[1])), white)
+                    video_overlay.line(frame, (int(b[0]), int(b[1])),
+                                       (int(fc.x), int(fc.y)), white)
+                    video_overlay.line(frame, (int(fc.x), int(fc.y)),
+                                       (int(h[0]), int(h[1])), white)
 
-                    cv2.circle(frame, (int(fc.x), int(fc.y)), 2, green)
+                    video_overlay.circle(frame, (int(fc.x), int(fc.y)), 2, green)
 
                     ahd = fhd - 4
                     if ahd < 0:
@@ -768,17 +1381,17 @@ class Tracker:
                     arrow_line2 = geometry.point_along_a_perpendicular(fc.x, fc.y, hc.x, hc.y,
                                                                        arrow_head[0], arrow_head[1], -3)
 
-                    cv2.line(frame, (int(h[0]), int(h[1])),
-                             (int(arrow_line1[0]), int(arrow_line1[1])), white)
-                    cv2.line(frame, (int(h[0]), int(h[1])),
-                             (int(arrow_line2[0]), int(arrow_line2[1])), white)
+                    video_overlay.line(frame, (int(h[0]), int(h[1])),
+                                       (int(arrow_line1[0]), int(arrow_line1[1])), white)
+                    video_overlay.line(frame, (int(h[0]), int(h[1])),
+                                       (int(arrow_line2[0]), int(arrow_line2[1])), white)
                 else:
 
                     hbd = geometry.distance(hc.x, hc.y, bc.x, bc.y)
                     h = geometry.point_along_a_line(bc.x, bc.y, hc.x, hc.y, hbd + hr)
                     b = geometry.point_along_a_line(hc.x, hc.y, bc.x, bc.y, hbd + br)
-                    cv2.line(frame, (int(b[0]), int(b[1])),
-                             (int(h[0]), int(h[1])), white)
+                    video_overlay.line(frame, (int(b[0]), int(b[1])),
+                                       (int(h[0]), int(h[1])), white)
                     ahd = hbd - 4
                     if ahd < 0:
                         ahd = 0
@@ -788,8 +1401,8 @@ class Tracker:
                     arrow_line2 = geometry.point_along_a_perpendicular(bc.x, bc.y, hc.x, hc.y,
                                                                        arrow_head[0], arrow_head[1], -3)
 
-                    cv2.line(frame, (int(h[0]), int(h[1])),
-                             (int(arrow_line1[0]), int(arrow_line1[1])), white)
-                    cv2.line(frame, (int(h[0]), int(h[1])),
-                             (int(arrow_line2[0]), int(arrow_line2[1])), white)
+                    video_overlay.line(frame, (int(h[0]), int(h[1])),
+                                       (int(arrow_line1[0]), int(arrow_line1[1])), white)
+                    video_overlay.line(frame, (int(h[0]), int(h[1])),
+                                       (int(arrow_line2[0]), int(arrow_line2[1])), white)
         logger.log(5, "finished drawing animals")
@@ -53,6 +53,12 @@ class Ui_TrackerControl(object):
         self.showThreshCheckBox.setFont(font)
         self.showThreshCheckBox.setObjectName("showThreshCheckBox")
         self.horizontalLayout_2.addWidget(self.showThreshCheckBox)
+        self.postureCheckBox = QtWidgets.QCheckBox(self.widget_2)
+        font = QtGui.QFont()
+        font.setPointSize(10)
+        self.postureCheckBox.setFont(font)
+        self.postureCheckBox.setObjectName("postureCheckBox")
+        self.horizontalLayout_2.addWidget(self.postureCheckBox)
         self.groupBox_2 = QtWidgets.QGroupBox(self.widget_2)
         self.groupBox_2.setMaximumSize(QtCore.QSize(16777215, 52))
         self.groupBox_2.setObjectName("groupBox_2")
@@ -129,6 +135,7 @@ class Ui_TrackerControl(object):
         self.initButton.setText(_translate("TrackerControl", "Init Anim."))
         self.resetButton.setText(_translate("TrackerControl", "Reset Anim."))
         self.showThreshCheckBox.setText(_translate("TrackerControl", "Show Thresh."))
+        self.postureCheckBox.setText(_translate("TrackerControl", "Posture"))
         self.groupBox_2.setTitle(_translate("TrackerControl", "Threshold"))
         self.groupBox_3.setTitle(_translate("TrackerControl", "Speed thresh. flips"))
         self.groupBox_4.setTitle(_translate("TrackerControl", "Tracking State"))
@@ -12,6 +12,9 @@ class TrackerController(QtCore.QObject):
         self.widget = TrackerControlWidget()
 
         self.widget.ui.showThreshCheckBox.setChecked(self.tracker.show_thresholded)
+        self.widget.ui.postureCheckBox.setChecked(self.tracker.posture_requested)
+        # the posture is always searched in the posture tracking tier
+        self.widget.ui.postureCheckBox.setEnabled(self.tracker.tracking_tier == 'centroid')
         self.widget.ui.thresholdSpinBox.setValue(self.tracker.component_threshold)
         self.widget.ui.speedSpinBox.setValue(self.tracker.speed_threshold)
         self.widget.ui.animalsLabel.setText('0/{}'.format(self.tracker.max_num_animals))
@@ -23,6 +26,7 @@ class TrackerController(QtCore.QObject):
         self.widget.ui.resetButton.clicked.connect(self.reset_animals)
         self.widget.ui.resetButton.setEnabled(False)
         self.widget.ui.showThreshCheckBox.toggled.connect(self.show_thresh_changed)
+        self.widget.ui.postureCheckBox.toggled.connect(self.posture_changed)
         self.widget.ui.thresholdSpinBox.valueChanged.connect(self.set_tracker_threshold)
         self.widget.ui.speedSpinBox.valueChanged.connect(self.set_speed_threshold)
 
@@ -51,6 +55,10 @@ class TrackerController(QtCore.QObject):
     def show_thresh_changed(self, val):
         self.tracker.show_thresholded = val
 
+    @QtCore.pyqtSlot(bool)
+    def posture_changed(self, val):
+        self.tracker.request_posture(val)
+
     @QtCore.pyqtSlot(float)
     def set_tracker_threshold(self, val):
         self.tracker.component_threshold = val
@@ -116,6 +116,18 @@ class Ui_VideoControlWidget(object):
         self.frameLabel.setObjectName("frameLabel")
         self.verticalLayout_4.addWidget(self.frameLabel)
         self.gridLayout.addWidget(self.groupBox_5, 2, 1, 1, 1)
+        self.groupBox_6 = QtWidgets.QGroupBox(self.groupBox)
+        self.groupBox_6.setObjectName("groupBox_6")
+        self.verticalLayout_5 = QtWidgets.QVBoxLayout(self.groupBox_6)
+        self.verticalLayout_5.setContentsMargins(-1, 2, -1, 2)
+        self.verticalLayout_5.setObjectName("verticalLayout_5")
+        self.cacheLabel = QtWidgets.QLabel(self.groupBox_6)
+        font = QtGui.QFont()
+        font.setPointSize(10)
+        self.cacheLabel.setFont(font)
+        self.cacheLabel.setObjectName("cacheLabel")
+        self.verticalLayout_5.addWidget(self.cacheLabel)
+        self.gridLayout.addWidget(self.groupBox_6, 4, 0, 1, 2)
         self.verticalLayout.addWidget(self.groupBox)
         self.line = QtWidgets.QFrame(VideoControlWidget)
         self.line.setFrameShape(QtWidgets.QFrame.HLine)
@@ -140,5 +152,7 @@ class Ui_VideoControlWidget(object):
         self.groupBox_3.setTitle(_translate("VideoControlWidget", "Playback speed"))
         self.groupBox_5.setTitle(_translate("VideoControlWidget", "Frame"))
         self.frameLabel.setText(_translate("VideoControlWidget", "0000"))
+        self.groupBox_6.setTitle(_translate("VideoControlWidget", "Frame cache"))
+        self.cacheLabel.setText(_translate("VideoControlWidget", "-"))
 
 import score_behavior.video_in_icons_rc
@@ -0,0 +1,292 @@
+# what is drawn on the frames during a trial, recorded next to the raw video instead of encoded in a second video,
+# and the renderer that draws it on the raw video afterwards
+
+import argparse
+import collections
+import concurrent.futures
+import os
+import struct
+import threading
+import time
+import logging
+
+import numpy as np
+import cv2
+
+from score_behavior.video_writer import AsyncVideoWriter
+
+logger = logging.getLogger(__name__)
+
+LINE = 1
+CIRCLE = 2
+RECTANGLE = 3
+TEXT = 4
+
+op_dtype = np.dtype([('op', 'u1'), ('line_type', 'u1'), ('font', 'u1'), ('thickness', '<i2'),
+                     ('color', '<f4', 4), ('points', '<i4', 4), ('radius', '<i4'), ('scale', '<f8'),
+                     ('text_start', '<u4'), ('text_length', '<u2')])
+
+# the overlay writers open, replaced rather than changed, so that it can be read from any thread without a lock
+_writers = ()
+
+
+def _color(color):
+    color = tuple(color) if np.ndim(color) else (color,)
+    return color + (0.,) * (4 - len(color))
+
+
+def _recording(img):
+    """the writer recording the image, and the operations drawn on it so far, or None if it is not recorded"""
+    for writer in _writers:
+        ops = writer.recorded_ops(img)
+        if ops is not None:
+            return writer, ops
+    return None
+
+
+def _record(img, op, color, thickness, line_type, points=(0, 0, 0, 0), radius=0, font=0, scale=0., text=None):
+    recording = _recording(img)
+    if recording is None:
+        return
+    recording[1].append((op, line_type, font, thickness, _color(color), tuple(int(p) for p in points), int(radius),
+                         scale, text))
+
+
+def line(img, pt1, pt2, color, thickness=1, lineType=cv2.LINE_8):
+    cv2.line(img, pt1, pt2, color, thickness, lineType)
+    _record(img, LINE, color, thickness, lineType, points=tuple(pt1) + tuple(pt2))
+
+
+def circle(img, center, radius, color, thickness=1, lineType=cv2.LINE_8):
+    cv2.circle(img, center, radius, color, thickness, lineType)
+    _record(img, CIRCLE, color, thickness, lineType, points=tuple(center) + (0, 0), radius=radius)
+
+
+def rectangle(img, pt1, pt2, color, thickness=1, lineType=cv2.LINE_8):
+    cv2.rectangle(img, pt1, pt2, color, thickness, lineType)
+    _record(img, RECTANGLE, color, thickness, lineType, points=tuple(pt1) + tuple(pt2))
+
+
+def put_text(img, text, org, fontFace, fontScale, color, thickness=1, lineType=cv2.LINE_8):
+    cv2.putText(img, text, org, fontFace, fontScale, color, thickness, lineType)
+    _record(img, TEXT, color, thickness, lineType, points=tuple(org) + (0, 0), font=fontFace, scale=fontScale,
+            text=text)
+
+
+def replace(img, src):
+    """writes src over the whole image, and returns whether it did.
+
+    A recorded image is left as it is, as it could not be drawn again from the raw video.
+    """
+    recording = _recording(img)
+    if recording is not None:
+        recording[0].warn_replaced()
+        return False
+    img[:] = src
+    return True
+
+
+def replay(img, ops, text):
+    """draws the operations recorded for a frame on it"""
+    for o in ops:
+        color = tuple(float(c) for c in o['color'])
+        p = [int(c) for c in o['points']]
+        thickness = int(o['thickness'])
+        line_type = int(o['line_type'])
+        if o['op'] == LINE:
+            cv2.line(img, (p[0], p[1]), (p[2], p[3]), color, thickness, line_type)
+        elif o['op'] == CIRCLE:
+            cv2.circle(img, (p[0], p[1]), int(o['radius']), color, thickness, line_type)
+        elif o['op'] == RECTANGLE:
+            cv2.rectangle(img, (p[0], p[1]), (p[2], p[3]), color, thickness, line_type)
+        elif o['op'] == TEXT:
+            s = text[o['text_start']:o['text_start'] + o['text_length']].decode('utf-8')
+            cv2.putText(img, s, (p[0], p[1]), int(o['font']), float(o['scale']), color, thickness, line_type)
+    return img
+
+
+class OverlayWriter:
+    """the sidecar of a raw video, with the drawing operations on each of its frames.
+
+    The frames are recorded from begin_frame, when they are written to the raw video, to end_frame, once everything
+    has been drawn on them. Several frames can be recorded at once, e.g. in the frame pipeline, each under the
+    number begin_frame gives it, even if they are the same image; they are written in the order they were begun,
+    which is the order of the raw video. What is drawn on an image goes to the oldest of its frames not ended yet.
+
+    The file is a header, then for each frame the number of operations and the size of their text, the operations,
+    as op_dtype, and their text, in utf-8.
+    """
+
+    magic = b'SCOV'
+    version = 1
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._file = open(filename, 'wb')
+        self._file.write(self.magic + struct.pack('<I', self.version))
+        self._frames = collections.OrderedDict()  # number -> (image, operations) of the frames being recorded
+        self._next_no = 0
+        self._lock = threading.Lock()
+        self._file_lock = threading.Lock()  # held while writing, so that the frames are written in order
+        self._warned_replaced = False
+        self.frames_written = 0
+        global _writers
+        _writers = _writers + (self,)
+
+    @staticmethod
+    def sidecar_file_name(video_file):
+        basename, _ = os.path.splitext(video_file)
+        return basename + '.overlay'
+
+    def begin_frame(self, frame):
+        """starts recording what is drawn on the frame, and returns its number"""
+        with self._lock:
+            frame_no = self._next_no
+            self._next_no += 1
+            self._frames[frame_no] = (frame, [])
+        return frame_no
+
+    def recorded_ops(self, img):
+        with self._lock:
+            for frame, ops in self._frames.values():
+                if frame is img:
+                    return ops
+        return None
+
+    def warn_replaced(self):
+        if not self._warned_replaced:
+            self._warned_replaced = True
+            logger.warning("a whole frame replacement, e.g. the thresholded view, can't be recorded in {}, "
+                           "left out".format(self.filename))
+
+    def end_frame(self, frame_no):
+        """writes the operations on the frame, and before it on the frames begun before it"""
+        with self._file_lock:
+            ended = []
+            with self._lock:
+                while self._frames:
+                    no = next(iter(self._frames))
+                    if no > frame_no:
+                        break
+                    ended.append(self._frames.pop(no)[1])
+            # written out of the frame lock, so that beginning a frame never waits on the file
+            for recorded in ended:
+                self._write_frame(recorded)
+
+    def _write_frame(self, recorded):
+        ops = np.zeros(len(recorded), dtype=op_dtype)
+        text = bytearray()
+        for i, (op, line_type, font, thickness, color, points, radius, scale, s) in enumerate(recorded):
+            ops[i] = (op, line_type, font, thickness, color, points, radius, scale, 0, 0)
+            if s is not None:
+                b = s.encode('utf-8')
+                ops[i]['text_start'] = len(text)
+                ops[i]['text_length'] = len(b)
+                text += b
+        self._file.write(struct.pack('<II', len(ops), len(text)))
+        self._file.write(ops.tobytes())
+        self._file.write(bytes(text))
+        self.frames_written += 1
+
+    def close(self):
+        global _writers
+        _writers = tuple(w for w in _writers if w is not self)
+        with self._file_lock:
+            with self._lock:
+                ended = [ops for _, ops in self._frames.values()]
+                self._frames.clear()
+            for recorded in ended:
+                self._write_frame(recorded)
+            self._file.close()
+
+
+def read_overlay(filename):
+    """the (operations, text) of each frame recorded in a sidecar"""
+    with open(filename, 'rb') as f:
+        header = f.read(8)
+        if len(header) < 8 or header[:4] != OverlayWriter.magic:
+            raise ValueError("{} is not an overlay file".format(filename))
+        version, = struct.unpack('<I', header[4:])
+        if version != OverlayWriter.version:
+            raise ValueError("unknown overlay file version {} in {}".format(version, filename))
+        while True:
+            h = f.read(8)
+            if len(h) < 8:
+                return
+            n_ops, n_text = struct.unpack('<II', h)
+            ops = np.frombuffer(f.read(n_ops * op_dtype.itemsize), dtype=op_dtype)
+            yield ops, f.read(n_text)
+
+
+def annotated_file_name(raw_file):
+    """the name the annotated video would have had, if it had been encoded during the trial"""
+    basename, ext = os.path.splitext(raw_file)
+    if basename.endswith('_raw'):
+        return basename[:-len('_raw')] + ext
+    return basename + '.annotated' + ext
+
+
+def render_overlay(raw_file, out_file=None, codec='MP42', overlay_file=None):
+    """writes the annotated video of a raw video and its sidecar, and returns the number of frames written.
+
+    Decoding, drawing and encoding overlap: the encoder runs on the thread of the video writer.
+    """
+    if out_file is None:
+        out_file = annotated_file_name(raw_file)
+    if overlay_file is None:
+        overlay_file = OverlayWriter.sidecar_file_name(raw_file)
+    capture = cv2.VideoCapture(raw_file)
+    if not capture.isOpened():
+        raise RuntimeError("Could not open video file {}".format(raw_file))
+    fps = capture.get(cv2.CAP_PROP_FPS)
+    size = (int(capture.get(cv2.CAP_PROP_FRAME_WIDTH)), int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+    writer = AsyncVideoWriter(out_file, cv2.VideoWriter_fourcc(*codec), fps, size)
+    frame = None
+    n = 0
+    try:
+        for ops, text in read_overlay(overlay_file):
+            ret, frame = capture.read(frame)
+            if not ret:
+                logger.warning("{} has fewer frames than its overlay".format(raw_file))
+                break
+            writer.write(replay(frame, ops, text))
+            n += 1
+        else:
+            if capture.grab():
+                logger.warning("{} has more frames than its overlay".format(raw_file))
+    finally:
+        writer.release()
+        capture.release()
+    return n
+
+
+def render_all(raw_files, jobs=None, codec='MP42'):
+    """renders the annotated videos of several raw videos in parallel"""
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(render_overlay, f, None, codec): f for f in raw_files}
+        for future in concurrent.futures.as_completed(futures):
+            raw_file = futures[future]
+            try:
+                logger.info("rendered {} frames of {} to {}".format(future.result(), raw_file,
+                                                                    annotated_file_name(raw_file)))
+            except (OSError, ValueError, RuntimeError, cv2.error) as e:
+                logger.error("could not render {}: {}".format(raw_file, e))
+
+
+def _main():
+    parser = argparse.ArgumentParser(description='Render the annotated videos of raw videos recorded with an '
+                                                 'overlay sidecar', prog='video_overlay')
+    parser.add_argument('videos', nargs='+', help="raw video files")
+    parser.add_argument('--jobs', type=int, default=None, help="number of videos rendered at once")
+    parser.add_argument('--codec', default='MP42', help="fourcc of the codec of the annotated videos")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    t0 = time.perf_counter()
+    render_all(args.videos, args.jobs, args.codec)
+    logger.info("rendered {} videos in {:.1f} s".format(len(args.videos), time.perf_counter() - t0))
+
+
+if __name__ == '__main__':
+    _main()
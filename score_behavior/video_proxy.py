@@ -0,0 +1,220 @@
+# downscaled copies of the trial videos, saved next to them, for navigating and reviewing them quickly
+
+import argparse
+import os
+import queue
+import struct
+import threading
+import time
+import logging
+
+import numpy as np
+import cv2
+
+from score_behavior.video_seek_index import read_avi_index
+
+logger = logging.getLogger(__name__)
+
+
+class VideoProxy:
+    """a downscaled copy of a video, in motion JPEG, and the frame of the video each of its frames is.
+
+    Each frame of the proxy is a JPEG image on its own, which is read from the file and decoded without going
+    through the video decoder: any frame takes a single decode, however far from the last one. The frame map goes
+    from the proxy frames to the frames of the video: it is the identity unless frames were left out when the
+    proxy was made, e.g. with a frame step, or because they could not be decoded.
+    """
+
+    version = 1
+
+    def __init__(self, video_file, frames, scale, video_size=0, video_mtime=0.):
+        self.video_file = video_file
+        self.frames = np.asarray(frames, dtype=np.int64)
+        self.scale = scale
+        self.video_size = video_size
+        self.video_mtime = video_mtime
+        self._offsets = None  # the offsets of the frames in the proxy file, once it is open
+        self._file = None
+
+    @staticmethod
+    def proxy_file_name(video_file):
+        basename, _ = os.path.splitext(video_file)
+        return basename + '.proxy.avi'
+
+    @staticmethod
+    def map_file_name(video_file):
+        basename, _ = os.path.splitext(video_file)
+        return basename + '.proxy.npz'
+
+    @property
+    def proxy_file(self):
+        return self.proxy_file_name(self.video_file)
+
+    @classmethod
+    def load(cls, video_file):
+        """the proxy of a video, or None if there is none or the video changed since it was made"""
+        filename = cls.map_file_name(video_file)
+        if not os.path.exists(filename) or not os.path.exists(cls.proxy_file_name(video_file)):
+            return None
+        try:
+            with np.load(filename) as d:
+                if int(d['version']) != cls.version:
+                    return None
+                proxy = cls(video_file, d['frames'], float(d['scale']), int(d['video_size']),
+                            float(d['video_mtime']))
+        except (OSError, KeyError, ValueError) as e:
+            logger.warning("could not read proxy frame map {}: {}".format(filename, e))
+            return None
+        stat = os.stat(video_file)
+        if proxy.video_size != stat.st_size or proxy.video_mtime != stat.st_mtime:
+            logger.info("video {} changed since its proxy was made".format(video_file))
+            return None
+        return proxy
+
+    def save(self):
+        filename = self.map_file_name(self.video_file)
+        tmp_filename = filename + '.tmp.npz'
+        np.savez(tmp_filename, version=self.version, frames=self.frames, scale=self.scale,
+                 video_size=self.video_size, video_mtime=self.video_mtime)
+        os.replace(tmp_filename, filename)
+
+    def proxy_frame(self, frame_no):
+        """the proxy frame of the last video frame at or before frame_no"""
+        return max(int(np.searchsorted(self.frames, frame_no, side='right')) - 1, 0)
+
+    def source_frame(self, proxy_frame_no):
+        return int(self.frames[min(max(int(proxy_frame_no), 0), len(self.frames) - 1)])
+
+    def read(self, proxy_frame_no, flags=cv2.IMREAD_COLOR):
+        """the frame of the proxy, or None if it can't be read. flags can ask the JPEG decoder for a reduced size"""
+        if self._file is None:
+            index = read_avi_index(self.proxy_file)
+            if index is None:
+                logger.warning("could not read the index of proxy {}".format(self.proxy_file))
+                return None
+            self._offsets = index[0]
+            self._file = open(self.proxy_file, 'rb')
+        if not 0 <= proxy_frame_no < len(self._offsets):
+            return None
+        self._file.seek(int(self._offsets[proxy_frame_no]))
+        _, size = struct.unpack('<4sI', self._file.read(8))
+        return cv2.imdecode(np.frombuffer(self._file.read(size), dtype=np.uint8), flags)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def make_proxy(video_file, scale=0.5, frame_step=1):
+    """writes the proxy of a video and its frame map, and returns it, or None if the video can't be read.
+
+    The proxy is written to a temporary file first, so that an interrupted job never leaves a truncated proxy
+    behind.
+    """
+    capture = cv2.VideoCapture(video_file)
+    if not capture.isOpened():
+        logger.warning("could not open video {} to make its proxy".format(video_file))
+        return None
+    stat = os.stat(video_file)
+    fps = capture.get(cv2.CAP_PROP_FPS) or 30.
+    w = int(capture.get(cv2.CAP_PROP_FRAME_WIDTH))
+    h = int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    size = (max(int(w * scale) // 2 * 2, 2), max(int(h * scale) // 2 * 2, 2))
+    proxy_file = VideoProxy.proxy_file_name(video_file)
+    tmp_file = proxy_file[:-len('.avi')] + '.tmp.avi'
+    writer = cv2.VideoWriter(tmp_file, cv2.VideoWriter_fourcc(*'MJPG'), fps / frame_step, size)
+    if not writer.isOpened():
+        logger.warning("could not open proxy file {} for writing".format(tmp_file))
+        capture.release()
+        return None
+    frames = []
+    small = np.empty((size[1], size[0], 3), dtype=np.uint8)
+    frame_no = 0
+    try:
+        while True:
+            if frame_no % frame_step == 0:
+                ret, frame = capture.read()
+                if not ret:
+                    break
+                cv2.resize(frame, size, dst=small, interpolation=cv2.INTER_AREA)
+                writer.write(small)
+                frames.append(frame_no)
+            elif not capture.grab():
+                break
+            frame_no += 1
+    finally:
+        writer.release()
+        capture.release()
+    if not frames:
+        os.remove(tmp_file)
+        return None
+    os.replace(tmp_file, proxy_file)
+    proxy = VideoProxy(video_file, frames, size[0] / w, stat.st_size, stat.st_mtime)
+    proxy.save()
+    return proxy
+
+
+class ProxyBuilder:
+    """makes the proxies of the videos submitted to it, one after the other, on its own thread"""
+
+    def __init__(self, scale=0.5, frame_step=1):
+        self.scale = scale
+        self.frame_step = frame_step
+        self._queue = queue.Queue()
+        self._closing = False
+        self._thread = threading.Thread(target=self.run, name="ProxyBuilder", daemon=True)
+        self._thread.start()
+
+    def submit(self, video_file):
+        self._queue.put(video_file)
+
+    @property
+    def pending(self):
+        return self._queue.qsize()
+
+    def run(self):
+        while True:
+            video_file = self._queue.get()
+            if video_file is None or self._closing:
+                return
+            t0 = time.perf_counter()
+            try:
+                proxy = make_proxy(video_file, self.scale, self.frame_step)
+            except (OSError, cv2.error) as e:
+                logger.warning("could not make the proxy of {}: {}".format(video_file, e))
+                continue
+            if proxy is not None:
+                logger.info("made proxy of {}: {} frames in {:.1f} s".format(video_file, len(proxy.frames),
+                                                                             time.perf_counter() - t0))
+
+    def close(self):
+        """finishes the proxy being made, and leaves out the ones not started yet"""
+        self._closing = True
+        if self.pending:
+            logger.info("{} proxy videos left to make".format(self.pending))
+        self._queue.put(None)
+        self._thread.join()
+
+
+def _main():
+    parser = argparse.ArgumentParser(description='Make the proxies of videos, for fast review', prog='video_proxy')
+    parser.add_argument('videos', nargs='+', help="video files")
+    parser.add_argument('--scale', type=float, default=0.5, help="size of the proxy relative to the video")
+    parser.add_argument('--frame-step', type=int, default=1, help="keep one frame every frame step")
+    parser.add_argument('--force', action='store_true', help="make the proxy again even if it is up to date")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    for video_file in args.videos:
+        if not args.force and VideoProxy.load(video_file) is not None:
+            logger.info("proxy of {} is up to date".format(video_file))
+            continue
+        t0 = time.perf_counter()
+        proxy = make_proxy(video_file, args.scale, args.frame_step)
+        if proxy is not None:
+            logger.info("made proxy of {}: {} frames in {:.1f} s".format(video_file, len(proxy.frames),
+                                                                         time.perf_counter() - t0))
+
+
+if __name__ == '__main__':
+    _main()
@@ -0,0 +1,312 @@
+import argparse
+import collections
+import threading
+import time
+import logging
+
+import numpy as np
+import cv2
+
+logger = logging.getLogger(__name__)
+
+
+class PrefetchingVideoReader:
+    """a cv2.VideoCapture of a video file, decoded on its own thread ahead of the frames read.
+
+    The decoded frames are kept in a cache of at most max_bytes, which also holds the frames decoded ahead, up to
+    read_ahead frames past the position. The frames read last are evicted first, so that rewinding or stepping back
+    a few frames is served from memory. Seeking far from the cached frames moves the decoder, through the seek
+    index if there is one. With a schedule, only the frames in it are decoded ahead, e.g. the keyframes when
+    reviewing a video at high speed.
+
+    It stands in for the capture as the video device manager uses it: read, grab, get and set of the position. The
+    frames read are copies, which can be drawn on.
+
+    hits counts the frames found in the cache, underruns the frames the decoder had not got to yet, and misses the
+    frames that needed a seek.
+    """
+
+    def __init__(self, capture, read_ahead=32, max_bytes=256 * 2 ** 20, seek_index=None):
+        self.capture = capture
+        self.read_ahead = max(int(read_ahead), 1)
+        self.max_bytes = max_bytes
+        self.seek_index = seek_index
+        self._properties = {p: capture.get(p) for p in (cv2.CAP_PROP_FRAME_WIDTH, cv2.CAP_PROP_FRAME_HEIGHT,
+                                                        cv2.CAP_PROP_FPS, cv2.CAP_PROP_FRAME_COUNT)}
+        self._cache = collections.OrderedDict()  # frame number -> frame, the least recently used first
+        self._free = []  # evicted frames, whose buffers are decoded into again
+        self._max_frames = None
+        self._position = int(capture.get(cv2.CAP_PROP_POS_FRAMES))  # the next frame read
+        self._decode_position = self._position  # the next frame decoded
+        self._capture_position = self._position  # the next frame the capture reads
+        self._end = None  # the number of frames, once the decoder has reached the end
+        self._requested = None  # the frame waited for by a read
+        self.schedule = None  # the frames to decode, in order, if not all of them
+        self._grab_time = None  # running averages of the time to decode a frame and to seek, in s
+        self._seek_time = None
+        self._condition = threading.Condition()
+        self._capture_lock = threading.Lock()
+        self._running = True
+        self.hits = 0
+        self.misses = 0
+        self.underruns = 0
+        self._thread = threading.Thread(target=self.run, name="PrefetchingVideoReader", daemon=True)
+        self._thread.start()
+
+    def isOpened(self):
+        return self.capture.isOpened()
+
+    def get(self, prop):
+        if prop == cv2.CAP_PROP_POS_FRAMES:
+            return float(self._position)
+        if prop in self._properties:
+            return self._properties[prop]
+        with self._capture_lock:
+            return self.capture.get(prop)
+
+    def set(self, prop, value):
+        if prop != cv2.CAP_PROP_POS_FRAMES:
+            with self._capture_lock:
+                return self.capture.set(prop, value)
+        with self._condition:
+            self._position = max(int(value), 0)
+            self._condition.notify_all()
+        return True
+
+    def set_schedule(self, frames):
+        """decodes only these frames, e.g. keyframes for a fast review, or every frame again if None"""
+        with self._condition:
+            self.schedule = None if frames is None else np.unique(np.asarray(frames, dtype=np.int64))
+            self._condition.notify_all()
+
+    def _scheduled_ahead(self):
+        start = int(np.searchsorted(self.schedule, self._position))
+        return self.schedule[start:start + self.read_ahead]
+
+    def _upcoming(self, frame_no):
+        """whether the decoder gets to the frame at the position without a seek"""
+        if self.schedule is None:
+            return self._decode_position <= frame_no
+        return frame_no in self._scheduled_ahead()
+
+    def _next_to_decode(self):
+        """the next frame for the decoder, or None if it is far enough ahead"""
+        if self._requested is not None and self._requested not in self._cache:
+            frame_no = self._requested
+        elif self.schedule is None:
+            self._decode_position = max(self._decode_position, self._position)
+            # the frames already cached are not decoded again
+            while self._decode_position in self._cache:
+                self._decode_position += 1
+            frame_no = self._decode_position
+            if frame_no >= self._position + self.read_ahead:
+                return None
+        else:
+            frame_no = next((int(f) for f in self._scheduled_ahead() if f not in self._cache), None)
+            if frame_no is None:
+                return None
+        if self._end is not None and frame_no >= self._end:
+            return None
+        return frame_no
+
+    def _next_frame(self):
+        """the frame at the position, waiting for the decoder if needed, or None past the end of the video"""
+        frame_no = self._position
+        frame = self._cache.get(frame_no)
+        if frame is not None:
+            self.hits += 1
+        else:
+            if self._upcoming(frame_no):
+                self.underruns += 1
+            else:
+                self.misses += 1
+            self._requested = frame_no
+            self._condition.notify_all()
+            while self._running and frame_no not in self._cache and (self._end is None or frame_no < self._end):
+                self._condition.wait(0.1)
+            self._requested = None
+            frame = self._cache.get(frame_no)
+            if frame is None:
+                return None
+        self._cache.move_to_end(frame_no)
+        self._position = frame_no + 1
+        self._condition.notify_all()
+        return frame
+
+    def read(self, image=None):
+        with self._condition:
+            frame = self._next_frame()
+            if frame is None:
+                return False, None
+            if image is None or image.shape != frame.shape or image.dtype != frame.dtype:
+                return True, frame.copy()
+            np.copyto(image, frame)
+            return True, image
+
+    def grab(self):
+        with self._condition:
+            return self._next_frame() is not None
+
+    def run(self):
+        while True:
+            with self._condition:
+                frame_no = None
+                while self._running:
+                    frame_no = self._next_to_decode()
+                    if frame_no is not None:
+                        break
+                    self._condition.wait()
+                if not self._running:
+                    return
+                buffer = self._free.pop() if self._free else None
+            with self._capture_lock:
+                if self._capture_position != frame_no:
+                    self._move_capture(frame_no)
+                ret, frame = self.capture.read(buffer)
+                self._capture_position = frame_no + 1 if ret else None
+            with self._condition:
+                if not ret:
+                    self._end = frame_no
+                    logger.debug("video ends at frame {}".format(frame_no))
+                elif frame is not buffer and buffer is not None:
+                    self._free.append(buffer)
+                if ret:
+                    self._put(frame_no, frame)
+                    if self.schedule is None:
+                        self._decode_position = frame_no + 1
+                self._condition.notify_all()
+
+    def _move_capture(self, frame_no):
+        """makes frame_no the next frame the capture reads, decoding the frames in between if that takes less time
+        than a seek"""
+        distance = frame_no - self._capture_position if self._capture_position is not None else -1
+        if distance <= 0:
+            grab = False
+        elif self._grab_time is None:
+            # decoding is timed on the first short enough move ahead, and seeking on the next one
+            grab = distance <= self.read_ahead
+        elif self._seek_time is None:
+            grab = distance == 1
+        else:
+            grab = distance * self._grab_time < self._seek_time
+        t0 = time.perf_counter()
+        if grab:
+            for _ in range(distance):
+                if not self.capture.grab():
+                    break
+            grab_time = (time.perf_counter() - t0) / distance
+            self._grab_time = grab_time if self._grab_time is None else self._grab_time + 0.2 * (
+                grab_time - self._grab_time)
+            return
+        if self.seek_index is not None:
+            self.seek_index.seek(self.capture, frame_no, self._capture_position)
+        else:
+            self.capture.set(cv2.CAP_PROP_POS_FRAMES, float(frame_no))
+        seek_time = time.perf_counter() - t0
+        self._seek_time = seek_time if self._seek_time is None else self._seek_time + 0.2 * (
+            seek_time - self._seek_time)
+
+    def _put(self, frame_no, frame):
+        if self._max_frames is None:
+            self._max_frames = max(int(self.max_bytes // frame.nbytes), self.read_ahead + 2)
+            logger.debug("caching up to {} frames".format(self._max_frames))
+        self._cache[frame_no] = frame
+        if self.schedule is None:
+            ahead = range(self._position, self._decode_position)
+        else:
+            ahead = set(self._scheduled_ahead().tolist())
+        while len(self._cache) > self._max_frames:
+            # the least recently used frame, leaving out the frames decoded ahead and not read yet
+            for evicted in self._cache:
+                if evicted not in ahead:
+                    break
+            else:
+                break
+            self._free.append(self._cache.pop(evicted))
+        del self._free[2:]
+
+    def statistics(self):
+        n = self.hits + self.underruns + self.misses
+        return {'hits': self.hits, 'underruns': self.underruns, 'misses': self.misses,
+                'hit_rate': self.hits / n if n else 0., 'frames': len(self._cache),
+                'ahead': sum(1 for f in self._cache if f >= self._position)}
+
+    def release(self):
+        with self._condition:
+            self._running = False
+            self._condition.notify_all()
+        self._thread.join()
+        self.capture.release()
+
+
+def run_reader_benchmark(video_file, n_frames=600, read_ahead=32, cache_mb=256, work_ms=10.):
+    """frames per second of plain and prefetched reading, with work_ms of work per frame, and the time to step
+    back 10 frames"""
+    for name in ('capture', 'prefetching'):
+        capture = cv2.VideoCapture(video_file)
+        if name == 'prefetching':
+            capture = PrefetchingVideoReader(capture, read_ahead, cache_mb * 2 ** 20)
+            time.sleep(0.2)
+        t0 = time.perf_counter()
+        read = 0
+        for _ in range(n_frames):
+            ret, frame = capture.read()
+            if not ret:
+                break
+            read += 1
+            time.sleep(work_ms * 1.e-3)
+        elapsed = time.perf_counter() - t0
+        position = int(capture.get(cv2.CAP_PROP_POS_FRAMES))
+        t1 = time.perf_counter()
+        for back in range(10):
+            capture.set(cv2.CAP_PROP_POS_FRAMES, float(position - 10 + back))
+            capture.read()
+        step_ms = 1.e3 * (time.perf_counter() - t1) / 10
+        line = "{:<12} {:.1f} frames/s ({:.1f} ms/frame of which {:.1f} ms work), step back {:.2f} ms/frame".format(
+            name + ':', read / elapsed, 1.e3 * elapsed / max(read, 1), work_ms, step_ms)
+        if name == 'prefetching':
+            s = capture.statistics()
+            line += ", {} hits, {} underruns, {} misses".format(s['hits'], s['underruns'], s['misses'])
+        print(line)
+        capture.release()
+
+
+def run_review_benchmark(video_file, steps=(1, 2, 4, 8, 16), n_frames=4800, read_ahead=32, cache_mb=256):
+    """frames of video per second got through when showing one frame every step frames, as in a fast review"""
+    from score_behavior.video_seek_index import VideoSeekIndex
+    seek_index = VideoSeekIndex.load_or_build(video_file)
+    for step in steps:
+        reader = PrefetchingVideoReader(cv2.VideoCapture(video_file), read_ahead, cache_mb * 2 ** 20, seek_index)
+        frame_count = int(reader.get(cv2.CAP_PROP_FRAME_COUNT))
+        frames = np.arange(0, min(frame_count, n_frames), step)
+        if step > 1:
+            reader.set_schedule(frames)
+        t0 = time.perf_counter()
+        for frame_no in frames:
+            reader.set(cv2.CAP_PROP_POS_FRAMES, float(frame_no))
+            reader.read()
+        elapsed = time.perf_counter() - t0
+        print("step {:>2}: {:.0f} video frames/s, {:.2f} ms per frame shown".format(
+            step, (frames[-1] + step) / elapsed, 1.e3 * elapsed / len(frames)))
+        reader.release()
+
+
+def _main():
+    parser = argparse.ArgumentParser(description='Benchmark reading a video with and without prefetching',
+                                     prog='video_reader')
+    parser.add_argument('video', help="video file")
+    parser.add_argument('--frames', type=int, default=600, help="number of frames to read")
+    parser.add_argument('--read-ahead', type=int, default=32, help="number of frames decoded ahead")
+    parser.add_argument('--cache-mb', type=float, default=256., help="size of the frame cache")
+    parser.add_argument('--work-ms', type=float, default=10., help="time spent on each frame after reading it")
+    parser.add_argument('--review', action='store_true', help="time showing one frame in 1 to 16, as in a fast "
+                                                              "review, instead")
+    args = parser.parse_args()
+    if args.review:
+        run_review_benchmark(args.video, n_frames=args.frames, read_ahead=args.read_ahead, cache_mb=args.cache_mb)
+    else:
+        run_reader_benchmark(args.video, args.frames, args.read_ahead, args.cache_mb, args.work_ms)
+
+
+if __name__ == '__main__':
+    _main()
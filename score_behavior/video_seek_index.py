@@ -0,0 +1,285 @@
+# a per video index of the frames and keyframes, saved next to the video, for frame accurate seeking
+
+import argparse
+import os
+import struct
+import time
+import logging
+
+import numpy as np
+import cv2
+
+logger = logging.getLogger(__name__)
+
+AVIIF_KEYFRAME = 0x10
+ODML_NOT_KEYFRAME = 0x80000000
+
+
+def _chunks(f, start, end):
+    """the (fourcc, data start, data size) of the chunks between start and end, lists as (list type, ...)"""
+    pos = start
+    while pos + 8 <= end:
+        f.seek(pos)
+        header = f.read(12)
+        if len(header) < 8:
+            return
+        fourcc, size = struct.unpack('<4sI', header[:8])
+        if fourcc in (b'LIST', b'RIFF'):
+            yield header[8:12], pos + 12, size - 4
+        else:
+            yield fourcc, pos + 8, size
+        pos += 8 + size + (size & 1)
+
+
+def _find(f, start, end, fourcc):
+    for c, data_start, size in _chunks(f, start, end):
+        if c == fourcc:
+            return data_start, size
+    return None
+
+
+def read_avi_index(filename):
+    """the byte offsets, keyframe flags and timestamps (ms) of the frames of the video stream of an avi file.
+
+    The OpenDML index is used if there is one, as it covers files larger than the 1 GB of the original avi index.
+    Returns None if the file is not an avi file or has no index.
+    """
+    file_size = os.path.getsize(filename)
+    with open(filename, 'rb') as f:
+        riff, _, form = struct.unpack('<4sI4s', f.read(12))
+        if riff != b'RIFF' or form != b'AVI ':
+            return None
+        hdrl = _find(f, 12, file_size, b'hdrl')
+        movi = _find(f, 12, file_size, b'movi')
+        if hdrl is None or movi is None:
+            return None
+        # the first video stream
+        stream = 0
+        scale = rate = None
+        start = 0
+        super_index = None
+        for fourcc, data_start, size in _chunks(f, hdrl[0], hdrl[0] + hdrl[1]):
+            if fourcc != b'strl':
+                continue
+            strh = _find(f, data_start, data_start + size, b'strh')
+            f.seek(strh[0])
+            fcc_type, _, _, _, _, _, s, r, st = struct.unpack('<4s4sIHHIIII', f.read(32))
+            if fcc_type == b'vids':
+                scale, rate, start = s, r, st
+                super_index = _find(f, data_start, data_start + size, b'indx')
+                break
+            stream += 1
+        if not rate:
+            return None
+        chunk_ids = (b'%02ddc' % stream, b'%02ddb' % stream)
+
+        offsets = []
+        keyframes = []
+        if super_index is not None:
+            f.seek(super_index[0])
+            _, _, _, n_entries, _ = struct.unpack('<HBBI4s', f.read(12))
+            f.seek(super_index[0] + 24)
+            entries = np.frombuffer(f.read(16 * n_entries), dtype=[('offset', '<u8'), ('size', '<u4'),
+                                                                   ('duration', '<u4')])
+            for ix_offset in entries['offset']:
+                f.seek(int(ix_offset) + 8)
+                _, _, _, n, _, base = struct.unpack('<HBBI4sQ', f.read(20))
+                f.seek(4, 1)
+                ix = np.frombuffer(f.read(8 * n), dtype=[('offset', '<u4'), ('size', '<u4')])
+                offsets.append(base + ix['offset'].astype(np.int64) - 8)  # the offsets of the chunk headers
+                keyframes.append((ix['size'] & ODML_NOT_KEYFRAME) == 0)
+        else:
+            idx1 = _find(f, 12, file_size, b'idx1')
+            if idx1 is None:
+                return None
+            f.seek(idx1[0])
+            entries = np.frombuffer(f.read(idx1[1] // 16 * 16), dtype=[('id', 'S4'), ('flags', '<u4'),
+                                                                      ('offset', '<u4'), ('size', '<u4')])
+            entries = entries[np.isin(entries['id'], chunk_ids)]
+            if len(entries) == 0:
+                return None
+            entry_offsets = entries['offset'].astype(np.int64)
+            # the offsets are relative to the movi list, or, in some files, to the start of the file
+            f.seek(movi[0] - 4 + int(entry_offsets[0]))
+            if f.read(4) in chunk_ids:
+                entry_offsets += movi[0] - 4
+            offsets.append(entry_offsets)
+            keyframes.append((entries['flags'] & AVIIF_KEYFRAME) != 0)
+    offsets = np.concatenate(offsets)
+    keyframes = np.concatenate(keyframes)
+    timestamps = (start + np.arange(len(offsets))) * (1.e3 * scale / rate)
+    return offsets, keyframes, timestamps
+
+
+class VideoSeekIndex:
+    """the frames of a video, which of them are keyframes, and their timestamps.
+
+    Seeking goes to the keyframe at or before the frame, which every decoder lands on exactly, and decodes the
+    frames up to it, at most as many as there are between two keyframes.
+    """
+
+    version = 1
+
+    def __init__(self, offsets, keyframes, timestamps, video_size=0, video_mtime=0.):
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.keyframes = np.asarray(keyframes, dtype=bool)
+        self.timestamps = np.asarray(timestamps, dtype=float)
+        self.video_size = video_size
+        self.video_mtime = video_mtime
+        self.keyframe_numbers = np.flatnonzero(self.keyframes)
+        if len(self.keyframe_numbers) == 0 or self.keyframe_numbers[0] != 0:
+            # the first frame can always be decoded
+            self.keyframe_numbers = np.concatenate([[0], self.keyframe_numbers])
+
+    @property
+    def frame_count(self):
+        return len(self.offsets)
+
+    @property
+    def max_keyframe_interval(self):
+        return int(np.max(np.diff(np.append(self.keyframe_numbers, self.frame_count))))
+
+    @staticmethod
+    def sidecar_file_name(video_file):
+        basename, _ = os.path.splitext(video_file)
+        return basename + '.seek.npz'
+
+    @classmethod
+    def build(cls, video_file):
+        """the index of a video, or None if it can't be indexed"""
+        try:
+            index = read_avi_index(video_file)
+        except (OSError, struct.error, ValueError, TypeError) as e:
+            logger.warning("could not read the index of {}: {}".format(video_file, e))
+            return None
+        if index is None:
+            return None
+        stat = os.stat(video_file)
+        return cls(*index, video_size=stat.st_size, video_mtime=stat.st_mtime)
+
+    @classmethod
+    def load(cls, video_file, filename=None):
+        """the index saved for a video, or None if there is none or the video changed since"""
+        if filename is None:
+            filename = cls.sidecar_file_name(video_file)
+        if not os.path.exists(filename):
+            return None
+        try:
+            with np.load(filename) as d:
+                if int(d['version']) != cls.version:
+                    return None
+                index = cls(d['offsets'], d['keyframes'], d['timestamps'], int(d['video_size']),
+                            float(d['video_mtime']))
+        except (OSError, KeyError, ValueError) as e:
+            logger.warning("could not read seek index {}: {}".format(filename, e))
+            return None
+        stat = os.stat(video_file)
+        if index.video_size != stat.st_size or index.video_mtime != stat.st_mtime:
+            logger.info("video {} changed since its seek index was built".format(video_file))
+            return None
+        return index
+
+    def save(self, video_file, filename=None):
+        if filename is None:
+            filename = self.sidecar_file_name(video_file)
+        # written to a temporary file first, so that a crash never leaves a truncated index behind
+        tmp_filename = filename + '.tmp.npz'
+        try:
+            np.savez(tmp_filename, version=self.version, offsets=self.offsets, keyframes=self.keyframes,
+                     timestamps=self.timestamps, video_size=self.video_size, video_mtime=self.video_mtime)
+            os.replace(tmp_filename, filename)
+        except OSError as e:
+            logger.warning("could not save seek index {}: {}".format(filename, e))
+
+    @classmethod
+    def load_or_build(cls, video_file):
+        """the saved index of a video, or a new one, saved for the next time"""
+        index = cls.load(video_file)
+        if index is not None:
+            logger.debug("loaded seek index of {}".format(video_file))
+            return index
+        t0 = time.perf_counter()
+        index = cls.build(video_file)
+        if index is None:
+            logger.info("no seek index for {}, seeking is left to the decoder".format(video_file))
+            return None
+        logger.info("built seek index of {}: {} frames, {} keyframes, in {:.1f} ms".format(
+            video_file, index.frame_count, len(index.keyframe_numbers), 1.e3 * (time.perf_counter() - t0)))
+        index.save(video_file)
+        return index
+
+    def keyframe_before(self, frame_no):
+        """the last keyframe at or before the frame"""
+        return int(self.keyframe_numbers[np.searchsorted(self.keyframe_numbers, frame_no, side='right') - 1])
+
+    def timestamp(self, frame_no):
+        return float(self.timestamps[min(max(int(frame_no), 0), self.frame_count - 1)])
+
+    def seek(self, capture, frame_no, current=None):
+        """positions the capture so that the next frame read is frame_no.
+
+        If the capture is at frame current (the number of the next frame it reads) and the frame is ahead of it, at
+        or after the keyframe it is in, the frames in between are decoded without seeking.
+        """
+        frame_no = min(max(int(frame_no), 0), self.frame_count)
+        keyframe = self.keyframe_before(frame_no)
+        if current is None or not keyframe <= current <= frame_no:
+            capture.set(cv2.CAP_PROP_POS_FRAMES, float(keyframe))
+            current = keyframe
+        for _ in range(frame_no - current):
+            if not capture.grab():
+                return False
+        return True
+
+
+def run_seek_benchmark(video_file, n_seeks=100, seed=0):
+    """time and accuracy of random seeks with the index and with the decoder alone, against the frames read in
+    sequence"""
+    index = VideoSeekIndex.load_or_build(video_file)
+    if index is None:
+        print("{} can't be indexed".format(video_file))
+        return
+    rng = np.random.RandomState(seed)
+    targets = np.sort(rng.randint(0, index.frame_count, n_seeks))
+    capture = cv2.VideoCapture(video_file)
+    reference = {}
+    frame_no = 0
+    for target in targets:
+        while frame_no <= target:
+            ret, frame = capture.read()
+            frame_no += 1
+        reference[target] = frame
+    rng.shuffle(targets)
+    print("{}: {} frames, {} keyframes, at most {} frames between keyframes".format(
+        video_file, index.frame_count, len(index.keyframe_numbers), index.max_keyframe_interval))
+    for name in ('index', 'decoder'):
+        errors = 0
+        t0 = time.perf_counter()
+        for target in targets:
+            if name == 'index':
+                index.seek(capture, target)
+            else:
+                capture.set(cv2.CAP_PROP_POS_FRAMES, float(target))
+            ret, frame = capture.read()
+            errors += int(not ret or not np.array_equal(frame, reference[target]))
+        elapsed = time.perf_counter() - t0
+        print("{:<8} {:.2f} ms/seek, {} of {} frames wrong".format(name + ':', 1.e3 * elapsed / len(targets), errors,
+                                                                   len(targets)))
+
+
+def _main():
+    parser = argparse.ArgumentParser(description='Build the seek indexes of videos', prog='video_seek_index')
+    parser.add_argument('videos', nargs='+', help="video files")
+    parser.add_argument('--benchmark', type=int, default=0, metavar='N',
+                        help="time N random seeks with and without the index")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    for video_file in args.videos:
+        if args.benchmark:
+            run_seek_benchmark(video_file, args.benchmark)
+        else:
+            VideoSeekIndex.load_or_build(video_file)
+
+
+if __name__ == '__main__':
+    _main()
@@ -0,0 +1,189 @@
+import collections
+import os
+import tempfile
+import threading
+import time
+import logging
+
+import numpy as np
+import cv2
+
+from score_behavior.frame_pipeline import LatencyHistogram
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncVideoWriter:
+    """a cv2.VideoWriter that encodes on its own thread, fed through a bounded queue of frames.
+
+    When the queue is full, the policy decides what happens to a new frame:
+    - 'block': the caller waits until the encoder has made room
+    - 'drop_oldest': the oldest frame still waiting is dropped
+    - 'spill': the frame is written raw to a temporary file, and encoded from there in its turn
+    """
+
+    policies = ('block', 'drop_oldest', 'spill')
+
+    def __init__(self, filename, fourcc, fps, frame_size, queue_size=64, policy='block'):
+        if policy not in self.policies:
+            raise ValueError("Unknown video writer policy {}".format(policy))
+        self.filename = filename
+        self.queue_size = max(int(queue_size), 1)
+        self.policy = policy
+        self._writer = cv2.VideoWriter(filename, fourcc, fps, frame_size)
+        self._queue = collections.deque()
+        self._in_memory = 0
+        self._free = []  # the buffers of the frames already encoded
+        self._condition = threading.Condition()
+        self._closing = False
+
+        self.written = 0
+        self.dropped = 0
+        self.spilled = 0
+        self.max_depth = 0
+        self.latency = LatencyHistogram()  # time to encode each frame
+
+        self._spill_file = None  # written by the callers of write, and read back by the encoder
+        self._spill_read_file = None
+        self._spill_write_lock = threading.Lock()
+        self._spill_name = None
+        self._spill_offset = 0
+        self._spill_pending = 0
+
+        self._thread = None
+        if self._writer.isOpened():
+            self._thread = threading.Thread(target=self.run, name="AsyncVideoWriter", daemon=True)
+            self._thread.start()
+
+    def isOpened(self):
+        return self._writer.isOpened()
+
+    @property
+    def depth(self):
+        """the number of frames waiting to be encoded"""
+        return len(self._queue)
+
+    def write(self, frame):
+        """queues a copy of the frame, so that the caller can keep drawing on it"""
+        if self._thread is None:
+            # the file could not be opened, nothing would ever take the frame from the queue
+            self.dropped += 1
+            return
+        ref = None
+        with self._condition:
+            if self._in_memory >= self.queue_size:
+                if self.policy == 'block':
+                    while self._in_memory >= self.queue_size:
+                        self._condition.wait()
+                elif self.policy == 'drop_oldest':
+                    if not self._queue:
+                        # the only frame in memory is being encoded, so the new one is the oldest waiting
+                        self.dropped += 1
+                        return
+                    self._drop_oldest()
+                else:
+                    ref = self._reserve_spill(frame)
+            if ref is None:
+                buffer = self._take_buffer(frame)
+                np.copyto(buffer, frame)
+                self._queue.append(buffer)
+                self._in_memory += 1
+                self._notify()
+                return
+        # the frame is written to the spill file out of the lock, so that the encoder is not held up by the disk
+        self._spill(ref, frame)
+        with self._condition:
+            self._queue.append(ref)
+            self._notify()
+
+    def _take_buffer(self, frame):
+        """a buffer for a copy of the frame, reused from the frames already encoded if possible"""
+        while self._free:
+            buffer = self._free.pop()
+            if buffer.shape == frame.shape and buffer.dtype == frame.dtype:
+                return buffer
+        return np.empty_like(frame)
+
+    def _notify(self):
+        self.max_depth = max(self.max_depth, len(self._queue))
+        self._condition.notify_all()
+
+    def _drop_oldest(self):
+        self._free.append(self._queue.popleft())
+        self._in_memory -= 1
+        self.dropped += 1
+
+    def _reserve_spill(self, frame):
+        """the place of the frame in the spill file, where it is written next, called with the lock held"""
+        if self._spill_file is None:
+            fd, spill_name = tempfile.mkstemp(prefix=os.path.basename(self.filename) + '.', suffix='.spill',
+                                              dir=os.path.dirname(os.path.abspath(self.filename)))
+            self._spill_file = os.fdopen(fd, 'wb')
+            # unbuffered, as the file is written over again once everything in it has been read back
+            self._spill_read_file = open(spill_name, 'rb', buffering=0)
+            self._spill_name = spill_name
+        ref = (self._spill_offset, frame.shape, frame.dtype)
+        self._spill_offset += frame.nbytes
+        # counted from the reservation, so that the file is not started over while a frame is being written to it
+        self._spill_pending += 1
+        self.spilled += 1
+        return ref
+
+    def _spill(self, ref, frame):
+        with self._spill_write_lock:
+            self._spill_file.seek(ref[0])
+            self._spill_file.write(frame.tobytes())
+            self._spill_file.flush()
+
+    def _unspill(self, ref):
+        """reads the frame back from the spill file, on the encoder thread"""
+        offset, shape, dtype = ref
+        frame = np.empty(shape, dtype)
+        self._spill_read_file.seek(offset)
+        self._spill_read_file.readinto(frame)
+        return frame
+
+    def run(self):
+        while True:
+            with self._condition:
+                while not self._queue and not self._closing:
+                    self._condition.wait()
+                if not self._queue:
+                    return
+                item = self._queue.popleft()
+            spilled = isinstance(item, tuple)
+            if spilled:
+                item = self._unspill(item)
+                with self._condition:
+                    self._spill_pending -= 1
+                    if self._spill_pending == 0:
+                        # everything spilled has been read back, start the file over
+                        self._spill_offset = 0
+                        self._spill_file.truncate(0)
+            t0 = time.perf_counter()
+            self._writer.write(item)
+            self.latency.add(time.perf_counter() - t0)
+            with self._condition:
+                if not spilled:
+                    # the room in the queue is only given back once the buffer can be reused
+                    self._free.append(item)
+                    self._in_memory -= 1
+                self.written += 1
+                self._condition.notify_all()
+
+    def release(self):
+        """encodes all the frames still in the queue, and closes the file"""
+        with self._condition:
+            self._closing = True
+            self._condition.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+        self._writer.release()
+        if self._spill_file is not None:
+            self._spill_file.close()
+            self._spill_read_file.close()
+            os.remove(self._spill_name)
+            self._spill_file = None
+        logger.info("closed video file {}: {} frames written, {} dropped, {} spilled, max queue depth {}".format(
+            self.filename, self.written, self.dropped, self.spilled, self.max_depth))
+        logger.info("encoding latency: " + self.latency.summary())
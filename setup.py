@@ -43,5 +43,6 @@ setup(description='Behavioral scorer',
       entry_points="""
         [console_scripts]
         score=score_behavior.score_window:_main
+        score-track=score_behavior.score_track:_main
       """)
       #install_requires=['pandas', 'appdirs', 'neuroseries', 'PyQt5', 'numpy'])
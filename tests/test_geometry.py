@@ -0,0 +1,108 @@
+"""parity of the vectorized geometry functions with the scalar ones they stand in for"""
+
+import numpy as np
+import pytest
+
+import score_behavior.tracking.geometry as geometry
+from score_behavior.tracking.geometry import Point
+
+
+def _points(rng, n):
+    """random points, half of them on a small integer grid, so that vertical, horizontal and coincident cases come
+    up often"""
+    p = rng.uniform(-50., 50., (n, 2))
+    p[::2] = rng.randint(-3, 4, (len(p[::2]), 2))
+    return p
+
+
+def _distances(rng, n):
+    d = rng.uniform(-30., 30., n)
+    d[::3] = rng.randint(-2, 3, len(d[::3]))
+    return d
+
+
+@pytest.fixture
+def cases():
+    rng = np.random.RandomState(0)
+    n = 3000
+    start, end, other = _points(rng, n), _points(rng, n), _points(rng, n)
+    distance = _distances(rng, n)
+    # degenerate cases: vertical lines, horizontal lines, coincident points, zero and negative distances
+    start[:4] = [[1., 1.], [1., 1.], [1., 1.], [1., 1.]]
+    end[:4] = [[1., 5.], [1., -5.], [1., 1.], [6., 1.]]
+    distance[:4] = [3., -3., 2., -2.]
+    distance[4:8] = 0.
+    return start, end, other, distance
+
+
+def _assert_same(vectorized, scalar):
+    np.testing.assert_array_equal(np.asarray(vectorized, dtype=float), np.asarray(scalar, dtype=float))
+
+
+def test_point_along_a_line(cases):
+    start, end, _, distance = cases
+    expected = [geometry.point_along_a_line(s[0], s[1], e[0], e[1], d) for s, e, d in zip(start, end, distance)]
+    _assert_same(geometry.point_along_a_line_v(start, end, distance), expected)
+
+
+def test_point_along_a_perpendicular(cases):
+    start, end, other, distance = cases
+    expected = [geometry.point_along_a_perpendicular(s[0], s[1], e[0], e[1], p[0], p[1], d)
+                for s, e, p, d in zip(start, end, other, distance)]
+    _assert_same(geometry.point_along_a_perpendicular_v(start, end, other, distance), expected)
+
+
+def test_point_along_a_line_eq(cases):
+    start, end, _, distance = cases
+    k = (end[:, 1] - start[:, 1]) / 7.
+    k[::4] = 0.
+    expected = [geometry.point_along_a_line_eq(kk, s[0], s[1], d) for kk, s, d in zip(k, start, distance)]
+    _assert_same(geometry.point_along_a_line_eq_v(k, start, distance), expected)
+
+
+def test_distance(cases):
+    start, end, _, _ = cases
+    expected = [geometry.distance(s[0], s[1], e[0], e[1]) for s, e in zip(start, end)]
+    _assert_same(geometry.distance_v(start, end), expected)
+
+
+def test_line_equation(cases):
+    start, end, _, _ = cases
+    expected = [geometry.line_equation(s[0], s[1], e[0], e[1]) for s, e in zip(start, end)]
+    k, intercept = geometry.line_equation_v(start, end)
+    _assert_same(np.stack((k, intercept), axis=-1), expected)
+
+
+def test_cosine(cases):
+    start, end, other, _ = cases
+    expected = [geometry.cosine(a[0], a[1], b[0], b[1], c[0], c[1]) for a, b, c in zip(start, end, other)]
+    _assert_same(geometry.cosine_v(start, end, other), expected)
+
+
+def test_intersection_with_circle(cases):
+    start, end, other, distance = cases
+    radius = np.abs(distance) + 1.
+    i1, i2 = geometry.intersection_with_circle_v(start, end, other, radius)
+    for j in range(len(start)):
+        e1, e2 = geometry.intersection_with_circle(Point(start[j]), Point(end[j]), Point(other[j]), radius[j])
+        if e1 is None:
+            assert np.isnan(i1[j]).all() and np.isnan(i2[j]).all()
+        else:
+            _assert_same(i1[j], e1)
+            _assert_same(i2[j], e2)
+
+
+def test_angle(cases):
+    start, end, other, _ = cases
+    expected = [geometry.angle(a[0], a[1], b[0], b[1], c[0], c[1]) for a, b, c in zip(start, end, other)]
+    _assert_same(geometry.angle_v(start, end, other), expected)
+
+
+def test_rotate(cases):
+    start, end, _, distance = cases
+    angles = distance / 10.
+    expected = [geometry.rotate_p(Point(p), Point(q), a) for p, q, a in zip(start, end, angles)]
+    _assert_same(geometry.rotate_v(start, end, angles), expected)
+    # a single angle for all the points
+    expected = [geometry.rotate_p(Point(p), Point(q), 0.3) for p, q in zip(start, end)]
+    _assert_same(geometry.rotate_v(start, end, 0.3), expected)